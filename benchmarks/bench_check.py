@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+''' Checks/second of the asyncio engine vs the scrapy proxy_check path
+
+    python -m benchmarks.bench_check --checks 5000 --latency 0.05
+'''
+import time
+import asyncio
+import argparse
+
+from benchmarks.stubs import StubProxyFarm, VALIDATOR_URL, STARTSTRING
+
+def bench_asyncio(proxies, args):
+    from proxy_spider.aiocheck import check_proxies, Timeouts
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    started = time.time()
+    results = loop.run_until_complete(check_proxies(
+        proxies, [(VALIDATOR_URL, STARTSTRING)], Timeouts(),
+        concurrency=args.concurrency, per_host=args.concurrency))
+    elapsed = time.time() - started
+    loop.close()
+    return elapsed, sum(r.valid for r in results)
+
+def bench_scrapy(proxies, args):
+    ''' Same requests, settings and middlewares as ProxyCheckSpider, minus
+    the redis writes, so only the validation path is measured
+    '''
+    from scrapy import Spider, Request
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+
+    valid = []
+    class BenchCheckSpider(Spider):
+        name = 'bench_check'
+        def start_requests(self):
+            for proxy in proxies:
+                yield Request(url=VALIDATOR_URL, meta={'proxy': proxy, 'startstring': STARTSTRING},
+                    callback=self.checkin, dont_filter=True)
+        def checkin(self, response):
+            if response.body_as_unicode().startswith(STARTSTRING):
+                valid.append(response.meta['proxy'])
+
+    settings = get_project_settings()
+    settings.set('ITEM_PIPELINES', {})
+    settings.set('LOG_LEVEL', 'WARNING')
+    process = CrawlerProcess(settings)
+    process.crawl(BenchCheckSpider)
+    started = time.time()
+    process.start()
+    return time.time() - started, len(valid)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--checks', type=int, default=2000)
+    parser.add_argument('--ports', type=int, default=50, help='number of stub proxies')
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--concurrency', type=int, default=2000)
+    parser.add_argument('--engine', choices=['asyncio', 'scrapy', 'both'], default='both')
+    args = parser.parse_args()
+
+    farm = StubProxyFarm(args.ports, args.latency, args.failure_rate).start()
+    proxies = [farm.proxies[i % len(farm.proxies)] for i in range(args.checks)]
+    engines = ['asyncio', 'scrapy'] if args.engine == 'both' else [args.engine]
+    print('%-8s %8s %8s %10s' % ('engine', 'checks', 'valid', 'checks/s'))
+    for engine in engines:
+        elapsed, valid = globals()['bench_' + engine](proxies, args)
+        print('%-8s %8d %8d %10.1f' % (engine, len(proxies), valid, len(proxies) / elapsed))
+    farm.stop()
+
+if __name__ == '__main__':
+    main()
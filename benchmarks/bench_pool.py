@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+''' End-to-end throughput of hq-proxies against local stubs, no network or redis
+
+For every pool size, stub vendors list that many stub proxies, a fetch run
+validates them into an in-process FakeRedis, then a full check run
+re-validates the pool. Reports fetch-to-pool latency, checks/second and
+redis commands/round-trips per proxy.
+
+    python -m benchmarks.bench_pool --sizes 100,1000,10000,100000 --engine asyncio
+    python -m benchmarks.bench_pool --sizes 1000 --engine scrapy --failure-rate 0.3
+
+--skip-fetch seeds the pool directly instead of crawling the stub vendors,
+with --engine asyncio that needs neither scrapy nor twisted.
+'''
+import time
+import argparse
+
+from benchmarks.fakeredis import FakeRedis
+from benchmarks.stubs import StubValidator, StubProxyFarm, StubVendors, STARTSTRING
+
+ROW = '%-8s %-6s %-8s %9s %10s %9s %9s %10s %9s'
+
+def bench_config(validator, vendors, args):
+    return {
+        'PROXY_COUNT': 'bench:proxy_count',
+        'PROXY_SET': 'bench:proxy_pool',
+        'PROXY_VENDORS': vendors.vendors() if vendors else [],
+        'PROXY_VALIDATORS': [{'url': validator.url, 'startstring': STARTSTRING}],
+        'CHECK_MODE': 'full',
+        'CHECK_CONCURRENCY': args.concurrency,
+        'CHECK_PER_VALIDATOR': args.concurrency,
+        'VENDOR_TIMEOUT': 60,
+        'VENDOR_DEADLINE': 3600,
+        'FETCH_DEADLINE': 3600,
+        'LOG_SAMPLE_RATE': 0,
+    }
+
+class Probe(object):
+    ''' Commands, round-trips and pool growth over one phase
+    '''
+    def __init__(self, redis_db, config):
+        self.redis_db = redis_db
+        self.key = config['PROXY_SET']
+        self.started = time.time()
+        self.commands = redis_db.commands
+        self.roundtrips = redis_db.roundtrips
+        self.first = None
+
+    def poll(self):
+        if self.first is None and self.redis_db.data.get(self.key.encode('utf-8')):
+            self.first = time.time() - self.started
+
+    def report(self, size, phase, engine, done):
+        elapsed = time.time() - self.started
+        pool = len(self.redis_db.data.get(self.key.encode('utf-8'), ()))
+        print(ROW % (size, phase, engine, '%.2f' % elapsed, '%.1f' % (done / elapsed),
+            '%.2f' % self.first if self.first is not None else '-', pool,
+            '%.2f' % ((self.redis_db.commands - self.commands) / max(done, 1)),
+            '%.2f' % ((self.redis_db.roundtrips - self.roundtrips) / max(done, 1))))
+
+def seed(pool, farm, size):
+    pool.apply([{'proxy': farm.address(i), 'valid': True, 'latency': None, 'source': 'fetch'} for i in range(size)])
+
+def run_asyncio_only(args, sizes, validator, farm):
+    ''' --skip-fetch --engine asyncio: drive aiocheck directly
+    '''
+    from proxy_spider.pool import ProxyPool
+    from proxy_spider.utils import load_validators
+    from proxy_spider import aiocheck
+    for size in sizes:
+        redis_db = FakeRedis()
+        config = bench_config(validator, None, args)
+        pool = ProxyPool(redis_db, config)
+        seed(pool, farm, size)
+        probe = Probe(redis_db, config)
+        aiocheck.run_check(pool, load_validators(config), config, 'full')
+        probe.poll()
+        probe.report(size, 'check', 'asyncio', size)
+
+def run_reactor(args, sizes, validator, farm):
+    from twisted.internet import reactor, defer, task, threads
+    from scrapy.crawler import CrawlerRunner
+    from scrapy.utils.project import get_project_settings
+    from proxy_spider.spiders.proxy_spider import ProxyCheckSpider, ProxyFetchSpider
+    from proxy_spider.pool import ProxyPool
+    from proxy_spider.utils import load_validators
+    from proxy_spider import aiocheck
+
+    settings = get_project_settings()
+    settings.set('LOG_LEVEL', 'WARNING')
+    runner = CrawlerRunner(settings)
+
+    def crawl(spidercls, config, redis_db):
+        return runner.crawl(spidercls, config=config, redis_db=redis_db,
+            validator_pool=load_validators(config))
+
+    @defer.inlineCallbacks
+    def run_all():
+        for size in sizes:
+            vendors = None if args.skip_fetch else StubVendors([farm.address(i) for i in range(size)]).start()
+            redis_db = FakeRedis()
+            config = bench_config(validator, vendors, args)
+            pool = ProxyPool(redis_db, config)
+
+            if args.skip_fetch:
+                seed(pool, farm, size)
+            else:
+                probe = Probe(redis_db, config)
+                poller = task.LoopingCall(probe.poll)
+                poller.start(0.05)
+                yield crawl(ProxyFetchSpider, config, redis_db)
+                poller.stop()
+                probe.report(size, 'fetch', 'scrapy', size)
+                vendors.stop()
+
+            probe = Probe(redis_db, config)
+            checked = pool.count()
+            if args.engine == 'asyncio':
+                yield threads.deferToThread(aiocheck.run_check, pool, load_validators(config), config, 'full')
+            else:
+                yield crawl(ProxyCheckSpider, config, redis_db)
+            probe.poll()
+            probe.report(size, 'check', args.engine, checked)
+        reactor.stop()
+
+    def failed(failure):
+        failure.printTraceback()
+        reactor.stop()
+
+    reactor.callWhenRunning(lambda: run_all().addErrback(failed))
+    reactor.run()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='100,1000,10000')
+    parser.add_argument('--engine', choices=['asyncio', 'scrapy'], default='asyncio', help='check engine')
+    parser.add_argument('--skip-fetch', action='store_true')
+    parser.add_argument('--ports', type=int, default=50, help='listening ports of the stub proxy farm')
+    parser.add_argument('--latency', type=float, default=0.05, help='mean stub proxy latency')
+    parser.add_argument('--failure-rate', type=float, default=0.2, help='share of stub proxy requests dropped')
+    parser.add_argument('--concurrency', type=int, default=2000, help='asyncio engine concurrency')
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    validator = StubValidator().start()
+    farm = StubProxyFarm(args.ports, args.latency, args.failure_rate, host='0.0.0.0', upstream=validator).start()
+    print(ROW % ('size', 'phase', 'engine', 'seconds', 'proxies/s', 'first(s)', 'pool', 'cmds/proxy', 'rtts/proxy'))
+    if args.skip_fetch and args.engine == 'asyncio':
+        run_asyncio_only(args, sizes, validator, farm)
+    else:
+        run_reactor(args, sizes, validator, farm)
+    farm.stop()
+    validator.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+''' In-process stand-in for the subset of StrictRedis (redis-py 2.10 API)
+used by hq-proxies, counting commands and round-trips
+
+Only good for benchmarks: no persistence, no pub/sub delivery, and a single
+lock instead of redis' single thread. The Lua scripts ProxyPool registers
+run as python equivalents.
+'''
+import time
+import random
+import threading
+
+from proxy_spider import pool
+
+def to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, float):
+        return repr(value).encode('utf-8')
+    return str(value).encode('utf-8')
+
+def to_score(value):
+    if value in ('-inf', b'-inf'):
+        return float('-inf')
+    if value in ('+inf', 'inf', b'+inf', b'inf'):
+        return float('inf')
+    return float(value)
+
+class FakeRedis(object):
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.lock = threading.RLock()
+        self.commands = 0
+        self.roundtrips = 0
+
+    def call(self, name, *args, **kwargs):
+        with self.lock:
+            self.commands += 1
+            return getattr(self, '_' + name)(*args, **kwargs)
+
+    def __getattr__(self, name):
+        if not hasattr(type(self), '_' + name):
+            raise AttributeError(name)
+        def command(*args, **kwargs):
+            with self.lock:
+                self.roundtrips += 1
+                return self.call(name, *args, **kwargs)
+        return command
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def register_script(self, script):
+        return FakeScript(self, SCRIPTS[script])
+
+    def pubsub(self, **kwargs):
+        raise NotImplementedError('FakeRedis does not deliver pub/sub messages')
+
+    def get_key(self, key, factory=None):
+        key = to_bytes(key)
+        expire = self.expires.get(key)
+        if expire is not None and expire <= time.time():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        if key not in self.data and factory is not None:
+            self.data[key] = factory()
+        return self.data.get(key)
+
+    # keys / strings
+    def _get(self, key):
+        return self.get_key(key)
+
+    def _set(self, key, value, ex=None, px=None, nx=False, xx=False):
+        exists = self.get_key(key) is not None
+        if (nx and exists) or (xx and not exists):
+            return None
+        key = to_bytes(key)
+        self.data[key] = to_bytes(value)
+        self.expires.pop(key, None)
+        if ex:
+            self.expires[key] = time.time() + ex
+        if px:
+            self.expires[key] = time.time() + px / 1000.0
+        return True
+
+    def _setex(self, key, seconds, value):
+        return self._set(key, value, ex=seconds)
+
+    def _getset(self, key, value):
+        old = self.get_key(key)
+        self._set(key, value)
+        return old
+
+    def _incr(self, key, amount=1):
+        value = int(self.get_key(key) or 0) + amount
+        self.data[to_bytes(key)] = to_bytes(value)
+        return value
+
+    def _ttl(self, key):
+        if self.get_key(key) is None:
+            return -2
+        expire = self.expires.get(to_bytes(key))
+        return -1 if expire is None else int(expire - time.time())
+
+    def _expire(self, key, seconds):
+        if self.get_key(key) is None:
+            return False
+        self.expires[to_bytes(key)] = time.time() + seconds
+        return True
+
+    def _pexpire(self, key, ms):
+        return self._expire(key, ms / 1000.0)
+
+    def _delete(self, *keys):
+        deleted = 0
+        for key in keys:
+            deleted += self.data.pop(to_bytes(key), None) is not None
+            self.expires.pop(to_bytes(key), None)
+        return deleted
+
+    def _exists(self, key):
+        return self.get_key(key) is not None
+
+    def _publish(self, channel, message):
+        return 0
+
+    # sets
+    def _sadd(self, key, *values):
+        s = self.get_key(key, set)
+        before = len(s)
+        s.update(to_bytes(v) for v in values)
+        return len(s) - before
+
+    def _srem(self, key, *values):
+        s = self.get_key(key, set)
+        before = len(s)
+        s.difference_update(to_bytes(v) for v in values)
+        return before - len(s)
+
+    def _sismember(self, key, value):
+        return to_bytes(value) in (self.get_key(key) or ())
+
+    def _scard(self, key):
+        return len(self.get_key(key) or ())
+
+    def _smembers(self, key):
+        return set(self.get_key(key) or ())
+
+    def _srandmember(self, key, number=None):
+        members = list(self.get_key(key) or ())
+        if number is None:
+            return random.choice(members) if members else None
+        return random.sample(members, min(number, len(members)))
+
+    # hashes
+    def _hset(self, key, field, value):
+        h = self.get_key(key, dict)
+        new = to_bytes(field) not in h
+        h[to_bytes(field)] = to_bytes(value)
+        return int(new)
+
+    def _hget(self, key, field):
+        return (self.get_key(key) or {}).get(to_bytes(field))
+
+    def _hmget(self, key, fields):
+        h = self.get_key(key) or {}
+        return [h.get(to_bytes(f)) for f in fields]
+
+    def _hmset(self, key, mapping):
+        h = self.get_key(key, dict)
+        h.update((to_bytes(f), to_bytes(v)) for f, v in mapping.items())
+        return True
+
+    def _hgetall(self, key):
+        return dict(self.get_key(key) or {})
+
+    def _hdel(self, key, *fields):
+        h = self.get_key(key, dict)
+        return sum(h.pop(to_bytes(f), None) is not None for f in fields)
+
+    def _hincrby(self, key, field, amount=1):
+        h = self.get_key(key, dict)
+        value = int(h.get(to_bytes(field), 0)) + amount
+        h[to_bytes(field)] = to_bytes(value)
+        return value
+
+    def _hlen(self, key):
+        return len(self.get_key(key) or {})
+
+    # sorted sets, StrictRedis argument order: score, member
+    def _zadd(self, key, *args):
+        z = self.get_key(key, dict)
+        added = 0
+        for i in range(0, len(args), 2):
+            member = to_bytes(args[i + 1])
+            added += member not in z
+            z[member] = float(args[i])
+        return added
+
+    def _zrem(self, key, *members):
+        z = self.get_key(key, dict)
+        return sum(z.pop(to_bytes(m), None) is not None for m in members)
+
+    def _zscore(self, key, member):
+        return (self.get_key(key) or {}).get(to_bytes(member))
+
+    def _zcard(self, key):
+        return len(self.get_key(key) or {})
+
+    def _zincrby(self, key, member, amount=1):
+        z = self.get_key(key, dict)
+        z[to_bytes(member)] = z.get(to_bytes(member), 0) + amount
+        return z[to_bytes(member)]
+
+    def sorted_items(self, key, reverse=False):
+        return sorted((self.get_key(key) or {}).items(), key=lambda i: (i[1], i[0]), reverse=reverse)
+
+    def slice(self, items, start, end, withscores):
+        end = len(items) if end == -1 else end + 1
+        items = items[start:end]
+        return items if withscores else [m for m, _ in items]
+
+    def _zrange(self, key, start, end, withscores=False):
+        return self.slice(self.sorted_items(key), start, end, withscores)
+
+    def _zrevrange(self, key, start, end, withscores=False):
+        return self.slice(self.sorted_items(key, True), start, end, withscores)
+
+    def _zrangebyscore(self, key, min, max, start=None, num=None, withscores=False):
+        items = [(m, s) for m, s in self.sorted_items(key) if to_score(min) <= s <= to_score(max)]
+        if start is not None:
+            items = items[start:start + num]
+        return items if withscores else [m for m, _ in items]
+
+    def _zrevrangebyscore(self, key, max, min, start=None, num=None, withscores=False):
+        items = [(m, s) for m, s in self.sorted_items(key, True) if to_score(min) <= s <= to_score(max)]
+        if start is not None:
+            items = items[start:start + num]
+        return items if withscores else [m for m, _ in items]
+
+    def _zinterstore(self, dest, keys, aggregate=None):
+        weights = keys if isinstance(keys, dict) else dict((key, 1) for key in keys)
+        zsets = [(self.get_key(key) or {}, weight) for key, weight in weights.items()]
+        members = set(zsets[0][0]).intersection(*[z for z, _ in zsets[1:]])
+        self.data[to_bytes(dest)] = dict((m, sum(z[m] * w for z, w in zsets)) for m in members)
+        self.expires.pop(to_bytes(dest), None)
+        return len(members)
+
+    def _zremrangebyscore(self, key, min, max):
+        z = self.get_key(key, dict)
+        drop = [m for m, s in z.items() if to_score(min) <= s <= to_score(max)]
+        for member in drop:
+            del z[member]
+        return len(drop)
+
+    # Lua scripts, keys/args as passed to the registered script
+    def _script_claim(self, keys, args):
+        now, limit, lease = float(args[0]), int(args[1]), float(args[2])
+        due = self._zrangebyscore(keys[0], '-inf', now, start=0, num=limit)
+        for proxy in due:
+            self._zadd(keys[0], lease, proxy)
+        return due
+
+    def _script_sync(self, keys, args):
+        members = self._smembers(keys[0])
+        for proxy in self._zrange(keys[1], 0, -1):
+            if proxy not in members:
+                self._zrem(keys[1], proxy)
+        for proxy in members:
+            if self._zscore(keys[1], proxy) is None:
+                self._zadd(keys[1], float(args[0]), proxy)
+
+    def _script_renew(self, keys, args):
+        if self._get(keys[0]) != to_bytes(args[0]):
+            return 0
+        return int(self._pexpire(keys[0], args[1]))
+
+    def _script_resign(self, keys, args):
+        if self._get(keys[0]) != to_bytes(args[0]):
+            return 0
+        return self._delete(keys[0])
+
+    def _script_lease(self, keys, args):
+        now, expires, lease_id = float(args[0]), float(args[1]), args[2]
+        max_concurrency, max_rps, ttl = float(args[3]), float(args[4]), int(args[5])
+        best = best_load = None
+        for i in range(0, len(keys), 2):
+            self._zremrangebyscore(keys[i], '-inf', now)
+            load = self._zcard(keys[i])
+            rate = int(self._get(keys[i + 1]) or 0)
+            if load < max_concurrency and rate < max_rps and (best is None or load < best_load):
+                best, best_load = i, load
+        if best is None:
+            return 0
+        self._zadd(keys[best], expires, lease_id)
+        self._expire(keys[best], ttl)
+        self._incr(keys[best + 1])
+        self._expire(keys[best + 1], 2)
+        return best // 2 + 1
+
+SCRIPTS = {
+    pool.CLAIM_SCRIPT: 'script_claim',
+    pool.SYNC_SCRIPT: 'script_sync',
+    pool.RENEW_SCRIPT: 'script_renew',
+    pool.RESIGN_SCRIPT: 'script_resign',
+    pool.LEASE_SCRIPT: 'script_lease',
+}
+
+class FakeScript(object):
+    def __init__(self, redis_db, name):
+        self.redis_db = redis_db
+        self.name = name
+
+    def __call__(self, keys=[], args=[]):
+        return getattr(self.redis_db, self.name)(keys, args)
+
+class FakePipeline(object):
+    ''' Queues commands and runs them under one lock, counting one round-trip
+    '''
+    def __init__(self, redis_db):
+        self.redis_db = redis_db
+        self.queued = []
+
+    def __getattr__(self, name):
+        if not hasattr(FakeRedis, '_' + name):
+            raise AttributeError(name)
+        def queue(*args, **kwargs):
+            self.queued.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        queued, self.queued = self.queued, []
+        with self.redis_db.lock:
+            self.redis_db.roundtrips += 1
+            return [self.redis_db.call(name, *args, **kwargs) for name, args, kwargs in queued]
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+''' Local stand-ins for everything hq-proxies talks to over the network
+
+Each stub serves from its own event loop in a background thread so that
+both the asyncio engine and scrapy/twisted can hit it.
+'''
+import random
+import socket
+import asyncio
+import threading
+from urllib.parse import urlsplit
+
+STARTSTRING = 'hello world! :)'
+VALIDATOR_URL = 'http://validator.bench/text/helloworld.txt'
+
+async def read_request(reader, prefix=b''):
+    ''' Request line and headers, None on EOF. `prefix` is what the caller
+    already read of the request line
+    '''
+    line = prefix + await reader.readline()
+    if not line:
+        return None
+    headers = {}
+    while True:
+        h = await reader.readline()
+        if not h or h in (b'\r\n', b'\n'):
+            break
+        name, _, value = h.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return line.decode('latin-1').split(), headers
+
+def response(body, status='200 OK', content_type='text/plain; charset=utf-8'):
+    body = body.encode('utf-8')
+    return ('HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n'
+        % (status, content_type, len(body))).encode('latin-1') + body
+
+class StubServer(object):
+
+    def __init__(self, host='127.0.0.1'):
+        self.host = host
+        self.loop = None
+        self.thread = None
+
+    async def serve(self):
+        raise NotImplementedError
+
+    def start(self):
+        started = threading.Event()
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(self.serve())
+            started.set()
+            self.loop.run_forever()
+            # connections still open when stopped
+            all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+            pending = [t for t in all_tasks(self.loop) if not t.done()]
+            for t in pending:
+                t.cancel()
+            self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            self.loop.close()
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+class StubValidator(StubServer):
+    ''' Serves the helloworld page every PROXY_VALIDATORS entry points at
+    '''
+    def __init__(self, host='127.0.0.1'):
+        super(StubValidator, self).__init__(host)
+        self.port = None
+
+    @property
+    def url(self):
+        return 'http://%s:%s/text/helloworld.txt' % (self.host, self.port)
+
+    async def handle(self, reader, writer):
+        try:
+            if await read_request(reader) is not None:
+                writer.write(response(STARTSTRING))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle, self.host, 0, backlog=1024)
+        self.port = server.sockets[0].getsockname()[1]
+
+async def relay(reader, writer):
+    try:
+        while True:
+            chunk = await reader.read(65536)
+            if not chunk:
+                break
+            writer.write(chunk)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+class StubProxyFarm(StubServer):
+    ''' A bunch of fake proxies
+
+    Every proxy waits `latency` seconds (+-50%), drops the connection with
+    probability `failure_rate`, and otherwise forwards GETs for `upstream`
+    (a StubValidator) or, without one, answers with the validator page
+    itself. CONNECT and socks5 (no auth) tunnels to `upstream` work on the
+    same ports. Listening on 0.0.0.0 lets any 127.x.y.z address reach the
+    farm, which is how address() hands out many distinct proxies on few ports.
+    '''
+    def __init__(self, ports=20, latency=0.05, failure_rate=0.0, host='127.0.0.1', upstream=None):
+        super(StubProxyFarm, self).__init__(host)
+        self.nports = ports
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.upstream = upstream
+        self.ports = []
+
+    @property
+    def proxies(self):
+        return ['http://%s:%s' % (self.host, port) for port in self.ports]
+
+    def address(self, i, scheme='http'):
+        ''' The i-th distinct proxy, spread over 127.0.0.0/8 when listening on 0.0.0.0
+        '''
+        port = self.ports[i % len(self.ports)]
+        if self.host != '0.0.0.0':
+            return '%s://%s:%s' % (scheme, self.host, port)
+        n = i // len(self.ports) + 1
+        return '%s://127.%s.%s.%s:%s' % (scheme, (n >> 16) & 255, (n >> 8) & 255, n & 255, port)
+
+    def upstream_netloc(self):
+        return '%s:%s' % (self.upstream.host, self.upstream.port)
+
+    async def tunnel(self, reader, writer):
+        up_reader, up_writer = await asyncio.open_connection(self.upstream.host, self.upstream.port)
+        await asyncio.gather(relay(reader, up_writer), relay(up_reader, writer))
+
+    async def socks5(self, reader, writer):
+        nmethods = (await reader.readexactly(2))[1]
+        await reader.readexactly(nmethods)
+        writer.write(b'\x05\x00')
+        request = await reader.readexactly(4)
+        if request[3] == 3:
+            host = (await reader.readexactly((await reader.readexactly(1))[0])).decode('idna')
+        else:
+            host = socket.inet_ntop(socket.AF_INET6 if request[3] == 4 else socket.AF_INET,
+                await reader.readexactly(16 if request[3] == 4 else 4))
+        port = int.from_bytes(await reader.readexactly(2), 'big')
+        await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        if random.random() < self.failure_rate:
+            return
+        if self.upstream is None or '%s:%s' % (host, port) != self.upstream_netloc():
+            writer.write(b'\x05\x02\x00\x01\x00\x00\x00\x00\x00\x00')
+            return
+        writer.write(b'\x05\x00\x00\x01\x7f\x00\x00\x01\x00\x00')
+        await self.tunnel(reader, writer)
+
+    async def handle(self, reader, writer):
+        try:
+            first = await reader.readexactly(1)
+            if first == b'\x05':
+                await self.socks5(reader, writer)
+                return
+            request = await read_request(reader, first)
+            if request is None:
+                return
+            (method, target, version), headers = request
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+            if random.random() < self.failure_rate:
+                return
+            if method == 'CONNECT':
+                if self.upstream is None or target != self.upstream_netloc():
+                    writer.write(response('', '403 Forbidden'))
+                else:
+                    writer.write(b'HTTP/1.1 200 Connection Established\r\n\r\n')
+                    await self.tunnel(reader, writer)
+                    return
+            elif self.upstream is None:
+                writer.write(response(STARTSTRING))
+            elif urlsplit(target).netloc != self.upstream_netloc():
+                writer.write(response('', '403 Forbidden'))
+            else:
+                up_reader, up_writer = await asyncio.open_connection(self.upstream.host, self.upstream.port)
+                path = urlsplit(target).path or '/'
+                up_writer.write(('%s %s HTTP/1.1\r\nHost: %s\r\nConnection: close\r\n\r\n'
+                    % (method, path, urlsplit(target).netloc)).encode('latin-1'))
+                writer.write(await up_reader.read())
+                up_writer.close()
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        for _ in range(self.nports):
+            server = await asyncio.start_server(self.handle, self.host, 0, backlog=1024)
+            self.ports.append(server.sockets[0].getsockname()[1])
+
+class StubVendors(StubServer):
+    ''' Free proxy listing sites in the formats the built-in parsers expect
+
+    `proxies` are split evenly over xici, 66ip, ip181 and the 3 kxdaili pages.
+    '''
+    KX_PAGES = 3
+
+    def __init__(self, proxies, host='127.0.0.1'):
+        super(StubVendors, self).__init__(host)
+        self.port = None
+        self.pages = self.render(proxies)
+
+    def render(self, proxies):
+        addrs = [urlsplit(p).netloc.split(':') for p in proxies]
+        shares = [addrs[i::3 + self.KX_PAGES] for i in range(3 + self.KX_PAGES)]
+        pages = {}
+        pages['/nn/'] = '<table id="ip_list"><tr><th>IP</th></tr>%s</table>' % ''.join(
+            '<tr><td class="country"><img alt="Cn" /></td><td>%s</td><td>%s</td><td>bench</td><td>高匿</td><td>1天</td><td>HTTP</td>'
+            '<td><div class="bar" title="0.%03d秒"></div></td></tr>' % (ip, port, random.randint(1, 999))
+            for ip, port in shares[0])
+        pages['/nmtq.php'] = '<br />'.join('%s:%s' % (ip, port) for ip, port in shares[1])
+        pages['/ip181/'] = '<table><tbody>%s</tbody></table>' % ''.join(
+            '<tr><td>%s</td><td>%s</td><td>高匿</td><td>HTTP</td></tr>' % (ip, port) for ip, port in shares[2])
+        for page in range(1, self.KX_PAGES + 1):
+            pages['/dailiip/1/%s.html' % page] = '<table class="ui table segment"><tbody>%s</tbody></table>' % ''.join(
+                '<tr><td>%s</td><td>%s</td><td>高匿</td></tr>' % (ip, port) for ip, port in shares[2 + page])
+        return pages
+
+    def vendors(self):
+        base = 'http://%s:%s' % (self.host, self.port)
+        return [
+            {'parser': 'parse_xici', 'url': base + '/nn/'},
+            {'parser': 'parse_kxdaili', 'url': base + '/dailiip/1/%s.html#ip', 'pages': self.KX_PAGES},
+            {'parser': 'parse_ip181', 'url': base + '/ip181/'},
+            {'parser': 'parse_66ip', 'url': base + '/nmtq.php?getnum=100'},
+        ]
+
+    async def handle(self, reader, writer):
+        try:
+            request = await read_request(reader)
+            if request is not None:
+                path = urlsplit(request[0][1]).path
+                if path in self.pages:
+                    writer.write(response(self.pages[path], content_type='text/html; charset=utf-8'))
+                else:
+                    writer.write(response('', '404 Not Found'))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle, self.host, 0, backlog=1024)
+        self.port = server.sockets[0].getsockname()[1]
@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+
+import ssl
+import time
+import errno
+import socket
+import asyncio
+import logging
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+from proxy_spider.pool import base_capability
+from proxy_spider.validators import ValidatorPool
+from proxy_spider import echo
+
+try:
+    import resource
+except ImportError:
+    # Windows上没有resource模块，不限制
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/53.0.2785.116 Safari/537.36'
+
+# connect/first_byte/total are seconds, None when the check didn't get that far
+# capabilities are the ones the proxy passed, see pool.CAPABILITIES
+# anonymity is only known for checks against echo validators
+# errors starting with "local" are our own host out of sockets, see inconclusive()
+CheckResult = namedtuple('CheckResult', 'proxy validator valid latency connect first_byte error capabilities anonymity')
+# echo响应整个读完再分类，限制一下大小
+ECHO_MAX_BODY = 65536
+# 本机的文件描述符、端口或者缓冲区用完了，建连接失败说明不了代理的好坏
+LOCAL_ERRNOS = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.EADDRNOTAVAIL)
+# 留给redis连接、日志、监听端口等的文件描述符
+FD_HEADROOM = 100
+
+class TunnelError(ConnectionError):
+    pass
+
+def local_error(e):
+    ''' Whether a connect error is our own host running out of sockets,
+    for OSErrors and Twisted's ConnectErrors alike
+    '''
+    return getattr(e, 'errno', None) in LOCAL_ERRNOS or getattr(e, 'osError', None) in LOCAL_ERRNOS
+
+def fit_fds(*concurrency):
+    ''' Scale concurrency limits down so that together they fit in the
+    open file limit, one socket each
+    '''
+    if resource is None:
+        return list(concurrency)
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY or sum(concurrency) <= soft - FD_HEADROOM:
+        return list(concurrency)
+    budget = max(soft - FD_HEADROOM, len(concurrency))
+    fitted = [max(1, c * budget // sum(concurrency)) for c in concurrency]
+    logger.warning('打开文件数上限为%s，并发数从%s降到%s' % (soft, list(concurrency), fitted))
+    return fitted
+
+def inconclusive(result):
+    ''' Whether a check failed on our side and says nothing about the proxy
+    '''
+    return bool(result.error) and result.error.startswith('local ')
+
+_ssl_context = None
+
+def ssl_context():
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context()
+    return _ssl_context
+
+class Timeouts(object):
+    def __init__(self, connect=1.5, first_byte=3, total=3):
+        self.connect = connect
+        self.first_byte = first_byte
+        self.total = total
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            connect=config.get('CHECK_CONNECT_TIMEOUT', 1.5),
+            first_byte=config.get('CHECK_FIRST_BYTE_TIMEOUT', 3),
+            total=config.get('CHECK_TOTAL_TIMEOUT', 3)
+        )
+
+async def read_response(reader, status, length):
+    ''' Read headers and up to `length` bytes of body, None unless 200
+    '''
+    parts = status.split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith(b'HTTP/') or parts[1] != b'200':
+        return None
+    chunked = False
+    while True:
+        line = await reader.readline()
+        if not line:
+            return None
+        if line in (b'\r\n', b'\n'):
+            break
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'transfer-encoding' and b'chunked' in value.lower():
+            chunked = True
+    if chunked:
+        body = b''
+        while len(body) < length:
+            size = int((await reader.readline()).split(b';')[0].strip() or b'0', 16)
+            if not size:
+                break
+            body += await reader.readexactly(size)
+            await reader.readline()
+    else:
+        try:
+            body = await reader.readexactly(length)
+        except asyncio.IncompleteReadError as e:
+            body = e.partial
+    return body
+
+async def open_socket(loop, proxy):
+    ''' Non-blocking socket connected to the proxy itself
+    '''
+    target = urlsplit(proxy)
+    default_port = 1080 if base_capability(proxy) == 'socks5' else 80
+    infos = await loop.getaddrinfo(target.hostname, target.port or default_port, type=socket.SOCK_STREAM)
+    family, type_, proto, _, addr = infos[0]
+    sock = socket.socket(family, type_, proto)
+    sock.setblocking(False)
+    try:
+        await loop.sock_connect(sock, addr)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+async def tcp_probe(proxy, timeout):
+    ''' None if the proxy accepts a TCP connection within `timeout`, else
+    the reason it didn't, "local ..." when that's our side
+    '''
+    loop = asyncio.get_event_loop()
+    try:
+        sock = await asyncio.wait_for(open_socket(loop, proxy), timeout)
+    except asyncio.TimeoutError:
+        return 'tcp timeout'
+    except (OSError, ValueError) as e:
+        if local_error(e):
+            return 'local %s' % errno.errorcode[e.errno]
+        return 'tcp %s' % e.__class__.__name__
+    sock.close()
+    return None
+
+async def recv_exactly(loop, sock, n):
+    data = b''
+    while len(data) < n:
+        chunk = await loop.sock_recv(sock, n - len(data))
+        if not chunk:
+            raise TunnelError('EOF from proxy')
+        data += chunk
+    return data
+
+async def http_tunnel(loop, sock, host, port):
+    ''' CONNECT host:port through an http proxy
+    '''
+    await loop.sock_sendall(sock, (
+        'CONNECT %s:%s HTTP/1.1\r\n'
+        'Host: %s:%s\r\n'
+        'User-Agent: %s\r\n\r\n' % (host, port, host, port, USER_AGENT)
+    ).encode('latin-1'))
+    # 对方在我们发数据之前不会往隧道里写东西，整块读不会吃掉隧道里的数据
+    head = b''
+    while b'\r\n\r\n' not in head:
+        chunk = await loop.sock_recv(sock, 4096)
+        if not chunk or len(head) > 8192:
+            raise TunnelError('bad CONNECT response')
+        head += chunk
+    parts = head.split(None, 2)
+    if len(parts) < 2 or parts[1] != b'200':
+        raise TunnelError('CONNECT refused')
+
+async def socks5_tunnel(loop, sock, host, port):
+    ''' Open a connection to host:port through a socks5 proxy, no auth
+    '''
+    await loop.sock_sendall(sock, b'\x05\x01\x00')
+    if await recv_exactly(loop, sock, 2) != b'\x05\x00':
+        raise TunnelError('socks5 handshake refused')
+    name = host.encode('idna')
+    await loop.sock_sendall(sock, b'\x05\x01\x00\x03' + bytes([len(name)]) + name + port.to_bytes(2, 'big'))
+    reply = await recv_exactly(loop, sock, 4)
+    if reply[0] != 5 or reply[1] != 0:
+        raise TunnelError('socks5 connect failed')
+    if reply[3] == 3:
+        skip = (await recv_exactly(loop, sock, 1))[0]
+    else:
+        skip = 16 if reply[3] == 4 else 4
+    await recv_exactly(loop, sock, skip + 2)
+
+async def check_proxy(proxy, validator, timeouts, capability=None, own_ips=None):
+    ''' Fetch a validator page through a proxy with a raw request, timing
+    connect, first byte and the whole exchange separately
+
+    Capability http sends the request to the proxy as is, https tunnels it
+    through CONNECT and socks5 through a socks5 handshake, TLS is spoken
+    whenever the validator url is https. Defaults to the proxy's base
+    capability. Passing `own_ips` makes it an echo validator check that
+    also classifies the proxy's anonymity.
+    '''
+    capability = capability or base_capability(proxy)
+    url, startstring = validator
+    loop = asyncio.get_event_loop()
+    started = loop.time()
+    remaining = lambda: timeouts.total - (loop.time() - started)
+    connect = first_byte = None
+    sock = writer = None
+    try:
+        target = urlsplit(url)
+        tls = target.scheme == 'https'
+        port = target.port or (443 if tls else 80)
+        sock = await asyncio.wait_for(open_socket(loop, proxy), timeouts.connect)
+        connect = loop.time() - started
+        if capability == 'https':
+            await asyncio.wait_for(http_tunnel(loop, sock, target.hostname, port), remaining())
+        elif capability == 'socks5':
+            await asyncio.wait_for(socks5_tunnel(loop, sock, target.hostname, port), remaining())
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(
+            sock=sock, ssl=ssl_context() if tls else None,
+            server_hostname=target.hostname if tls else None), remaining())
+        sock = None
+        if capability == 'http':
+            path = url
+        else:
+            path = (target.path or '/') + ('?' + target.query if target.query else '')
+        writer.write((
+            'GET %s HTTP/1.1\r\n'
+            'Host: %s\r\n'
+            'User-Agent: %s\r\n'
+            'Accept: */*\r\n'
+            'Connection: close\r\n\r\n' % (path, target.netloc, USER_AGENT)
+        ).encode('latin-1'))
+        status = await asyncio.wait_for(reader.readline(), min(timeouts.first_byte, remaining()))
+        first_byte = loop.time() - started
+        expected = startstring.encode('utf-8')
+        length = ECHO_MAX_BODY if own_ips is not None else len(expected)
+        body = await asyncio.wait_for(read_response(reader, status, length), remaining())
+        valid = body is not None and body.startswith(expected)
+        latency = loop.time() - started
+        anonymity = None
+        if valid and own_ips is not None:
+            anonymity = echo.classify(body.decode('utf-8', 'replace'), own_ips)
+        return CheckResult(proxy, url, valid, latency if valid else None, connect, first_byte,
+            None if valid else 'bad response', (capability,) if valid else (), anonymity)
+    except asyncio.TimeoutError:
+        return CheckResult(proxy, url, False, None, connect, first_byte, 'timeout', (), None)
+    except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+        if connect is None and local_error(e):
+            return CheckResult(proxy, url, False, None, None, None, 'local %s' % errno.errorcode[e.errno], (), None)
+        return CheckResult(proxy, url, False, None, connect, first_byte, e.__class__.__name__, (), None)
+    finally:
+        if writer is not None:
+            writer.close()
+        elif sock is not None:
+            sock.close()
+
+async def acquire(validators, capability, exclude=(), wait=5):
+    ''' Wait for a validator of `capability` with room under its caps,
+    None if there is none to wait for. After `wait` seconds one is picked
+    over its caps, so counts gone stale can never stall the checks
+    '''
+    deadline = time.time() + wait
+    while True:
+        validator = validators.pick(capability, exclude, strict=time.time() < deadline)
+        if validator is not None or not validators.available(capability, exclude):
+            return validator
+        await asyncio.sleep(0.01)
+
+async def check_proxies(proxies, validators, timeouts=None, concurrency=500, per_host=200,
+        echo_validators=None, own_ips=None, precheck=None, precheck_concurrency=500, quorum=1):
+    ''' Validate `proxies` against `validators`, a ValidatorPool or
+    (url, startstring) pairs
+
+    Every proxy is checked for its base capability, http proxies that pass
+    are then checked for https if an https validator is configured. Returns
+    one CheckResult per proxy with the base check's timings. With
+    `echo_validators`, base checks go to those instead and classify
+    anonymity, `own_ips` being our egress ips (see echo.own_ips).
+
+    `concurrency` bounds the proxies in flight overall, within the open
+    file limit. Validators are
+    picked by the pool's weighted round-robin within their rate and
+    concurrency caps, `per_host` being the cap of validators given as pairs.
+    A base check failing once the proxy was reached is retried on other
+    validators until it failed on `quorum` different ones.
+
+    A `precheck` timeout first probes every proxy with a bare TCP connect,
+    up to `precheck_concurrency` at once (also within the open file limit),
+    and only proxies that answer go on to the validators, so dead hosts
+    never hold a check slot.
+    '''
+    timeouts = timeouts or Timeouts()
+    validators = ValidatorPool.wrap(validators, per_host)
+    echo_validators = ValidatorPool.wrap(echo_validators, per_host) or None
+    pools = {'http': echo_validators or validators, 'socks5': echo_validators or validators, 'https': validators}
+    if precheck:
+        concurrency, precheck_concurrency = fit_fds(concurrency, precheck_concurrency)
+    else:
+        concurrency, = fit_fds(concurrency)
+    total = asyncio.Semaphore(concurrency)
+    probes = asyncio.Semaphore(precheck_concurrency)
+
+    async def checked(proxy, capability, exclude=()):
+        validator = await acquire(pools[capability], capability, exclude)
+        if validator is None:
+            return CheckResult(proxy, None, False, None, None, None, 'no validator', (), None)
+        ips = (own_ips or set()) if echo_validators and capability != 'https' else None
+        result = None
+        try:
+            result = await check_proxy(proxy, validator.pair, timeouts, capability, ips)
+        finally:
+            # 连不上代理本身说明不了验证页的好坏
+            pools[capability].release(validator.url,
+                None if result is None or result.connect is None else result.valid)
+        return result
+
+    async def bounded(proxy):
+        if precheck:
+            async with probes:
+                error = await tcp_probe(proxy, precheck)
+            if error:
+                return CheckResult(proxy, None, False, None, None, None, error, (), None)
+        async with total:
+            capability = base_capability(proxy)
+            result = await checked(proxy, capability)
+            tried = [result.validator]
+            while (not result.valid and result.connect is not None and len(tried) < quorum
+                    and pools[capability].available(capability, tried)):
+                result = await checked(proxy, capability, tried)
+                tried.append(result.validator)
+            if result.valid and result.capabilities == ('http',) and pools['https'].available('https'):
+                https = await checked(proxy, 'https')
+                if https.valid:
+                    result = result._replace(capabilities=('http', 'https'))
+                elif inconclusive(https):
+                    # 不知道能不能建隧道，先不写入，免得把https能力清掉
+                    return https
+            return result
+
+    return await asyncio.gather(*[bounded(proxy) for proxy in proxies])
+
+def check_and_apply(pool, proxies, validator_pool, config, source='check'):
+    ''' Validate `proxies` on a private event loop and write the results
+    through ProxyPool.apply, blocking, meant for a worker thread
+    '''
+    echo_validators = getattr(validator_pool, 'echo', None)
+    own_ips = echo.own_ips(echo_validators, config.get('ECHO_OWN_IPS') or []) if echo_validators else None
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        results = loop.run_until_complete(check_proxies(
+            proxies, validator_pool,
+            timeouts=Timeouts.from_config(config),
+            concurrency=config.get('CHECK_CONCURRENCY', 500),
+            per_host=config.get('CHECK_PER_VALIDATOR', 200),
+            echo_validators=echo_validators,
+            own_ips=own_ips,
+            # 新抓来的代理大多已经失效，先用TCP连接筛一遍
+            precheck=config.get('PRECHECK_TIMEOUT', 1) if source == 'fetch' else None,
+            precheck_concurrency=config.get('PRECHECK_CONCURRENCY', 500),
+            # 池内代理要在几个验证页上都失败才踢出去
+            quorum=config.get('VALIDATOR_QUORUM', 2) if source == 'check' else 1
+        ))
+    finally:
+        loop.close()
+    dropped = sum(1 for r in results if r.error and r.error.startswith('tcp '))
+    if dropped:
+        logger.info('TCP预检淘汰%s/%s个代理' % (dropped, len(results)))
+    # 本机资源不够导致的失败不记到代理头上，这些代理之后再验证
+    conclusive = [r for r in results if not inconclusive(r)]
+    if len(conclusive) < len(results):
+        logger.warning('本机文件描述符或端口不够，%s/%s个代理没有验证成，不计入结果' % (
+            len(results) - len(conclusive), len(results)))
+    batch = config.get('CHECK_WRITE_BATCH', 1000)
+    for i in range(0, len(conclusive), batch):
+        pool.apply([
+            {'proxy': r.proxy, 'valid': r.valid, 'latency': r.latency, 'source': source,
+                'validator': r.validator, 'capabilities': r.capabilities, 'anonymity': r.anonymity}
+            for r in conclusive[i:i + batch]
+        ])
+    return results
+
+def run_check(pool, validator_pool, config, mode='full'):
+    ''' Blocking drop-in for a proxy_check run, meant for a worker thread
+
+    Picks proxies the same way ProxyCheckSpider does, validates them on a
+    private event loop and writes the results through ProxyPool.apply.
+    '''
+    pool.redis_db.set(pool.PROXY_COUNT, pool.count())
+    if mode == 'rolling':
+        pool.sync_schedule()
+        proxies = pool.claim_due()
+    else:
+        proxies = pool.members()
+    proxies += pool.claim_quarantined()
+    logger.info('asyncio引擎开始验证%s个代理...' % len(proxies))
+    started = time.time()
+    results = check_and_apply(pool, proxies, validator_pool, config)
+    pcount = pool.count()
+    pool.redis_db.set(pool.PROXY_COUNT, pcount)
+    logger.info('代理池测试完成，验证%s个代理用时%.1f秒，有效代理数: %s，隔离区代理数: %s' % (
+        len(proxies), time.time() - started, pcount, pool.quarantined()))
+    return results
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+''' Echo validator: tells transparent, anonymous and elite proxies apart
+
+The echo server answers every request with the origin address and the
+headers it received, as seen on our side of the proxy. Run it somewhere the
+proxies can reach and list it under ECHO_VALIDATORS, the checks then use it
+instead of the plain http validators and classify each proxy:
+
+    transparent: our own ip shows up (origin or X-Forwarded-For and the like)
+    anonymous:   our ip is hidden but the proxy announces itself (Via, ...)
+    elite:       looks like a direct request
+
+    python -m proxy_spider.echo [--host 0.0.0.0] [--port 8090]
+'''
+import re
+import time
+import asyncio
+import argparse
+import logging
+from urllib.request import urlopen
+
+logger = logging.getLogger(__name__)
+
+ECHO_STARTSTRING = 'hq-proxies echo'
+# 会带出客户端ip的头
+FORWARD_HEADERS = ('x-forwarded-for', 'x-real-ip', 'forwarded', 'client-ip', 'x-client-ip',
+    'x-originating-ip', 'true-client-ip', 'x-cluster-client-ip')
+# 暴露自己是代理的头
+PROXY_HEADERS = FORWARD_HEADERS + ('via', 'proxy-connection', 'x-proxy-id', 'x-bluecoat-via',
+    'proxy-agent', 'x-forwarded-host', 'x-forwarded-proto')
+# ipv4，或者至少两个冒号的ipv6；"1.2.3.4:3128"里的端口不算ip
+IP_RE = re.compile(r'(?<![\w.])\d{1,3}(?:\.\d{1,3}){3}(?![\w.])'
+    r'|(?<![\w:.])(?:[0-9a-fA-F]{0,4}:){2,7}[0-9a-fA-F]{0,4}(?![\w:.])')
+
+def render(origin, headers):
+    lines = [ECHO_STARTSTRING, 'origin: %s' % origin]
+    lines.extend('%s: %s' % (name, value) for name, value in headers)
+    return '\n'.join(lines) + '\n'
+
+def parse(body):
+    ''' (origin, {lowercased header: value}) of an echo body, None if the
+    body didn't come from an echo server
+    '''
+    lines = body.splitlines()
+    if len(lines) < 2 or lines[0] != ECHO_STARTSTRING or not lines[1].startswith('origin: '):
+        return None
+    headers = {}
+    for line in lines[2:]:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return lines[1][len('origin: '):].strip(), headers
+
+def classify(body, own_ips):
+    ''' Anonymity level of the proxy an echo body came through, None for
+    other validators
+
+    Without known own ips, any forwarded ip other than the origin counts as
+    a leak.
+    '''
+    echo = parse(body)
+    if echo is None:
+        return None
+    origin, headers = echo
+    forwarded = set()
+    for name in FORWARD_HEADERS:
+        forwarded.update(IP_RE.findall(headers.get(name, '')))
+    if own_ips:
+        leaked = origin in own_ips or forwarded & set(own_ips)
+    else:
+        leaked = forwarded - {origin}
+    if leaked:
+        return 'transparent'
+    if any(name in headers for name in PROXY_HEADERS):
+        return 'anonymous'
+    return 'elite'
+
+_own_ips = {'ips': set(), 'at': 0}
+
+def own_ips(echo_validators, extra=(), ttl=600):
+    ''' Our own egress ips, asked directly from the echo validators and
+    cached for `ttl` seconds, plus the ones configured in ECHO_OWN_IPS
+    '''
+    if time.time() - _own_ips['at'] > ttl:
+        ips = set()
+        for url, _ in echo_validators:
+            try:
+                with urlopen(url, timeout=5) as response:
+                    echo = parse(response.read().decode('utf-8', 'replace'))
+            except (OSError, ValueError) as e:
+                logger.warning('访问echo验证页失败 %s: %r' % (url, e))
+                continue
+            if echo is not None:
+                ips.add(echo[0])
+        _own_ips['ips'] = ips
+        _own_ips['at'] = time.time()
+        logger.info('本机出口ip: %s' % ', '.join(sorted(ips | set(extra))))
+    return _own_ips['ips'] | set(extra)
+
+async def handle(reader, writer):
+    try:
+        line = await reader.readline()
+        if not line:
+            return
+        headers = []
+        while True:
+            h = await reader.readline()
+            if not h or h in (b'\r\n', b'\n'):
+                break
+            name, _, value = h.decode('latin-1').partition(':')
+            headers.append((name.strip(), value.strip()))
+        origin = writer.get_extra_info('peername')[0]
+        body = render(origin, headers).encode('utf-8')
+        writer.write((
+            'HTTP/1.1 200 OK\r\n'
+            'Content-Type: text/plain; charset=utf-8\r\n'
+            'Content-Length: %d\r\n'
+            'Cache-Control: no-store\r\n'
+            'Connection: close\r\n\r\n' % len(body)
+        ).encode('latin-1') + body)
+        await writer.drain()
+    except (ConnectionError, OSError) as e:
+        logger.debug('echo连接异常: %r' % e)
+    finally:
+        writer.close()
+
+async def start(host='0.0.0.0', port=8090):
+    server = await asyncio.start_server(handle, host, port, backlog=1024)
+    logger.info('echo验证页已启动 %s:%s' % (host, port))
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description='hq-proxies echo validator')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8090)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelno)s/%(lineno)d: %(message)s')
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(start(args.host, args.port))
+    loop.run_forever()
+
+if __name__ == '__main__':
+    main()
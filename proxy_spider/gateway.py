@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+''' A local forwarding proxy in front of the pool
+
+Clients point at the gateway once (http and https via CONNECT), the gateway
+picks an upstream proxy per request from an in-memory snapshot of the best
+scored proxies (CONNECT tunnels only from proxies that passed the https
+check, if one is configured), retries failed upstreams on another proxy and reports the
+failures back to the pool.
+
+    python -m proxy_spider.gateway [--mode test] [--port 8899]
+'''
+import asyncio
+import argparse
+import logging
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+from proxy_spider.utils import load_config, connect_redis
+from proxy_spider.pool import ProxyPool, weighted_sample
+
+logger = logging.getLogger(__name__)
+
+HOP_HEADERS = {b'connection', b'proxy-connection', b'keep-alive', b'proxy-authorization',
+    b'proxy-authenticate', b'te', b'trailer', b'upgrade'}
+# 上游代理自己返回的这些状态码多半是代理坏了，换一个代理重试
+RETRY_STATUS = {502, 503, 504}
+
+class UpstreamError(Exception):
+    pass
+
+def header(headers, name):
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+
+async def read_head(reader):
+    ''' Read a request/status line and its headers, None on a clean EOF
+    '''
+    line = await reader.readline()
+    if not line:
+        return None
+    headers = []
+    while True:
+        h = await reader.readline()
+        if not h:
+            raise ConnectionError('EOF in headers')
+        if h in (b'\r\n', b'\n'):
+            break
+        name, _, value = h.partition(b':')
+        headers.append((name.strip(), value.strip()))
+    return line.rstrip(b'\r\n'), headers
+
+def framed(headers):
+    te = header(headers, b'transfer-encoding')
+    return (te is not None and b'chunked' in te.lower()) or header(headers, b'content-length') is not None
+
+async def relay_body(reader, writer, headers):
+    ''' Copy a chunked or Content-Length body, or everything up to EOF if the
+    message isn't framed
+    '''
+    te = header(headers, b'transfer-encoding')
+    if te is not None and b'chunked' in te.lower():
+        while True:
+            line = await reader.readline()
+            writer.write(line)
+            size = int(line.split(b';')[0].strip() or b'0', 16)
+            if not size:
+                while True:
+                    trailer = await reader.readline()
+                    writer.write(trailer)
+                    if trailer in (b'\r\n', b'\n', b''):
+                        break
+                break
+            writer.write(await reader.readexactly(size + 2))
+            await writer.drain()
+    elif header(headers, b'content-length') is not None:
+        remaining = int(header(headers, b'content-length'))
+        while remaining:
+            chunk = await reader.read(min(65536, remaining))
+            if not chunk:
+                raise ConnectionError('EOF in body')
+            writer.write(chunk)
+            remaining -= len(chunk)
+            await writer.drain()
+    else:
+        while True:
+            chunk = await reader.read(65536)
+            if not chunk:
+                break
+            writer.write(chunk)
+            await writer.drain()
+    await writer.drain()
+
+async def read_body(reader, headers):
+    ''' Buffer a request body so that it can be replayed on another upstream
+    '''
+    if not framed(headers):
+        return b''
+    buf = BufferWriter()
+    await relay_body(reader, buf, headers)
+    return bytes(buf.data)
+
+class BufferWriter(object):
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+def serialize(line, headers, extra=()):
+    out = [line]
+    for name, value in headers:
+        if name.lower() not in HOP_HEADERS:
+            out.append(name + b': ' + value)
+    out.extend(extra)
+    return b'\r\n'.join(out) + b'\r\n\r\n'
+
+async def pipe(reader, writer):
+    try:
+        while True:
+            chunk = await reader.read(65536)
+            if not chunk:
+                break
+            writer.write(chunk)
+            await writer.drain()
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        writer.close()
+
+class ProxyGateway(object):
+
+    def __init__(self, pool, snapshot_size=500, refresh_interval=5, retries=2, timeout=5, max_idle=4, anonymity=None):
+        self.pool = pool
+        self.snapshot_size = snapshot_size
+        self.refresh_interval = refresh_interval
+        self.retries = retries
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.anonymity = anonymity
+        # 按能力分开的快照，普通请求用http，CONNECT隧道用https
+        self.ranked = {'http': [], 'https': []}
+        # 没配置https验证页时PROXY_CAPS:https是空的，隧道也用通过了http验证的代理
+        self.tunnel_capability = pool.capability_for('https://')
+        self.failures = set()
+        # 空闲的上游连接，按代理分组复用
+        self.idle = defaultdict(list)
+
+    @classmethod
+    def from_config(cls, pool, config):
+        return cls(
+            pool,
+            snapshot_size=config.get('GATEWAY_SNAPSHOT', 500),
+            refresh_interval=config.get('GATEWAY_REFRESH', 5),
+            retries=config.get('GATEWAY_RETRIES', 2),
+            timeout=config.get('GATEWAY_TIMEOUT', 5),
+            anonymity=config.get('GATEWAY_ANONYMITY'),
+        )
+
+    async def refresh(self):
+        ''' Keep the snapshot fresh and push failures back, off the event loop
+        '''
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                failures, self.failures = self.failures, set()
+                if failures:
+                    await loop.run_in_executor(None, self.pool.report_failures, failures)
+                for capability in self.ranked:
+                    self.ranked[capability] = await loop.run_in_executor(
+                        None, self.pool.snapshot, self.snapshot_size, capability, self.anonymity)
+                logger.debug('刷新代理快照，http代理%s个，https代理%s个'
+                    % (len(self.ranked['http']), len(self.ranked['https'])))
+            except Exception as e:
+                logger.exception(e)
+            await asyncio.sleep(self.refresh_interval)
+
+    def candidates(self, capability='http'):
+        return weighted_sample(self.ranked[capability], self.retries + 1)
+
+    def failed(self, proxy, reason):
+        logger.info('上游代理失败 %s: %s' % (proxy, reason))
+        self.failures.add(proxy)
+        for capability, ranked in self.ranked.items():
+            self.ranked[capability] = [(p, score) for p, score in ranked if p != proxy]
+        for _, writer in self.idle.pop(proxy, []):
+            writer.close()
+
+    async def connect(self, proxy):
+        target = urlsplit(proxy)
+        return await asyncio.wait_for(
+            asyncio.open_connection(target.hostname, target.port or 80), self.timeout)
+
+    async def acquire(self, proxy):
+        idle = self.idle[proxy]
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await self.connect(proxy)
+        return reader, writer, False
+
+    def release(self, proxy, reader, writer):
+        idle = self.idle[proxy]
+        if len(idle) < self.max_idle and proxy in dict(self.ranked['http']):
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                head = await read_head(reader)
+                if head is None:
+                    break
+                line, headers = head
+                method, target, version = line.split(b' ', 2)
+                if method == b'CONNECT':
+                    await self.tunnel(target, reader, writer)
+                    return
+                if not await self.forward(method, target, version, headers, reader, writer):
+                    break
+        except (ConnectionError, OSError, ValueError, asyncio.IncompleteReadError) as e:
+            logger.debug('客户端连接异常: %r' % e)
+        finally:
+            writer.close()
+
+    async def forward(self, method, target, version, headers, reader, writer):
+        ''' Forward one plain-http request, return whether the client
+        connection can take another request
+        '''
+        if not target.startswith(b'http://'):
+            target = b'http://' + (header(headers, b'host') or b'') + target
+        body = await read_body(reader, headers)
+        request = serialize(b' '.join([method, target, version]), headers,
+            [b'Connection: keep-alive']) + body
+        client_keep = version == b'HTTP/1.1' and (header(headers, b'connection') or b'').lower() != b'close'
+
+        candidates = self.candidates()
+        for attempt, proxy in enumerate(candidates):
+            last = attempt == len(candidates) - 1
+            up_writer = None
+            try:
+                up_reader, up_writer, reused = await self.acquire(proxy)
+                try:
+                    up_writer.write(request)
+                    head = await asyncio.wait_for(read_head(up_reader), self.timeout)
+                except (ConnectionError, OSError, asyncio.TimeoutError):
+                    if not reused:
+                        raise
+                    # 复用的连接可能已被上游关闭，换新连接重试一次
+                    up_writer.close()
+                    up_reader, up_writer = await self.connect(proxy)
+                    up_writer.write(request)
+                    head = await asyncio.wait_for(read_head(up_reader), self.timeout)
+                if head is None:
+                    raise UpstreamError('empty response')
+                status_line, resp_headers = head
+                status = int(status_line.split(b' ', 2)[1])
+                if status in RETRY_STATUS and not last:
+                    raise UpstreamError('status %s' % status)
+            except (ConnectionError, OSError, ValueError, IndexError,
+                    asyncio.TimeoutError, asyncio.IncompleteReadError, UpstreamError) as e:
+                # 换下一个代理前关掉这次的上游连接，不然每次重试都漏一个socket
+                if up_writer is not None:
+                    up_writer.close()
+                self.failed(proxy, repr(e))
+                continue
+
+            no_body = method == b'HEAD' or status in (204, 304) or 100 <= status < 200
+            keep = client_keep and (no_body or framed(resp_headers))
+            released = False
+            try:
+                writer.write(serialize(status_line, resp_headers,
+                    [b'Connection: keep-alive' if keep else b'Connection: close']))
+                if not no_body:
+                    await relay_body(up_reader, writer, resp_headers)
+                await writer.drain()
+                upstream_close = (header(resp_headers, b'connection') or b'').lower() == b'close'
+                if (no_body or framed(resp_headers)) and not upstream_close:
+                    self.release(proxy, up_reader, up_writer)
+                    released = True
+            except (ConnectionError, OSError, ValueError, asyncio.IncompleteReadError) as e:
+                # 响应已经发出一半，没法换代理重试了；客户端自己断开的不算上游的错
+                if not writer.transport.is_closing():
+                    self.failed(proxy, repr(e))
+                raise
+            finally:
+                if not released:
+                    up_writer.close()
+            return keep
+
+        writer.write(b'HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+        await writer.drain()
+        return False
+
+    async def tunnel(self, target, reader, writer):
+        for proxy in self.candidates(self.tunnel_capability):
+            up_writer = None
+            try:
+                up_reader, up_writer = await self.connect(proxy)
+                up_writer.write(b'CONNECT ' + target + b' HTTP/1.1\r\nHost: ' + target + b'\r\n\r\n')
+                head = await asyncio.wait_for(read_head(up_reader), self.timeout)
+                if head is None or head[0].split(b' ', 2)[1] != b'200':
+                    raise UpstreamError('CONNECT refused')
+            except (ConnectionError, OSError, IndexError,
+                    asyncio.TimeoutError, asyncio.IncompleteReadError, UpstreamError) as e:
+                if up_writer is not None:
+                    up_writer.close()
+                self.failed(proxy, repr(e))
+                continue
+            writer.write(b'HTTP/1.1 200 Connection Established\r\n\r\n')
+            await asyncio.gather(pipe(reader, up_writer), pipe(up_reader, writer))
+            return
+        writer.write(b'HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+        await writer.drain()
+
+    async def start(self, host='127.0.0.1', port=8899):
+        asyncio.ensure_future(self.refresh())
+        server = await asyncio.start_server(self.handle, host, port, backlog=1024)
+        logger.info('代理网关已启动 %s:%s' % (host, port))
+        return server
+
+def main():
+    parser = argparse.ArgumentParser(description='hq-proxies gateway')
+    parser.add_argument('--mode', default='prod', choices=['prod', 'test'])
+    parser.add_argument('--host', default=None)
+    parser.add_argument('--port', type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelno)s/%(lineno)d: %(message)s')
+    config = load_config(args.mode)
+    pool = ProxyPool(connect_redis(config), config)
+    gateway = ProxyGateway.from_config(pool, config)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(gateway.start(
+        args.host or config.get('GATEWAY_HOST', '127.0.0.1'),
+        args.port or config.get('GATEWAY_PORT', 8899)))
+    loop.run_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+''' Offline geo/ASN lookup of proxy addresses
+
+GEO_DATABASE points to a local IPv4 range file, one range per line, comma
+or tab separated, with the columns named by GEO_COLUMNS (start, end,
+country, region, asn by default; "-" skips a column). Bounds are dotted
+addresses or integers, a start of the form a.b.c.d/nn stands for a whole
+CIDR block without an end column. Free databases like iptoasn's
+ip2asn-v4.tsv load as they are with GEO_COLUMNS [start, end, asn, country, '-'].
+
+The ranges are kept in sorted arrays, so a lookup is a single bisect, and
+ranges with the same tags share one tags tuple.
+Tagged proxies are indexed by country code ("CN"), country and region
+("CN/Guangdong") and autonomous system ("AS4134"), see label().
+'''
+import os
+import socket
+import struct
+import logging
+from array import array
+from bisect import bisect_right
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ('start', 'end', 'country', 'region', 'asn')
+TAGS = ('country', 'region', 'asn')
+# 32位无符号整数的数组类型，比list省内存
+UINT32 = 'I' if array('I').itemsize >= 4 else 'L'
+
+def ip_number(ip):
+    if ip.isdigit():
+        return int(ip)
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+def label(region):
+    ''' Index label of a region selector: "cn" -> "CN", "cn/Guangdong" ->
+    "CN/Guangdong", "as4134" or 4134 -> "AS4134"
+    '''
+    region = str(region).strip()
+    if region.isdigit() or region[:2].upper() == 'AS' and region[2:].isdigit():
+        return 'AS%s' % region.lstrip('asAS')
+    country, _, rest = region.partition('/')
+    return country.upper() + ('/' + rest if rest else '')
+
+class GeoIndex(object):
+    ''' Sorted IPv4 ranges with their (country, region, asn) tags
+    '''
+    def __init__(self, starts, ends, tags):
+        if any(starts[i] > starts[i + 1] for i in range(len(starts) - 1)):
+            order = sorted(range(len(starts)), key=starts.__getitem__)
+            starts, ends, tags = [starts[i] for i in order], [ends[i] for i in order], [tags[i] for i in order]
+        self.starts = array(UINT32, starts)
+        self.ends = array(UINT32, ends)
+        self.tags = tags
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        ''' Index of (start, end, {country, region, asn}) tuples
+        '''
+        ranges = list(ranges)
+        return cls([r[0] for r in ranges], [r[1] for r in ranges],
+            [tuple(r[2].get(tag, '') for tag in TAGS) for r in ranges])
+
+    @classmethod
+    def load(cls, path, columns=COLUMNS):
+        starts, ends, tags = array(UINT32), array(UINT32), []
+        interned = {}
+        with open(path, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                cells = [cell.strip().strip('"') for cell in line.split('\t' if '\t' in line else ',')]
+                row = dict(zip(columns, cells))
+                try:
+                    if '/' in row.get('start', ''):
+                        # 网段没有结束地址那一列
+                        row = dict(zip([c for c in columns if c != 'end'], cells))
+                        ip, bits = row['start'].split('/')
+                        start = ip_number(ip)
+                        end = start + 2 ** (32 - int(bits)) - 1
+                    else:
+                        start, end = ip_number(row['start']), ip_number(row['end'])
+                except (KeyError, ValueError, OSError):
+                    # 表头或者IPv6之类的行
+                    continue
+                asn = row.get('asn', '').upper().lstrip('AS')
+                key = (row.get('country', '').upper(), row.get('region', ''), asn if asn.isdigit() and asn != '0' else '')
+                if not any(key):
+                    continue
+                starts.append(start)
+                ends.append(end)
+                tags.append(interned.setdefault(key, key))
+        return cls(starts, ends, tags)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def lookup(self, ip):
+        ''' Tags of the range holding `ip`, None when it's in none of them
+        '''
+        try:
+            number = ip_number(ip)
+        except (ValueError, OSError):
+            return None
+        i = bisect_right(self.starts, number) - 1
+        if i >= 0 and number <= self.ends[i]:
+            return dict(zip(TAGS, self.tags[i]))
+        return None
+
+    def tag(self, proxy):
+        ''' Tags of a proxy url's host
+        '''
+        return self.lookup(proxy.split('://')[-1].rsplit(':', 1)[0])
+
+    def labels(self, proxy):
+        ''' Region index labels a proxy belongs to
+        '''
+        tags = self.tag(proxy)
+        return labels_of(tags) if tags else []
+
+def labels_of(tags):
+    labels = []
+    if tags.get('country'):
+        labels.append(tags['country'])
+        if tags.get('region'):
+            labels.append('%s/%s' % (tags['country'], tags['region']))
+    if tags.get('asn'):
+        labels.append('AS%s' % tags['asn'])
+    return labels
+
+_loaded = {}
+
+def load_geo(config):
+    ''' GeoIndex of config's GEO_DATABASE, loaded once per process, None
+    when it isn't configured or can't be read
+    '''
+    path = config.get('GEO_DATABASE')
+    if not path:
+        return None
+    columns = tuple(config.get('GEO_COLUMNS') or COLUMNS)
+    key = (path, columns)
+    if key not in _loaded:
+        if not os.path.exists(path):
+            logger.warning('IP地址库%s不存在，不给代理标注地区' % path)
+            _loaded[key] = None
+        else:
+            _loaded[key] = GeoIndex.load(path, columns)
+            logger.info('从%s载入%s个IP段' % (path, len(_loaded[key])))
+    return _loaded[key]
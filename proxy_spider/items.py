@@ -8,7 +8,16 @@
 import scrapy
 
 
-class ProxySpiderItem(scrapy.Item):
-    # define the fields for your item here like:
-    # name = scrapy.Field()
-    pass
+class ProxyItem(scrapy.Item):
+    ''' Result of validating one proxy, written to redis by ProxyPoolPipeline
+    '''
+    proxy = scrapy.Field()
+    valid = scrapy.Field()
+    latency = scrapy.Field()
+    validator = scrapy.Field()
+    # check: 池内代理复检  fetch: 新抓取代理的入库验证
+    source = scrapy.Field()
+    # 通过验证的能力（http/https/socks5），不填就是代理的基础能力
+    capabilities = scrapy.Field()
+    # echo验证页给出的匿名度 transparent/anonymous/elite
+    anonymity = scrapy.Field()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+''' Process-wide counters, gauges and histograms in Prometheus text format
+
+Spiders and the asyncio engine all run inside the scheduler process, so
+they update the module level metrics below and start.py serves render()
+over http (METRICS_PORT).
+'''
+import bisect
+import threading
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def format_labels(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.doc), '# TYPE %s %s' % (self.name, self.kind)]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.extend(self.render_value(key, value))
+        return lines
+
+    def render_value(self, key, value):
+        return ['%s%s %s' % (self.name, self.format_labels(key), value)]
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, doc, buckets, labels=()):
+        super(Histogram, self).__init__(name, doc, labels)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def render_value(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ['+Inf'], counts):
+            cumulative += count
+            lines.append('%s_bucket%s %s' % (self.name, self.format_labels(key, [('le', str(bound))]), cumulative))
+        lines.append('%s_sum%s %s' % (self.name, self.format_labels(key), total))
+        lines.append('%s_count%s %s' % (self.name, self.format_labels(key), cumulative))
+        return lines
+
+REGISTRY = []
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+POOL_SIZE = Gauge('hqproxies_pool_size', 'Proxies in PROXY_SET')
+CHECKS = Counter('hqproxies_checks_total', 'Proxy validations by outcome', ['source', 'result'])
+CHECK_LATENCY = Histogram('hqproxies_check_latency_seconds', 'Latency of passed validations',
+    [0.1, 0.25, 0.5, 1, 2, 3, 5, 10], ['source'])
+VALIDATOR_CHECKS = Counter('hqproxies_validator_checks_total', 'Validations per validator by outcome',
+    ['validator', 'result'])
+VALIDATOR_UP = Gauge('hqproxies_validator_up', 'Whether a validator is in rotation', ['validator'])
+VENDOR_CANDIDATES = Counter('hqproxies_vendor_candidates_total', 'Candidates listed per vendor', ['vendor'])
+VENDOR_VALID = Counter('hqproxies_vendor_valid_total', 'Valid proxies yielded per vendor', ['vendor'])
+CYCLE_DURATION = Histogram('hqproxies_cycle_duration_seconds', 'Duration of fetch/check runs',
+    [1, 5, 10, 30, 60, 120, 300, 600], ['kind'])
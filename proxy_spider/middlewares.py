@@ -1,15 +1,22 @@
 # -*- coding: utf-8 -*-
 
 import os
+import time
 import random
 from scrapy import signals
+from scrapy.exceptions import IgnoreRequest
 from scrapy.downloadermiddlewares.useragent import UserAgentMiddleware 
 from scrapy.downloadermiddlewares.downloadtimeout import DownloadTimeoutMiddleware
 from scrapy.http import TextResponse
 import logging
+from collections import defaultdict, Counter, OrderedDict
+from twisted.internet import reactor, task
 from twisted.web._newclient import ResponseNeverReceived
 from twisted.internet.error import TimeoutError, ConnectionRefusedError, ConnectError
 
+from proxy_spider.utils import CONFIG_YAML, load_config, connect_redis
+from proxy_spider.pool import ProxyPool, domain_of
+
 logger = logging.getLogger(__name__)
 
 class ProxyPoolUserAgentMiddleware(UserAgentMiddleware):
@@ -68,6 +75,243 @@ class ProxyPoolDownloaderMiddleware(DownloadTimeoutMiddleware):
     DONT_RETRY_ERRORS = (TimeoutError, ConnectionRefusedError, ResponseNeverReceived, ConnectError, ValueError, TypeError)
     
     def process_exception(self, request, exception, spider):
-        if isinstance(exception, self.DONT_RETRY_ERRORS):
+        # 只把验证请求的失败转成空响应，代理源页面的失败交给errback
+        # https验证无论怎么失败都要回到checkin_https，把前面http验证的结果写进去
+        if 'proxy' in request.meta and (isinstance(exception, self.DONT_RETRY_ERRORS)
+                or request.meta.get('capability') == 'https'):
+            # 请求没能走到验证页，不算验证页的失败
+            request.meta['proxy_error'] = repr(exception)
             return TextResponse(url=request.meta['proxy'])
-        
\ No newline at end of file
+
+class ValidatorMiddleware(object):
+    ''' Count validation checks against their validator only while they are
+    actually downloading
+
+    Validation requests choose their validator when they are queued, but
+    the spider may close with queued requests that then never come back,
+    so the in-flight count is taken here when the download starts and
+    given back with the response or exception, along with whether the
+    proxy passed. Anything still held when the spider closes is given back
+    then. Needs an order above ProxyPoolDownloaderMiddleware, to see the
+    exceptions before they become responses.
+    '''
+    def __init__(self):
+        # (验证页池, 验证页url) -> 占着的请求数
+        self.held = Counter()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        middleware = cls()
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    def validators(self, request, spider):
+        if request.meta.get('capability') == 'https':
+            return getattr(spider, 'https_validators', None)
+        return getattr(spider, 'http_validators', None)
+
+    def process_request(self, request, spider):
+        url = request.meta.get('validator')
+        validators = self.validators(request, spider)
+        if not url or validators is None or request.meta.get('validator_held'):
+            return
+        validators.hold(url)
+        request.meta['validator_held'] = True
+        self.held[(validators, url)] += 1
+
+    def release(self, request, spider, passed=None):
+        if not request.meta.pop('validator_held', False):
+            return
+        key = (self.validators(request, spider), request.meta['validator'])
+        if self.held[key] > 0:
+            self.held[key] -= 1
+            key[0].release(key[1], passed)
+
+    def process_response(self, request, response, spider):
+        startstring = request.meta.get('startstring')
+        # 请求没能走到验证页（被转成了空响应）不算验证页的失败
+        if 'proxy_error' in request.meta or not startstring:
+            self.release(request, spider)
+        else:
+            self.release(request, spider, response.body.startswith(startstring.encode('utf-8')))
+        return response
+
+    def process_exception(self, request, exception, spider):
+        self.release(request, spider)
+
+    def spider_closed(self, spider):
+        held, self.held = self.held, Counter()
+        if sum(held.values()):
+            logger.info('爬虫结束时还有%s个验证请求占着验证页，全部释放' % sum(held.values()))
+        for (validators, url), count in held.items():
+            for _ in range(count):
+                validators.release(url)
+
+class DynamicProxyMiddleware(object):
+    ''' Route requests through proxies from the pool, for consumer projects
+
+    Proxies come from local batches of the best scored proxies, refreshed
+    every DYNAMIC_PROXY_REFRESH seconds, so requests don't touch redis.
+    Failing proxies are dropped from the batch and reported to the pool with
+    the next refresh, the retry then goes out through another proxy. Enable
+    it between RetryMiddleware (550) and HttpProxyMiddleware (750), the
+    DYNAMIC_PROXY_* settings are described in the README:
+
+        DOWNLOADER_MIDDLEWARES = {'proxy_spider.middlewares.DynamicProxyMiddleware': 600}
+        HQ_PROXIES_CONFIG = '/etc/hq-proxies.yml'
+    '''
+    DONT_RETRY_ERRORS = ProxyPoolDownloaderMiddleware.DONT_RETRY_ERRORS
+    # 同一进程内所有爬虫共用一个带连接池的redis客户端
+    redis_db = None
+
+    def __init__(self, config, batch=50, refresh=10, anonymity=None, ban_codes=(403, 429), lease=False, lease_wait=60,
+            region=None, max_batches=1000, allow_direct=False):
+        if DynamicProxyMiddleware.redis_db is None:
+            DynamicProxyMiddleware.redis_db = connect_redis(config)
+        self.pool = ProxyPool(self.redis_db, config)
+        self.batch = batch
+        self.refresh = refresh
+        self.anonymity = anonymity
+        # 按能力（http/https）、目标域名和地区分别缓存，最多max_batches份，挤掉最久没用的
+        self.cache = OrderedDict()
+        self.fetched_at = {}
+        # 缓存里每份空结果上次报警时的抓取时间，一次刷新只报一次
+        self.warned = {}
+        self.max_batches = max_batches
+        self.failures = set()
+        self.ban_codes = set(ban_codes)
+        # 按域名记下请求结果，随下次刷新一起报告给代理池
+        self.outcomes = defaultdict(list)
+        self.lease = lease
+        self.lease_wait = lease_wait
+        self.region = region
+        # 池里没有代理时是否直接用本机ip访问，默认不允许，丢弃请求
+        self.allow_direct = allow_direct
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        config = load_config(path=settings.get('HQ_PROXIES_CONFIG', CONFIG_YAML['prod']))
+        return cls(
+            config,
+            batch=settings.getint('DYNAMIC_PROXY_BATCH', 50),
+            refresh=settings.getfloat('DYNAMIC_PROXY_REFRESH', 10),
+            anonymity=settings.get('DYNAMIC_PROXY_ANONYMITY'),
+            ban_codes=[int(code) for code in settings.getlist('DYNAMIC_PROXY_BAN_CODES', [403, 429])],
+            lease=settings.getbool('DYNAMIC_PROXY_LEASE', False),
+            lease_wait=settings.getfloat('DYNAMIC_PROXY_LEASE_WAIT', 60),
+            region=settings.get('DYNAMIC_PROXY_REGION'),
+            max_batches=settings.getint('DYNAMIC_PROXY_MAX_BATCHES', 1000),
+            allow_direct=settings.getbool('DYNAMIC_PROXY_ALLOW_DIRECT', False)
+        )
+
+    def proxies(self, capability, domain, region=None):
+        ''' Local batch of `capability` proxies not banned by `domain`,
+        refetched (and failures reported) every `refresh` seconds
+        '''
+        key = (capability, domain, region)
+        # 空结果也缓存到下次刷新，没有代理的地区不会每个请求都查一遍redis
+        if key not in self.cache or time.time() - self.fetched_at.get(key, 0) > self.refresh:
+            failures, self.failures = self.failures, set()
+            self.pool.report_failures(failures)
+            outcomes, self.outcomes = self.outcomes, defaultdict(list)
+            for reported, pairs in outcomes.items():
+                self.pool.report_domain(reported, pairs)
+            self.cache[key] = [p for p, _ in self.pool.snapshot(self.batch, capability, self.anonymity, domain,
+                region) if p not in failures]
+            self.fetched_at[key] = time.time()
+            while len(self.cache) > self.max_batches:
+                oldest, _ = self.cache.popitem(last=False)
+                self.fetched_at.pop(oldest, None)
+                self.warned.pop(oldest, None)
+        self.cache.move_to_end(key)
+        return self.cache[key]
+
+    def drop(self, proxy, domain=None):
+        ''' Take a proxy out of the batches (of `domain` only if given)
+        '''
+        for key, cache in self.cache.items():
+            if proxy in cache and (domain is None or key[1] == domain):
+                cache.remove(proxy)
+                if not cache:
+                    # 代理被踢光了，下次用到时马上重新取
+                    self.fetched_at[key] = 0
+
+    def warn_once(self, key, message):
+        ''' Log a warning about an empty batch once per refresh of it
+        '''
+        if self.warned.get(key) != self.fetched_at.get(key):
+            self.warned[key] = self.fetched_at.get(key)
+            logger.warning(message)
+
+    def process_request(self, request, spider):
+        # 请求自己指定了代理就不管了，重试的请求换一个代理
+        if 'proxy' in request.meta and not request.meta.get('dynamic_proxy'):
+            return
+        # 重试的请求可能还带着上一次的租约，先还掉
+        self.release(request)
+        capability = self.pool.capability_for(request.url)
+        domain = domain_of(request.url)
+        region = request.meta.get('proxy_region', self.region)
+        proxies = self.proxies(capability, domain, region)
+        if not proxies and region:
+            self.warn_once((capability, domain, region), '代理池里没有%s地区的代理，改用其他地区的代理访问%s' % (region, domain))
+            proxies = self.proxies(capability, domain)
+        if not proxies and not self.allow_direct:
+            self.warn_once((capability, domain, None), '代理池里没有可用代理，丢弃访问%s的请求' % domain)
+            raise IgnoreRequest('no proxy for %s' % request.url)
+        if not proxies:
+            self.warn_once((capability, domain, None), '代理池里没有可用代理，直接访问%s' % domain)
+            request.meta.pop('proxy', None)
+            request.meta.pop('dynamic_proxy', None)
+            return
+        if self.lease:
+            return self.lease_proxy(request, proxies)
+        self.use(request, random.choice(proxies))
+
+    def lease_proxy(self, request, proxies, waited=0):
+        ''' Lease one of `proxies` for the request, waiting up to
+        `lease_wait` seconds for one under its caps before dropping it
+        '''
+        # 租约至少要撑到下载超时，不然慢请求还没结束代理就被别人租走了
+        ttl = max(self.pool.lease_ttl, request.meta.get('download_timeout', 0) + 5)
+        lease = self.pool.lease(candidates=proxies, ttl=ttl)
+        if lease is None and waited < self.lease_wait:
+            # 候选代理都到了并发或频率上限，等一会儿再租
+            return task.deferLater(reactor, 0.1, self.lease_proxy, request, proxies, waited + 0.1)
+        if lease is None:
+            # 不租用直接发出去就绕过了并发和频率上限
+            logger.warning('代理都到了并发或频率上限，等了%s秒没租到，丢弃请求[%s]' % (self.lease_wait, request.url))
+            raise IgnoreRequest('no proxy lease for %s' % request.url)
+        proxy, request.meta['proxy_lease'] = lease
+        self.use(request, proxy)
+
+    def use(self, request, proxy):
+        logger.debug('使用代理[%s]访问[%s]' % (proxy, request.url))
+        request.meta['proxy'] = proxy
+        request.meta['dynamic_proxy'] = True
+
+    def release(self, request):
+        lease_id = request.meta.pop('proxy_lease', None)
+        if lease_id and request.meta.get('proxy'):
+            self.pool.release(request.meta['proxy'], lease_id)
+
+    def process_exception(self, request, exception, spider):
+        self.release(request)
+        proxy = request.meta.get('proxy')
+        if request.meta.get('dynamic_proxy') and isinstance(exception, self.DONT_RETRY_ERRORS):
+            logger.debug('代理[%s]失效: %r' % (proxy, exception))
+            self.failures.add(proxy)
+            self.drop(proxy)
+
+    def process_response(self, request, response, spider):
+        self.release(request)
+        if request.meta.get('dynamic_proxy') and request.meta.get('proxy'):
+            domain = domain_of(request.url)
+            ok = response.status not in self.ban_codes
+            self.outcomes[domain].append((request.meta['proxy'], ok))
+            if not ok:
+                proxy = request.meta['proxy']
+                logger.debug('代理[%s]被%s屏蔽: %s' % (proxy, domain, response.status))
+                self.drop(proxy, domain)
+        return response
@@ -5,7 +5,51 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: http://doc.scrapy.org/en/latest/topics/item-pipeline.html
 
+import logging
+from twisted.internet import task
+
+from proxy_spider.items import ProxyItem
+
+logger = logging.getLogger(__name__)
+
+class ProxyPoolPipeline(object):
+    ''' Buffer validation results and write them to redis in batches
+
+    Results are flushed through ProxyPool.apply once POOL_FLUSH_SIZE of them
+    are buffered, every POOL_FLUSH_INTERVAL seconds, and when the spider
+    closes, so callbacks never block the reactor on a redis round-trip.
+    '''
+    def __init__(self, flush_size=100, flush_interval=1.0):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.timer = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(
+            flush_size=crawler.settings.getint('POOL_FLUSH_SIZE', 100),
+            flush_interval=crawler.settings.getfloat('POOL_FLUSH_INTERVAL', 1.0)
+        )
+
+    def open_spider(self, spider):
+        self.timer = task.LoopingCall(self.flush, spider)
+        self.timer.start(self.flush_interval, now=False)
 
-class ProxySpiderPipeline(object):
     def process_item(self, item, spider):
+        if isinstance(item, ProxyItem):
+            self.buffer.append(item)
+            if len(self.buffer) >= self.flush_size:
+                self.flush(spider)
         return item
+
+    def flush(self, spider):
+        buffer, self.buffer = self.buffer, []
+        if buffer:
+            logger.debug('写入%s条验证结果' % len(buffer))
+            spider.pool.apply(buffer)
+
+    def close_spider(self, spider):
+        if self.timer and self.timer.running:
+            self.timer.stop()
+        self.flush(spider)
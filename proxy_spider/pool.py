@@ -0,0 +1,679 @@
+# -*- coding: utf-8 -*-
+
+import time
+import uuid
+import random
+import logging
+from urllib.parse import urlsplit
+
+from proxy_spider import metrics
+from proxy_spider.geo import load_geo, labels_of, label
+
+logger = logging.getLogger(__name__)
+
+# http: 转发普通http请求  https: 支持CONNECT隧道  socks5: socks5代理
+CAPABILITIES = ('http', 'https', 'socks5')
+# echo验证页给出的匿名度，从低到高，select(anonymity=...)取的是不低于这个级别的代理
+ANONYMITY = ('transparent', 'anonymous', 'elite')
+
+# 取出到期的一批代理并把它们推迟到租约到期，原子执行，多个节点同时取也不会重复
+CLAIM_SCRIPT = '''
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, proxy in ipairs(due) do
+    redis.call('ZADD', KEYS[1], ARGV[3], proxy)
+end
+return due
+'''
+# 给代理池里还没排期的代理排期，删掉已经不在代理池里的代理的排期，原子执行，不会误删同时入池的代理
+# KEYS: PROXY_SET、PROXY_DUE  ARGV: 当前时间
+SYNC_SCRIPT = '''
+for _, proxy in ipairs(redis.call('ZRANGE', KEYS[2], 0, -1)) do
+    if redis.call('SISMEMBER', KEYS[1], proxy) == 0 then
+        redis.call('ZREM', KEYS[2], proxy)
+    end
+end
+for _, proxy in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    if not redis.call('ZSCORE', KEYS[2], proxy) then
+        redis.call('ZADD', KEYS[2], ARGV[1], proxy)
+    end
+end
+'''
+# 只有持有者才能续期/释放主节点锁
+RENEW_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+'''
+RESIGN_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+'''
+# 租约上限配成0时传给脚本的值
+UNLIMITED = 10 ** 9
+# 在候选代理里挑租约最少、并发和本秒请求数都没到上限的一个，记下租约，返回它的序号（从1开始），都满了返回0
+# KEYS: 每个候选代理的租约集合和本秒计数  ARGV: 当前时间、租约到期时间、租约id、并发上限、每秒上限、租约秒数
+LEASE_SCRIPT = '''
+local now = tonumber(ARGV[1])
+local best, best_load
+for i = 1, #KEYS, 2 do
+    redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', now)
+    local load = redis.call('ZCARD', KEYS[i])
+    local rate = tonumber(redis.call('GET', KEYS[i + 1]) or '0')
+    if load < tonumber(ARGV[4]) and rate < tonumber(ARGV[5]) and (not best or load < best_load) then
+        best, best_load = i, load
+    end
+end
+if not best then
+    return 0
+end
+redis.call('ZADD', KEYS[best], ARGV[2], ARGV[3])
+redis.call('EXPIRE', KEYS[best], ARGV[6])
+redis.call('INCR', KEYS[best + 1])
+redis.call('EXPIRE', KEYS[best + 1], 2)
+return (best + 1) / 2
+'''
+
+def address(proxy):
+    ''' ip:port part of a proxy url, failures are remembered per address
+    whatever scheme the vendor listed it under
+    '''
+    return proxy.split('://')[-1]
+
+def proxy_url(ip, port, proto='http'):
+    ''' Pool url of a listed proxy, vendors' HTTP/HTTPS columns both mean
+    an http proxy (whether it tunnels https is up to the checks)
+    '''
+    scheme = 'socks5' if 'socks' in proto.lower() else 'http'
+    return '%s://%s:%s' % (scheme, ip, port)
+
+def domain_of(url):
+    ''' Domain that per-domain health is kept for: the lowercased host of a
+    url (or a bare host), without a leading www.
+    '''
+    host = (urlsplit(url).hostname if '://' in url else url.split(':')[0]).lower()
+    return host[4:] if host.startswith('www.') else host
+
+def base_capability(proxy):
+    ''' The capability a proxy must pass to stay in the pool at all
+    '''
+    return 'socks5' if proxy.lower().startswith('socks') else 'http'
+
+def geo_tags(stats):
+    ''' {country, region, asn} recorded in a raw stats hash
+    '''
+    stats = stats or {}
+    return dict((name, stats.get(name.encode('utf-8'), b'').decode('utf-8')) for name in ('country', 'region', 'asn'))
+
+def weighted_sample(ranked, n):
+    ''' Pick `n` distinct proxies from (proxy, weight) pairs, weight-proportionally
+    '''
+    ranked = list(ranked)
+    picked = []
+    while ranked and len(picked) < n:
+        total = sum(weight for _, weight in ranked)
+        r = random.uniform(0, total)
+        for i, (proxy, weight) in enumerate(ranked):
+            r -= weight
+            if r <= 0:
+                break
+        picked.append(ranked.pop(i)[0])
+    return picked
+
+class ProxyPool(object):
+    ''' Redis side of the proxy pool, shared by the spiders and the scheduler
+
+    PROXY_SET holds the live proxies, PROXY_DUE schedules their checks and
+    PROXY_STATS:<proxy> keeps their latency/success EWMAs. The other keys
+    (see hq-proxies.yml) index the same proxies by score, capability,
+    anonymity, domain bans, leases and location, or hold the ones in
+    quarantine.
+    '''
+    def __init__(self, redis_db, config):
+        self.redis_db = redis_db
+        self.PROXY_COUNT = config['PROXY_COUNT']
+        self.PROXY_SET = config['PROXY_SET']
+        self.PROXY_DUE = config.get('PROXY_DUE', 'hq-proxies:proxy_due')
+        self.PROXY_STREAK = config.get('PROXY_STREAK', 'hq-proxies:proxy_streak')
+        self.PROXY_SCORE = config.get('PROXY_SCORE', 'hq-proxies:proxy_score')
+        self.PROXY_STATS = config.get('PROXY_STATS', 'hq-proxies:proxy_stats') + ':%s'
+        self.PROXY_DEAD = config.get('PROXY_DEAD', 'hq-proxies:proxy_dead')
+        self.VENDOR_STATS = config.get('VENDOR_STATS', 'hq-proxies:vendor_stats') + ':%s'
+        self.PROXY_EVENTS = config.get('PROXY_EVENTS', 'hq-proxies:proxy_events')
+        self.PROXY_CAPS = config.get('PROXY_CAPS', 'hq-proxies:proxy_caps') + ':%s'
+        self.PROXY_ANON = config.get('PROXY_ANON', 'hq-proxies:proxy_anon') + ':%s'
+        self.PROXY_LEADER = config.get('PROXY_LEADER', 'hq-proxies:proxy_leader')
+        self.PROXY_QUARANTINE = config.get('PROXY_QUARANTINE', 'hq-proxies:proxy_quarantine')
+        self.PROXY_FAILS = config.get('PROXY_FAILS', 'hq-proxies:proxy_fails')
+        self.PROXY_DOMAIN = config.get('PROXY_DOMAIN', 'hq-proxies:proxy_domain') + ':%s'
+        self.PROXY_BANS = config.get('PROXY_BANS', 'hq-proxies:proxy_bans') + ':%s'
+        self.PROXY_LEASES = config.get('PROXY_LEASES', 'hq-proxies:proxy_leases') + ':%s'
+        self.PROXY_RATE = config.get('PROXY_RATE', 'hq-proxies:proxy_rate') + ':%s:%d'
+        self.PROXY_GEO = config.get('PROXY_GEO', 'hq-proxies:proxy_geo') + ':%s'
+        self.proxy_low = config.get('PROXY_LOW', 5)
+        self.proxy_exhaust = config.get('PROXY_EXHAUST', 2)
+
+        self.check_min = config.get('CHECK_MIN_INTERVAL', 10)
+        self.check_max = config.get('CHECK_MAX_INTERVAL', 600)
+        self.check_batch = config.get('CHECK_BATCH', 500)
+        self.check_lease = config.get('CHECK_LEASE', self.check_max)
+        self.score_alpha = config.get('SCORE_ALPHA', 0.3)
+        self.stats_ttl = config.get('STATS_TTL', 86400 * 7)
+        self.dead_ttl = config.get('DEAD_TTL', 3600)
+        self.vendor_backoff = config.get('VENDOR_BACKOFF', 600)
+        self.vendor_backoff_max = config.get('VENDOR_BACKOFF_MAX', 3600 * 6)
+        self.quarantine_max_fails = config.get('QUARANTINE_MAX_FAILS', 4)
+        self.quarantine_backoff = config.get('QUARANTINE_BACKOFF', 60)
+        self.quarantine_backoff_max = config.get('QUARANTINE_BACKOFF_MAX', 3600)
+        self.domain_half_life = config.get('DOMAIN_HALF_LIFE', 1800)
+        self.domain_ban_threshold = config.get('DOMAIN_BAN_THRESHOLD', 3)
+        self.domain_ban_ttl = config.get('DOMAIN_BAN_TTL', 3600)
+        self.domain_ttl = config.get('DOMAIN_TTL', 86400)
+        self.lease_ttl = config.get('LEASE_TTL', 180)
+        self.lease_max_concurrency = config.get('LEASE_MAX_CONCURRENCY', 4)
+        self.lease_max_rps = config.get('LEASE_MAX_RPS', 2)
+        self.lease_candidates = config.get('LEASE_CANDIDATES', 10)
+        # IP地址库用到时才载入，只取代理的middleware和网关用不着
+        self.config = config
+        # 没配置https验证页时PROXY_CAPS:https一直是空的，https请求只能交给通过了http验证的代理
+        self.https_checked = any(v['url'].startswith('https://') for v in config.get('PROXY_VALIDATORS') or [])
+
+        self.claim_script = redis_db.register_script(CLAIM_SCRIPT)
+        self.sync_script = redis_db.register_script(SYNC_SCRIPT)
+        self.renew_script = redis_db.register_script(RENEW_SCRIPT)
+        self.resign_script = redis_db.register_script(RESIGN_SCRIPT)
+        self.lease_script = redis_db.register_script(LEASE_SCRIPT)
+
+    @property
+    def geo(self):
+        ''' GeoIndex of GEO_DATABASE, loaded on first use
+        '''
+        return load_geo(self.config)
+
+    def count(self):
+        return self.redis_db.scard(self.PROXY_SET)
+
+    def update_count(self):
+        ''' Refresh PROXY_COUNT and publish an event when it crosses a threshold
+        '''
+        count = self.count()
+        metrics.POOL_SIZE.set(count)
+        old = int(self.redis_db.getset(self.PROXY_COUNT, count) or 0)
+        for level, threshold in (('exhaust', self.proxy_exhaust), ('low', self.proxy_low)):
+            if count < threshold <= old:
+                logger.debug('代理数量从%s降到%s，发布%s事件' % (old, count, level))
+                self.redis_db.publish(self.PROXY_EVENTS, '%s:%s' % (level, count))
+                break
+        return count
+
+    def members(self):
+        return [p.decode('utf-8') for p in self.redis_db.smembers(self.PROXY_SET)]
+
+    def contains(self, proxy):
+        return self.redis_db.sismember(self.PROXY_SET, proxy)
+
+    def next_check(self, streak):
+        interval = min(self.check_min * 2 ** streak, self.check_max)
+        # 加一点抖动，避免同一批入库的代理永远挤在同一个tick里
+        return time.time() + interval * random.uniform(0.9, 1.1)
+
+    def retry_at(self, fails):
+        backoff = min(self.quarantine_backoff * 2 ** (fails - 1), self.quarantine_backoff_max)
+        return time.time() + backoff * random.uniform(0.9, 1.1)
+
+    def fold(self, stats, ok, latency=None):
+        ''' Fold one check result into a proxy's stats hash, return (stats, score)
+
+        Latency is in seconds, failed checks count as DOWNLOAD_TIMEOUT-ish
+        slow so that a proxy can't look fast by failing quickly.
+        '''
+        if latency is None:
+            latency = 3.0
+        alpha = self.score_alpha
+        if stats:
+            ewma = float(stats[b'latency']) * (1 - alpha) + latency * alpha
+            success = float(stats[b'success']) * (1 - alpha) + (1.0 if ok else 0.0) * alpha
+            checks = int(stats[b'checks']) + 1
+        else:
+            ewma = latency
+            success = 1.0 if ok else 0.0
+            checks = 1
+        stats = {'latency': ewma, 'success': success, 'checks': checks, 'seen': int(time.time())}
+        return stats, self.score(ewma, success)
+
+    def score(self, latency, success):
+        # 成功率越高、延迟越低分数越高，取值0~1
+        return success / (1 + latency)
+
+    def apply(self, results):
+        ''' Write a batch of validation results in two redis round-trips
+
+        `results` are ProxyItem-like mappings with proxy/valid/latency/source.
+        source 'fetch' adds valid proxies to the pool and only records failed
+        ones, source 'check' keeps passing pool proxies and quarantines failing
+        ones, or drops them after QUARANTINE_MAX_FAILS failures in a row.
+        `valid` is the base capability's outcome, `capabilities` lists every
+        capability passed and defaults to the base one, `anonymity` is set
+        by echo validators.
+        '''
+        if not results:
+            return
+        pipe = self.redis_db.pipeline(transaction=False)
+        for result in results:
+            pipe.hgetall(self.PROXY_STATS % result['proxy'])
+            pipe.hget(self.PROXY_STREAK, result['proxy'])
+            pipe.hget(self.PROXY_FAILS, result['proxy'])
+        fetched = pipe.execute()
+
+        now = time.time()
+        geo = self.geo
+        pipe = self.redis_db.pipeline()
+        for i, result in enumerate(results):
+            proxy = result['proxy']
+            valid = result['valid']
+            source = result['source']
+            metrics.CHECKS.inc(source=source, result='valid' if valid else 'invalid')
+            if valid and result.get('latency') is not None:
+                metrics.CHECK_LATENCY.observe(result['latency'], source=source)
+            if result.get('validator'):
+                metrics.VALIDATOR_CHECKS.inc(validator=result['validator'], result='valid' if valid else 'invalid')
+            stats, score = self.fold(fetched[i * 3], valid, result.get('latency'))
+            capabilities = result.get('capabilities') or [base_capability(proxy)]
+            stats['caps'] = ','.join(capabilities) if valid else ''
+            anonymity = result.get('anonymity') or (fetched[i * 3] or {}).get(b'anonymity', b'').decode('utf-8')
+            stats['anonymity'] = anonymity
+            regions = labels_of(geo_tags(fetched[i * 3]))
+            if geo is not None and valid:
+                tags = geo.tag(proxy) or {'country': '', 'region': '', 'asn': ''}
+                stats.update(tags)
+                for region in set(regions) - set(labels_of(tags)):
+                    pipe.zrem(self.PROXY_GEO % region, proxy)
+                regions = labels_of(tags)
+            pipe.hmset(self.PROXY_STATS % proxy, stats)
+            pipe.expire(self.PROXY_STATS % proxy, self.stats_ttl)
+            if valid:
+                if result['source'] == 'fetch':
+                    streak = 0
+                else:
+                    streak = int(fetched[i * 3 + 1] or 0) + 1
+                pipe.sadd(self.PROXY_SET, proxy)
+                pipe.zadd(self.PROXY_DUE, self.next_check(streak), proxy)
+                pipe.zadd(self.PROXY_SCORE, score, proxy)
+                pipe.hset(self.PROXY_STREAK, proxy, streak)
+                pipe.zrem(self.PROXY_DEAD, address(proxy))
+                pipe.zrem(self.PROXY_QUARANTINE, proxy)
+                pipe.hdel(self.PROXY_FAILS, proxy)
+                for capability in CAPABILITIES:
+                    if capability in capabilities:
+                        pipe.zadd(self.PROXY_CAPS % capability, score, proxy)
+                    else:
+                        pipe.zrem(self.PROXY_CAPS % capability, proxy)
+                for level in ANONYMITY[1:]:
+                    if anonymity in ANONYMITY and ANONYMITY.index(anonymity) >= ANONYMITY.index(level):
+                        pipe.zadd(self.PROXY_ANON % level, score, proxy)
+                    else:
+                        pipe.zrem(self.PROXY_ANON % level, proxy)
+                for region in regions:
+                    pipe.zadd(self.PROXY_GEO % region, score, proxy)
+            elif result['source'] == 'check':
+                self.remove(proxy, pipe, regions)
+                fails = int(fetched[i * 3 + 2] or 0) + 1
+                if fails < self.quarantine_max_fails:
+                    # 可能只是偶尔超时，先隔离，按指数退避重试
+                    pipe.zadd(self.PROXY_QUARANTINE, self.retry_at(fails), proxy)
+                    pipe.hset(self.PROXY_FAILS, proxy, fails)
+                else:
+                    pipe.zrem(self.PROXY_QUARANTINE, proxy)
+                    pipe.hdel(self.PROXY_FAILS, proxy)
+                    pipe.zadd(self.PROXY_DEAD, now + self.dead_ttl, address(proxy))
+            else:
+                pipe.zadd(self.PROXY_DEAD, now + self.dead_ttl, address(proxy))
+        pipe.execute()
+        self.update_count()
+
+    def add(self, proxy, latency=None, capabilities=None):
+        self.apply([{'proxy': proxy, 'valid': True, 'latency': latency, 'source': 'fetch',
+            'capabilities': capabilities}])
+
+    def remove(self, proxy, pipe=None, regions=None):
+        ''' Take a proxy out of every live set, `regions` are the geo labels
+        it was indexed under, read from its stats when not given
+        '''
+        if regions is None:
+            regions = labels_of(geo_tags(self.redis_db.hgetall(self.PROXY_STATS % proxy)))
+        execute = pipe is None
+        if execute:
+            pipe = self.redis_db.pipeline()
+        pipe.srem(self.PROXY_SET, proxy)
+        pipe.zrem(self.PROXY_DUE, proxy)
+        pipe.zrem(self.PROXY_SCORE, proxy)
+        pipe.hdel(self.PROXY_STREAK, proxy)
+        for capability in CAPABILITIES:
+            pipe.zrem(self.PROXY_CAPS % capability, proxy)
+        for level in ANONYMITY[1:]:
+            pipe.zrem(self.PROXY_ANON % level, proxy)
+        for region in regions:
+            pipe.zrem(self.PROXY_GEO % region, proxy)
+        if execute:
+            pipe.execute()
+            self.update_count()
+
+    def passed(self, proxy, latency=None, capabilities=None):
+        ''' Keep a proxy that passed its check and push its next check back
+        '''
+        self.apply([{'proxy': proxy, 'valid': True, 'latency': latency, 'source': 'check',
+            'capabilities': capabilities}])
+
+    def failed(self, proxy):
+        self.apply([{'proxy': proxy, 'valid': False, 'latency': None, 'source': 'check'}])
+
+    def lookup(self, proxies):
+        ''' Triage a whole vendor page in one round-trip
+
+        Returns 'pool' for proxies already in the pool, 'quarantine' for ones
+        waiting for a retry, 'dead' for ones that failed validation less than
+        DEAD_TTL ago and None for new ones.
+        '''
+        pipe = self.redis_db.pipeline(transaction=False)
+        for proxy in proxies:
+            pipe.sismember(self.PROXY_SET, proxy)
+            pipe.zscore(self.PROXY_DEAD, address(proxy))
+            pipe.zscore(self.PROXY_QUARANTINE, proxy)
+        fetched = pipe.execute()
+        now = time.time()
+        states = []
+        for i in range(len(proxies)):
+            known, dead_until, quarantined = fetched[i * 3:i * 3 + 3]
+            if known:
+                states.append('pool')
+            elif quarantined is not None:
+                states.append('quarantine')
+            elif dead_until and dead_until > now:
+                states.append('dead')
+            else:
+                states.append(None)
+        return states
+
+    def vendor_skips(self, names):
+        ''' Timestamp until which each vendor's circuit breaker is open
+        '''
+        pipe = self.redis_db.pipeline(transaction=False)
+        for name in names:
+            pipe.hget(self.VENDOR_STATS % name, 'skip_until')
+        return [float(skip_until or 0) for skip_until in pipe.execute()]
+
+    def record_vendor_run(self, name, candidates, valid):
+        ''' Keep per-vendor yield stats, backing a vendor off exponentially
+        (VENDOR_BACKOFF up to VENDOR_BACKOFF_MAX) while its runs yield nothing
+        '''
+        metrics.VENDOR_CANDIDATES.inc(candidates, vendor=name)
+        metrics.VENDOR_VALID.inc(valid, vendor=name)
+        key = self.VENDOR_STATS % name
+        pipe = self.redis_db.pipeline()
+        pipe.hincrby(key, 'runs', 1)
+        pipe.hincrby(key, 'candidates', candidates)
+        pipe.hincrby(key, 'valid', valid)
+        pipe.hset(key, 'last_valid', valid)
+        pipe.hset(key, 'last_run', int(time.time()))
+        if valid:
+            pipe.hset(key, 'zero_runs', 0)
+            pipe.hset(key, 'skip_until', 0)
+            pipe.execute()
+            return
+        pipe.hincrby(key, 'zero_runs', 1)
+        zero_runs = pipe.execute()[-1]
+        backoff = min(self.vendor_backoff * 2 ** (zero_runs - 1), self.vendor_backoff_max)
+        self.redis_db.hset(key, 'skip_until', time.time() + backoff)
+        logger.info('代理源%s连续%s次没有有效代理，%s秒内不再抓取' % (name, zero_runs, backoff))
+
+    def stats(self, proxies):
+        ''' Stats hashes of `proxies` as str dicts, {} for unknown ones
+        '''
+        pipe = self.redis_db.pipeline(transaction=False)
+        for proxy in proxies:
+            pipe.hgetall(self.PROXY_STATS % proxy)
+        return [dict((k.decode('utf-8'), v.decode('utf-8')) for k, v in stats.items()) for stats in pipe.execute()]
+
+    def restore_stats(self, history):
+        ''' Write back {proxy: stats} saved by stats(), e.g. from a snapshot
+        '''
+        pipe = self.redis_db.pipeline(transaction=False)
+        for proxy, stats in history.items():
+            if not stats:
+                continue
+            pipe.hmset(self.PROXY_STATS % proxy, stats)
+            pipe.expire(self.PROXY_STATS % proxy, self.stats_ttl)
+        pipe.execute()
+
+    def purge_dead(self):
+        return self.redis_db.zremrangebyscore(self.PROXY_DEAD, '-inf', time.time())
+
+    def sample(self, n):
+        return [p.decode('utf-8') for p in self.redis_db.srandmember(self.PROXY_SET, n)]
+
+    def capability_for(self, url):
+        ''' Capability to pick proxies for a request to `url` by
+        '''
+        return 'https' if url.startswith('https://') and self.https_checked else 'http'
+
+    def snapshot(self, limit=500, capability=None, anonymity=None, domain=None, region=None):
+        ''' The `limit` best scored proxies as (proxy, score) pairs, only
+        those that passed `capability`, are at least as anonymous as
+        `anonymity`, aren't banned by `domain` and are located in `region`
+        (a country code, "country/region" or "AS<number>") if given
+
+        Without filters, falls back to SRANDMEMBER with equal scores while
+        nothing has been scored yet.
+        '''
+        banned = self.banned(domain) if domain else set()
+        ranked = self.ranked(limit + len(banned), capability, anonymity, region)
+        return [(p, score) for p, score in ranked if p not in banned][:limit]
+
+    def ranked(self, limit, capability=None, anonymity=None, region=None):
+        keys = []
+        if capability:
+            keys.append(self.PROXY_CAPS % capability)
+        if anonymity and anonymity != ANONYMITY[0]:
+            keys.append(self.PROXY_ANON % anonymity)
+        if region:
+            keys.append(self.PROXY_GEO % label(region))
+        if len(keys) > 1:
+            # 多个条件时临时求交集，分数沿用第一个集合里的
+            key = self.PROXY_SCORE + ':' + ':'.join(str(f) for f in (capability, anonymity, region) if f)
+            pipe = self.redis_db.pipeline()
+            pipe.zinterstore(key, dict((k, 1 if i == 0 else 0) for i, k in enumerate(keys)))
+            pipe.zrevrange(key, 0, limit - 1, withscores=True)
+            pipe.delete(key)
+            ranked = pipe.execute()[1]
+        else:
+            ranked = self.redis_db.zrevrange(keys[0] if keys else self.PROXY_SCORE, 0, limit - 1, withscores=True)
+        if not ranked and not keys:
+            return [(p, 1.0) for p in self.sample(limit)]
+        return [(p.decode('utf-8'), max(score, 1e-6)) for p, score in ranked]
+
+    def select(self, n=1, top=50, capability=None, anonymity=None, domain=None, region=None):
+        ''' Pick `n` distinct proxies among the `top` best scored ones,
+        e.g. select(capability='https', anonymity='elite') for https crawls
+        through elite proxies, select(domain='example.com') for proxies
+        example.com hasn't banned, select(region='CN/Guangdong') for ones
+        located there
+
+        Picks are weighted by score so that fast, healthy proxies get most of
+        the traffic without the single best one taking all of it.
+        '''
+        return weighted_sample(self.snapshot(top, capability, anonymity, domain, region), n)
+
+    def lease(self, top=50, capability=None, anonymity=None, domain=None, candidates=None, ttl=None, region=None):
+        ''' Check out a proxy for exclusive-ish use, returns (proxy, lease_id)
+        or None when every candidate is at its concurrency or rate cap
+
+        LEASE_CANDIDATES candidates are drawn score-weighted from the `top`
+        best matching proxies, or from `candidates` if given, and the one
+        script call takes the least leased of them that has room. Hand the
+        lease back with release(), leases not released lapse after `ttl`
+        (LEASE_TTL) seconds.
+        '''
+        if candidates is None:
+            ranked = self.snapshot(top, capability, anonymity, domain, region)
+        else:
+            ranked = [(proxy, 1.0) for proxy in candidates]
+        picked = weighted_sample(ranked, self.lease_candidates)
+        if not picked:
+            return None
+        ttl = ttl or self.lease_ttl
+        now = time.time()
+        lease_id = uuid.uuid4().hex
+        keys = []
+        for proxy in picked:
+            keys.append(self.PROXY_LEASES % proxy)
+            keys.append(self.PROXY_RATE % (proxy, int(now)))
+        index = self.lease_script(keys=keys, args=[now, now + ttl, lease_id,
+            self.lease_max_concurrency or UNLIMITED, self.lease_max_rps or UNLIMITED, int(ttl) + 1])
+        if not index:
+            return None
+        return picked[int(index) - 1], lease_id
+
+    def release(self, proxy, lease_id):
+        self.redis_db.zrem(self.PROXY_LEASES % proxy, lease_id)
+
+    def report_domain(self, domain, outcomes):
+        ''' Outcomes of requests to `domain` through pool proxies, as
+        (proxy, ok) pairs in the order they happened, in two round-trips
+
+        A failure adds 1 to the proxy's decayed penalty for the domain, a
+        success halves it and lifts any ban. Returns the proxies banned now.
+        '''
+        outcomes = list(outcomes)
+        if not outcomes:
+            return []
+        domain = domain_of(domain)
+        key = self.PROXY_DOMAIN % domain
+        proxies = list(dict.fromkeys(proxy for proxy, _ in outcomes))
+        now = time.time()
+        penalties = {}
+        for proxy, value in zip(proxies, self.redis_db.hmget(key, proxies)):
+            penalty, at = value.decode('utf-8').split(':') if value else (0, now)
+            # 按存的精度取整，不然几秒内连着失败几次也会因为一点点衰减够不到阈值
+            penalties[proxy] = round(float(penalty) * 0.5 ** ((now - float(at)) / self.domain_half_life), 3)
+        banned = set()
+        ok_proxies = set()
+        for proxy, ok in outcomes:
+            if ok:
+                penalties[proxy] *= 0.5
+                ok_proxies.add(proxy)
+                banned.discard(proxy)
+            else:
+                penalties[proxy] += 1
+                if penalties[proxy] >= self.domain_ban_threshold:
+                    banned.add(proxy)
+                    ok_proxies.discard(proxy)
+        pipe = self.redis_db.pipeline()
+        pipe.hmset(key, dict((proxy, '%.3f:%.3f' % (penalty, now)) for proxy, penalty in penalties.items()))
+        pipe.expire(key, self.domain_ttl)
+        bans = self.PROXY_BANS % domain
+        for proxy in banned:
+            pipe.zadd(bans, now + self.domain_ban_ttl, proxy)
+        if ok_proxies:
+            pipe.zrem(bans, *ok_proxies)
+        if banned:
+            pipe.expire(bans, self.domain_ban_ttl)
+        pipe.execute()
+        if banned:
+            logger.info('%s屏蔽了%s个代理' % (domain, len(banned)))
+        return sorted(banned)
+
+    def banned(self, domain):
+        ''' Proxies currently banned by `domain`
+        '''
+        bans = self.PROXY_BANS % domain_of(domain)
+        now = time.time()
+        pipe = self.redis_db.pipeline(transaction=False)
+        pipe.zremrangebyscore(bans, '-inf', now)
+        pipe.zrange(bans, 0, -1)
+        return set(p.decode('utf-8') for p in pipe.execute()[1])
+
+    def report_failures(self, proxies):
+        ''' Failures seen by consumers of the pool
+
+        Each one dents the proxy's score and pulls its next check forward to
+        now, the checker then decides whether it stays. Proxies that already
+        left the pool are only recorded in their stats.
+        '''
+        proxies = list(proxies)
+        if not proxies:
+            return
+        pipe = self.redis_db.pipeline(transaction=False)
+        for proxy in proxies:
+            pipe.hgetall(self.PROXY_STATS % proxy)
+            pipe.sismember(self.PROXY_SET, proxy)
+        fetched = pipe.execute()
+        now = time.time()
+        pipe = self.redis_db.pipeline()
+        for i, proxy in enumerate(proxies):
+            stats, score = self.fold(fetched[i * 2], False)
+            pipe.hmset(self.PROXY_STATS % proxy, stats)
+            pipe.expire(self.PROXY_STATS % proxy, self.stats_ttl)
+            if fetched[i * 2 + 1]:
+                pipe.zadd(self.PROXY_SCORE, score, proxy)
+                pipe.zadd(self.PROXY_DUE, now, proxy)
+                for capability in (fetched[i * 2] or {}).get(b'caps', b'').decode('utf-8').split(','):
+                    if capability:
+                        pipe.zadd(self.PROXY_CAPS % capability, score, proxy)
+                anonymity = (fetched[i * 2] or {}).get(b'anonymity', b'').decode('utf-8')
+                if anonymity in ANONYMITY:
+                    for level in ANONYMITY[1:ANONYMITY.index(anonymity) + 1]:
+                        pipe.zadd(self.PROXY_ANON % level, score, proxy)
+                for region in labels_of(geo_tags(fetched[i * 2])):
+                    pipe.zadd(self.PROXY_GEO % region, score, proxy)
+        pipe.execute()
+
+    def sync_schedule(self):
+        ''' Schedule proxies added to PROXY_SET by older versions (or by hand)
+        and forget schedules of proxies no longer in the pool
+        '''
+        if self.redis_db.zcard(self.PROXY_DUE) == self.redis_db.scard(self.PROXY_SET):
+            return
+        self.sync_script(keys=[self.PROXY_SET, self.PROXY_DUE], args=[time.time()])
+
+    def claim_due(self, limit=None):
+        ''' Lease up to `limit` proxies whose check is due
+
+        Claimed proxies are pushed CHECK_LEASE ahead in one atomic script, so
+        neither the next tick nor another node picks them again before their
+        check comes back, checkin reschedules them properly. If the claiming
+        node dies, they simply fall due again when the lease runs out.
+        '''
+        limit = limit or self.check_batch
+        now = time.time()
+        due = self.claim_script(keys=[self.PROXY_DUE], args=[now, limit, now + self.check_lease])
+        return [p.decode('utf-8') for p in due]
+
+    def claim_quarantined(self, limit=None):
+        ''' Lease up to `limit` quarantined proxies due for a retry, the same
+        way claim_due does. Their check result promotes or drops them
+        '''
+        limit = limit or self.check_batch
+        now = time.time()
+        due = self.claim_script(keys=[self.PROXY_QUARANTINE], args=[now, limit, now + self.check_lease])
+        return [p.decode('utf-8') for p in due]
+
+    def quarantined(self):
+        return self.redis_db.zcard(self.PROXY_QUARANTINE)
+
+    def lead(self, node, ttl):
+        ''' Take or keep the refill leadership for `ttl` seconds, return
+        whether `node` is the leader
+        '''
+        px = int(ttl * 1000)
+        if self.redis_db.set(self.PROXY_LEADER, node, px=px, nx=True):
+            return True
+        return bool(self.renew_script(keys=[self.PROXY_LEADER], args=[node, px]))
+
+    def resign(self, node):
+        self.resign_script(keys=[self.PROXY_LEADER], args=[node])
+
+    def leader(self):
+        leader = self.redis_db.get(self.PROXY_LEADER)
+        return leader.decode('utf-8') if leader else None
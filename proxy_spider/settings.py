@@ -54,6 +54,7 @@ ROBOTSTXT_OBEY = False
 # See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html
 DOWNLOADER_MIDDLEWARES = {
    'proxy_spider.middlewares.ProxyPoolDownloaderMiddleware': 542,
+   'proxy_spider.middlewares.ValidatorMiddleware': 545,
    'scrapy.downloadermiddlewares.retry.RetryMiddleware': 351,
    'proxy_spider.middlewares.ProxyPoolUserAgentMiddleware': 543,
 }
@@ -71,9 +72,12 @@ DUPEFILTER_DEBUG = True
 
 # Configure item pipelines
 # See http://scrapy.readthedocs.org/en/latest/topics/item-pipeline.html
-#ITEM_PIPELINES = {
-#    'proxy_spider.pipelines.SomePipeline': 300,
-#}
+ITEM_PIPELINES = {
+   'proxy_spider.pipelines.ProxyPoolPipeline': 300,
+}
+# 验证结果攒够POOL_FLUSH_SIZE条或每隔POOL_FLUSH_INTERVAL秒批量写一次redis
+POOL_FLUSH_SIZE = 100
+POOL_FLUSH_INTERVAL = 1.0
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See http://doc.scrapy.org/en/latest/topics/autothrottle.html
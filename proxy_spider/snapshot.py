@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+''' On-disk snapshots of the pool for warm starts
+
+A snapshot is a gzipped JSON-lines file: a header object, then one
+[proxy, score, stats] row per live proxy, best score first, where stats is
+the proxy's PROXY_STATS hash (latency/success EWMAs, checks, last seen,
+capabilities, anonymity, geo tags). It is rewritten whole every SNAPSHOT_INTERVAL
+through a temp file and a rename, so a crash never leaves a torn snapshot.
+
+Restoring writes the history back and revalidates the proxies best-first in
+WARM_START_BATCH batches with the asyncio engine, so the best part of the
+old pool is back within a few seconds instead of after a full vendor crawl.
+
+    python -m proxy_spider.snapshot dump|restore [--mode test] [--path FILE]
+'''
+import os
+import json
+import gzip
+import time
+import argparse
+import logging
+
+from proxy_spider.utils import load_config, connect_redis, load_validators
+from proxy_spider.pool import ProxyPool
+from proxy_spider import aiocheck
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+CHUNK = 1000
+
+def dump(pool, path):
+    ''' Write the pool to `path`, return the number of proxies saved
+    '''
+    scores = dict(pool.snapshot(max(pool.count(), 1)))
+    ranked = sorted(((proxy, scores.get(proxy, 0.0)) for proxy in pool.members()),
+        key=lambda pair: pair[1], reverse=True)
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = '%s.tmp' % path
+    with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+        f.write(json.dumps({'version': VERSION, 'created': int(time.time()), 'count': len(ranked)}) + '\n')
+        for i in range(0, len(ranked), CHUNK):
+            chunk = ranked[i:i + CHUNK]
+            for (proxy, score), stats in zip(chunk, pool.stats([proxy for proxy, _ in chunk])):
+                f.write(json.dumps([proxy, score, stats]) + '\n')
+    os.replace(tmp, path)
+    logger.info('代理池快照已保存到%s，共%s个代理' % (path, len(ranked)))
+    return len(ranked)
+
+def load(path, max_age=None):
+    ''' (proxy, score, stats) rows of a snapshot, best score first, leaving
+    out proxies not seen for `max_age` seconds
+    '''
+    rows = []
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        if header.get('version') != VERSION:
+            raise ValueError('unsupported snapshot version %s' % header.get('version'))
+        for line in f:
+            proxy, score, stats = json.loads(line)
+            if max_age and time.time() - int(stats.get('seen', 0)) > max_age:
+                continue
+            rows.append((proxy, score, stats))
+    rows.sort(key=lambda row: row[1], reverse=True)
+    return rows
+
+def restore(pool, path, validator_pool, config):
+    ''' Refill an empty pool from a snapshot, blocking, meant for a worker
+    thread. Returns the number of proxies back in the pool
+    '''
+    if not os.path.exists(path):
+        logger.info('没有找到代理池快照%s，冷启动' % path)
+        return 0
+    rows = load(path, max_age=pool.stats_ttl)
+    logger.info('从快照%s恢复%s个代理的历史记录，按分数从高到低重新验证...' % (path, len(rows)))
+    pool.restore_stats(dict((proxy, stats) for proxy, _, stats in rows))
+    batch = config.get('WARM_START_BATCH', 200)
+    started = time.time()
+    for i in range(0, len(rows), batch):
+        proxies = [proxy for proxy, _, _ in rows[i:i + batch]]
+        results = aiocheck.check_and_apply(pool, proxies, validator_pool, config, 'fetch')
+        logger.info('快照恢复：已验证%s/%s个代理，本批有效%s个，用时%.1f秒，代理池现有%s个代理' % (
+            i + len(proxies), len(rows), sum(r.valid for r in results), time.time() - started, pool.count()))
+    return pool.count()
+
+def main():
+    parser = argparse.ArgumentParser(description='hq-proxies pool snapshots')
+    parser.add_argument('action', choices=['dump', 'restore'])
+    parser.add_argument('--mode', default='prod', choices=['prod', 'test'])
+    parser.add_argument('--path', default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelno)s/%(lineno)d: %(message)s')
+    config = load_config(args.mode)
+    pool = ProxyPool(connect_redis(config), config)
+    path = args.path or config['SNAPSHOT_PATH']
+    if args.action == 'dump':
+        dump(pool, path)
+    else:
+        restore(pool, path, load_validators(config), config)
+
+if __name__ == '__main__':
+    main()
@@ -3,71 +3,188 @@
 import json
 import time
 from datetime import datetime
-from redis import StrictRedis
-import re
-import random
 import requests
-import yaml
-from scrapy import Spider, Request
+from urllib.parse import urlsplit
+from scrapy import Spider, Request, signals
 from scrapy.http import HtmlResponse
+from scrapy.exceptions import DontCloseSpider
+from twisted.internet import reactor, defer, threads
+from twisted.internet.protocol import Protocol
+from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
 from collections import defaultdict
 
+from proxy_spider.utils import load_config, connect_redis, load_validators, sampled
+from proxy_spider.pool import ProxyPool, base_capability
+from proxy_spider.items import ProxyItem
+from proxy_spider import aiocheck, echo, vendors
+
 import logging
 from logging.handlers import RotatingFileHandler
 
 logger = logging.getLogger(__name__)
 
+def vendor_name(vendor):
+    return vendor.get('name') or vendor.get('parser') or vendor['url']
+
+def spider_own_ips(echo_validators, config):
+    ''' Egress ips for `scrapy crawl`, which builds the spider before the
+    reactor runs; the scheduler resolves them in a thread instead
+    '''
+    return echo.own_ips(echo_validators, config.get('ECHO_OWN_IPS') or []) if echo_validators else set()
+
+def validation_request(validators, capability, meta, callback, errback, exclude=()):
+    ''' Request checking meta['proxy'] against the next validator of
+    `capability`, other than the urls in `exclude`. The validator only
+    counts as busy while the request downloads, see ValidatorMiddleware
+    '''
+    validator = validators.pick(capability, exclude, hold=False)
+    meta = dict(meta, startstring=validator.startstring, validator=validator.url)
+    return Request(url=validator.url, meta=meta, callback=callback, errback=errback, dont_filter=True)
+
+def https_request(response, validators, callback, errback):
+    ''' Follow a passed plain-http check with a CONNECT check of the same
+    proxy against an https validator, carrying the first check's result
+    '''
+    meta = {'proxy': response.meta['proxy'], 'capability': 'https',
+        'base_latency': response.meta.get('download_latency'), 'base_validator': response.meta.get('validator'),
+        'base_anonymity': response.meta.get('anonymity'), 'handle_httpstatus_all': True}
+    if 'vendor' in response.meta:
+        meta['vendor'] = response.meta['vendor']
+    return validation_request(validators, 'https', meta, callback, errback)
+
+def tcp_probe(proxy, timeout):
+    ''' Deferred firing with whether the proxy accepts a bare TCP connection
+    within `timeout`, None when we ran out of sockets ourselves
+    '''
+    target = urlsplit(proxy)
+    endpoint = TCP4ClientEndpoint(reactor, target.hostname, target.port or 80, timeout=timeout)
+    return connectProtocol(endpoint, Probe()).addCallbacks(hang_up, probe_failed)
+
+class Probe(Protocol):
+    def __init__(self):
+        self.closed = defer.Deferred()
+
+    def connectionLost(self, reason):
+        self.closed.callback(True)
+
+def hang_up(protocol):
+    # 等连接真正关掉再放下一个预检，否则文件描述符会越攒越多
+    protocol.transport.abortConnection()
+    return protocol.closed
+
+def probe_failed(failure):
+    return None if aiocheck.local_error(failure.value) else False
+
+def socks_failed(failure):
+    logger.error('socks5代理验证出错: %s' % failure.getErrorMessage())
+
+def passed(response):
+    return 'startstring' in response.meta and response.body_as_unicode().startswith(response.meta['startstring'])
+
+def https_failed(meta, source):
+    ''' Result of a proxy whose https check failed, it still passed http
+    '''
+    return ProxyItem(proxy=meta['proxy'], valid=True, latency=meta['base_latency'], source=source,
+        validator=meta['base_validator'], capabilities=['http'], anonymity=meta['base_anonymity'])
+
 class ProxyCheckSpider(Spider):
     ''' Spider to crawl free proxy servers for intern
     '''
     name = 'proxy_check'
     
-    def __init__(self, mode='prod', *args, **kwargs):
-        if mode == 'prod':            
-            LOCAL_CONFIG_YAML = '/etc/hq-proxies.yml'
-        elif mode == 'test':
-            LOCAL_CONFIG_YAML = '/etc/hq-proxies.test.yml'
-        with open(LOCAL_CONFIG_YAML, 'r') as f:
-            LOCAL_CONFIG = yaml.load(f)
-        
-        self.redis_db = StrictRedis(
-            host=LOCAL_CONFIG['REDIS_HOST'], 
-            port=LOCAL_CONFIG['REDIS_PORT'], 
-            password=LOCAL_CONFIG['REDIS_PASSWORD'],
-            db=LOCAL_CONFIG['REDIS_DB']
-        )
-        
-        self.validator_pool = set([])
-        for validator in LOCAL_CONFIG['PROXY_VALIDATORS']:
-            self.validator_pool.add((validator['url'], validator['startstring']))
+    def __init__(self, mode='prod', config=None, redis_db=None, validator_pool=None, own_ips=None, *args, **kwargs):
+        # config/redis_db/validator_pool/own_ips are handed over by the scheduler in start.py
+        # so that repeated runs reuse them; `scrapy crawl` loads them from the yaml
+        LOCAL_CONFIG = config or load_config(mode)
+        self.redis_db = redis_db or connect_redis(LOCAL_CONFIG)
+        self.validator_pool = validator_pool or load_validators(LOCAL_CONFIG)
         self.PROXY_COUNT = LOCAL_CONFIG['PROXY_COUNT']
         self.PROXY_SET = LOCAL_CONFIG['PROXY_SET']
+        self.pool = ProxyPool(self.redis_db, LOCAL_CONFIG)
+        self.config = LOCAL_CONFIG
+        # scrapy不支持socks5代理，socks5代理交给asyncio引擎在线程里验证
+        # 配置了echo验证页时用它做http验证，顺便判断匿名度
+        self.echo_validators = self.validator_pool.echo
+        self.own_ips = own_ips if own_ips is not None else spider_own_ips(self.echo_validators, LOCAL_CONFIG)
+        self.http_validators = self.echo_validators or self.validator_pool
+        self.https_validators = self.validator_pool if self.validator_pool.available('https') else None
+        self.socks_check = None
+        # 复检时一个代理要在几个不同的验证页上失败才删除
+        self.quorum = LOCAL_CONFIG.get('VALIDATOR_QUORUM', 2)
+        # full: 每轮验证全部代理  rolling: 每轮只验证到期的一批
+        self.check_mode = LOCAL_CONFIG.get('CHECK_MODE', 'full')
+        # 逐个代理的日志按比例抽样输出
+        self.log_sample = LOCAL_CONFIG.get('LOG_SAMPLE_RATE', 0.01)
         
     def start_requests(self):
 
         logger.info('测试代理池内代理质量...')
-        self.redis_db.set(self.PROXY_COUNT, self.redis_db.scard(self.PROXY_SET))
-        for proxy in self.redis_db.smembers(self.PROXY_SET):
-            proxy = proxy.decode('utf-8')
-            vaurl, vastart = random.choice(list(self.validator_pool))
-            yield Request(url=vaurl, meta={'proxy': proxy, 'startstring': vastart}, callback=self.checkin, dont_filter=True)
+        self.redis_db.set(self.PROXY_COUNT, self.pool.count())
+        if self.check_mode == 'rolling':
+            self.pool.sync_schedule()
+            proxies = self.pool.claim_due()
+            logger.info('本轮到期待检测代理数: %s' % len(proxies))
+        else:
+            proxies = self.pool.members()
+        # 隔离区里到期的代理一起重试，通过了就回到代理池
+        proxies += self.pool.claim_quarantined()
+        socks = [proxy for proxy in proxies if base_capability(proxy) == 'socks5']
+        if socks:
+            self.socks_check = threads.deferToThread(aiocheck.check_and_apply,
+                self.pool, socks, self.validator_pool, self.config, 'check')
+        for proxy in proxies:
+            if base_capability(proxy) == 'socks5':
+                continue
+            yield validation_request(self.http_validators, 'http', {'proxy': proxy}, self.checkin, self.check_failed)
     
     def checkin(self, response):
-        res = response.body_as_unicode()
-        if 'startstring' in response.meta and res.startswith(response.meta['startstring']):
+        if passed(response):
             proxy = response.meta['proxy']
-            self.redis_db.sadd(self.PROXY_SET, proxy)
-            logger.info('可用代理+1  %s' % proxy)
-            yield None
+            anonymity = response.meta['anonymity'] = echo.classify(response.body_as_unicode(), self.own_ips)
+            if sampled(self.log_sample):
+                logger.debug('可用代理+1  %s %s' % (proxy, anonymity or ''))
+            if self.https_validators:
+                yield https_request(response, self.https_validators, self.checkin_https, self.check_failed)
+                return
+            yield ProxyItem(proxy=proxy, valid=True, latency=response.meta.get('download_latency'),
+                source='check', validator=response.meta.get('validator'), anonymity=anonymity)
         else:
-            proxy = response.url if 'proxy' not in response.meta else response.meta['proxy']
-            self.redis_db.srem(self.PROXY_SET, proxy)
-            logger.info('无效代理  %s' % proxy)
-            yield None
+            yield from self.invalid(response.meta)
+
+    def invalid(self, meta):
+        proxy = meta['proxy']
+        # 换一个验证页再试，几个验证页上都失败才算失效，免得验证页出问题时误删好代理
+        tried = meta.get('tried', []) + [meta.get('validator')]
+        if len(tried) < self.quorum and self.http_validators.available('http', tried):
+            yield validation_request(self.http_validators, 'http', {'proxy': proxy, 'tried': tried},
+                self.checkin, self.check_failed, tried)
+            return
+        if sampled(self.log_sample):
+            logger.debug('无效代理  %s' % proxy)
+        yield ProxyItem(proxy=proxy, valid=False, source='check', validator=meta.get('validator'))
+    
+    def checkin_https(self, response):
+        capabilities = ['http', 'https'] if passed(response) else ['http']
+        yield ProxyItem(proxy=response.meta['proxy'], valid=True, latency=response.meta['base_latency'],
+            source='check', validator=response.meta['base_validator'], capabilities=capabilities,
+            anonymity=response.meta['base_anonymity'])
+    
+    def check_failed(self, failure):
+        # 没被middleware转成响应的异常（代理返回407/503之类的HttpError、连接中断等）也是验证失败
+        meta = failure.request.meta
+        if meta.get('capability') == 'https':
+            yield https_failed(meta, 'check')
+        else:
+            yield from self.invalid(meta)
     
     def closed(self, reason):
+        # 返回deferred，scrapy会等socks5代理验证完再结束
+        d = self.socks_check or defer.succeed(None)
+        return d.addErrback(socks_failed).addCallback(self.finished)
+    
+    def finished(self, _):
         pcount = self.redis_db.scard(self.PROXY_SET)
-        logger.info('代理池测试完成，有效代理数: %s' % pcount)
+        logger.info('代理池测试完成，有效代理数: %s，隔离区代理数: %s' % (pcount, self.pool.quarantined()))
         self.redis_db.set(self.PROXY_COUNT, pcount)
 
 class ProxyFetchSpider(Spider):
@@ -75,147 +192,209 @@ class ProxyFetchSpider(Spider):
     loop_delay = 10
     protect_sec = 180
     
-    def __init__(self, mode='prod', *args, **kwargs):
-        if mode == 'prod':            
-            LOCAL_CONFIG_YAML = '/etc/hq-proxies.yml'
-        elif mode == 'test':
-            LOCAL_CONFIG_YAML = '/etc/hq-proxies.test.yml'
-        with open(LOCAL_CONFIG_YAML, 'r') as f:
-            LOCAL_CONFIG = yaml.load(f)
-        
-        self.redis_db = StrictRedis(
-            host=LOCAL_CONFIG['REDIS_HOST'], 
-            port=LOCAL_CONFIG['REDIS_PORT'], 
-            password=LOCAL_CONFIG['REDIS_PASSWORD'],
-            db=LOCAL_CONFIG['REDIS_DB']
-        )
+    def __init__(self, mode='prod', config=None, redis_db=None, validator_pool=None, own_ips=None, *args, **kwargs):
+        LOCAL_CONFIG = config or load_config(mode)
+        self.redis_db = redis_db or connect_redis(LOCAL_CONFIG)
+        self.validator_pool = validator_pool or load_validators(LOCAL_CONFIG)
         self.PROXY_COUNT = LOCAL_CONFIG['PROXY_COUNT']
         self.PROXY_SET = LOCAL_CONFIG['PROXY_SET']
-
-        self.validator_pool = set([])
-        for validator in LOCAL_CONFIG['PROXY_VALIDATORS']:
-            self.validator_pool.add((validator['url'], validator['startstring']))
+        self.pool = ProxyPool(self.redis_db, LOCAL_CONFIG)
+        self.config = LOCAL_CONFIG
+        # 配置了echo验证页时用它做http验证，顺便判断匿名度
+        self.echo_validators = self.validator_pool.echo
+        self.own_ips = own_ips if own_ips is not None else spider_own_ips(self.echo_validators, LOCAL_CONFIG)
+        self.http_validators = self.echo_validators or self.validator_pool
+        self.https_validators = self.validator_pool if self.validator_pool.available('https') else None
+        self.socks_checks = []
         
         self.vendors = LOCAL_CONFIG['PROXY_VENDORS']
+        # 代理源页面的下载超时，单个代理源和整轮抓取的截止时间（秒）
+        self.vendor_timeout = LOCAL_CONFIG.get('VENDOR_TIMEOUT', 10)
+        self.vendor_deadline = LOCAL_CONFIG.get('VENDOR_DEADLINE', 30)
+        self.fetch_deadline = LOCAL_CONFIG.get('FETCH_DEADLINE', 60)
+        self.deadlines = {}
+        self.yields = {}
+        self.parsers = {}
+        # 候选代理按页批量做TCP预检，连不上的不再占着下载槽等DOWNLOAD_TIMEOUT
+        self.precheck = LOCAL_CONFIG.get('PRECHECK_TIMEOUT', 1)
+        self.precheck_concurrency = LOCAL_CONFIG.get('PRECHECK_CONCURRENCY', 500)
+        self.probes = None
+        self.prechecks = set()
+        self.closing = False
+        self.deadline_call = None
+        self.log_sample = LOCAL_CONFIG.get('LOG_SAMPLE_RATE', 0.01)
     
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(ProxyFetchSpider, cls).from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.idle, signal=signals.spider_idle)
+        # 预检连接和下载器的连接加起来不能超过打开文件数上限
+        _, concurrency = aiocheck.fit_fds(crawler.settings.getint('CONCURRENT_REQUESTS'), spider.precheck_concurrency)
+        spider.probes = defer.DeferredSemaphore(concurrency)
+        return spider
+
+    def idle(self, spider):
+        # 还有代理页在做预检，预检完才会发出验证请求
+        if self.prechecks:
+            raise DontCloseSpider
+
     def start_requests(self):
-        for vendor in self.vendors:
+        self.pool.purge_dead()
+        self.deadline_call = reactor.callLater(self.fetch_deadline, self.stop_fetch)
+        now = time.time()
+        names = [vendor_name(vendor) for vendor in self.vendors]
+        skips = self.pool.vendor_skips(names)
+        for vendor, name, skip_until in zip(self.vendors, names, skips):
+            if skip_until > now:
+                logger.info('代理源%s近期没有产出有效代理，%d秒内跳过' % (name, skip_until - now))
+                continue
             logger.debug(vendor)
-            callback = getattr(self, vendor['parser'])
-            yield Request(url=vendor['url'], callback=callback)
+            self.yields[name] = {'candidates': 0, 'valid': 0}
+            self.deadlines[name] = now + vendor.get('deadline', self.vendor_deadline)
+            self.parsers[name] = vendors.compile_vendor(vendor)
+            # 分页一次性全部发出去，不再一页页串行爬
+            for url in self.parsers[name].urls:
+                yield Request(url=url, callback=self.parse_vendor, errback=self.vendor_failed, dont_filter=True,
+                    meta={'vendor': name, 'download_timeout': vendor.get('timeout', self.vendor_timeout)})
+    
+    def vendor_failed(self, failure):
+        logger.info('代理源%s访问失败: %s' % (failure.request.meta['vendor'], failure.request.url))
+    
+    def stop_fetch(self):
+        logger.info('抓取超过%s秒，提前结束本轮抓取' % self.fetch_deadline)
+        self.crawler.engine.close_spider(self, 'deadline')
     
     def checkin(self, response):
-        res = response.body_as_unicode()
-        if 'startstring' in response.meta and res.startswith(response.meta['startstring']):
+        if passed(response):
             proxy = response.meta['proxy']
-            self.redis_db.sadd(self.PROXY_SET, proxy)
-            logger.info('可用代理+1  %s' % proxy)
-            yield None
+            anonymity = response.meta['anonymity'] = echo.classify(response.body_as_unicode(), self.own_ips)
+            if sampled(self.log_sample):
+                logger.debug('可用代理+1  %s %s' % (proxy, anonymity or ''))
+            self.yields[response.meta['vendor']]['valid'] += 1
+            if self.https_validators:
+                yield https_request(response, self.https_validators, self.checkin_https, self.check_failed)
+                return
+            yield ProxyItem(proxy=proxy, valid=True, latency=response.meta.get('download_latency'),
+                source='fetch', validator=response.meta.get('validator'), anonymity=anonymity)
         else:
             proxy = response.url if 'proxy' not in response.meta else response.meta['proxy']
-            logger.info('无效代理  %s' % proxy)
-            yield None
+            if sampled(self.log_sample):
+                logger.debug('无效代理  %s' % proxy)
+            yield ProxyItem(proxy=proxy, valid=False, source='fetch', validator=response.meta.get('validator'))
     
-    def parse_xici(self, response):
-        ''' 
-        @url http://www.xicidaili.com/nn/
-        '''
-        logger.info('解析http://www.xicidaili.com/nn/')
-        succ = 0
-        fail = 0
-        count = 0
-        for tr in response.css('#ip_list tr'):
-            td_list = tr.css('td::text')
-            if len(td_list) < 3:
-                continue
-            ipaddr = td_list[0].extract()
-            port = td_list[1].extract()
-            proto = td_list[5].extract()
-            latency = tr.css('div.bar::attr(title)').extract_first()
-            latency = re.match('(\d+\.\d+)秒', latency).group(1)
-            proxy = '%s://%s:%s' % (proto, ipaddr, port)
-            proxies = {proto: '%s:%s' % (ipaddr, port)}
-            if float(latency) > 3:
-                logger.info('丢弃慢速代理: %s 延迟%s秒' % (proxy, latency))
-                continue
-            logger.info('验证: %s' % proxy)
-            if not self.redis_db.sismember(self.PROXY_SET, proxy):
-                vaurl, vastart = random.choice(list(self.validator_pool))
-                yield Request(url=vaurl, meta={'proxy': proxy, 'startstring': vastart}, callback=self.checkin, dont_filter=True)
-            else:
-                logger.info('该代理已收录..')
+    def checkin_https(self, response):
+        capabilities = ['http', 'https'] if passed(response) else ['http']
+        yield ProxyItem(proxy=response.meta['proxy'], valid=True, latency=response.meta['base_latency'],
+            source='fetch', validator=response.meta['base_validator'], capabilities=capabilities,
+            anonymity=response.meta['base_anonymity'])
     
-    def parse_66ip(self, response):
-        ''' 
-        @url http://www.66ip.cn/nmtq.php?getnum=100&isp=0&anonymoustype=3&start=&ports=&export=&ipaddress=&area=1&proxytype=0&api=66ip
-        '''
-        logger.info('开始爬取66ip')
-        if 'proxy' in response.meta:
-            logger.info('=>使用代理%s' % response.meta['proxy'])
-        res = response.body_as_unicode()
-        for addr in re.findall('\d+\.\d+\.\d+\.\d+\:\d+', res):
-            proxy = 'http://' + addr
-            print(proxy)
-            logger.info('验证: %s' % proxy)
-            if not self.redis_db.sismember(self.PROXY_SET, proxy):
-                vaurl, vastart = random.choice(list(self.validator_pool))
-                yield Request(url=vaurl, meta={'proxy': proxy, 'startstring': vastart}, callback=self.checkin, dont_filter=True)
-            else:
-                logger.info('该代理已收录..')
+    def check_failed(self, failure):
+        meta = failure.request.meta
+        if meta.get('capability') == 'https':
+            yield https_failed(meta, 'fetch')
+        else:
+            yield ProxyItem(proxy=meta['proxy'], valid=False, source='fetch', validator=meta.get('validator'))
+    
+    def socks_checked(self, results, vendor):
+        self.yields[vendor]['valid'] += sum(r.valid for r in results)
     
-    def parse_ip181(self, response):
-        ''' 
-        @url http://www.ip181.com/
+    def validate(self, response, candidates):
+        ''' Request validation for the candidates of one vendor page,
+        checking the whole page against the pool and the recently-failed
+        cache in a single round-trip. With PRECHECK_TIMEOUT the page's http
+        candidates are TCP probed all at once first, see precheck_page
         '''
-        logger.info('开始爬取ip181')
-        if 'proxy' in response.meta:
-            logger.info('=>使用代理%s' % response.meta['proxy'])
-        for tr in response.css('table tbody tr'):
-            ip = tr.css('td::text').extract()[0]
-            port = tr.css('td::text').extract()[1]
-            type = tr.css('td::text').extract()[2]
-            proxy = 'http://%s:%s' % (ip, port)
-            if type != '高匿':
-                logger.info('丢弃非高匿代理：%s' % proxy)
-                continue
-            logger.info('验证: %s' % proxy)
-            if not self.redis_db.sismember(self.PROXY_SET, proxy):
-                vaurl, vastart = random.choice(list(self.validator_pool))
-                yield Request(url=vaurl, meta={'proxy': proxy, 'startstring': vastart}, callback=self.checkin, dont_filter=True)
+        vendor = response.meta['vendor']
+        if time.time() > self.deadlines[vendor]:
+            logger.info('代理源%s超过截止时间，丢弃%s个候选代理' % (vendor, len(candidates)))
+            return
+        candidates = list(dict.fromkeys(candidates))
+        self.yields[vendor]['candidates'] += len(candidates)
+        socks = []
+        fresh = []
+        for proxy, state in zip(candidates, self.pool.lookup(candidates)):
+            if state == 'pool':
+                # 已在池里的代理也算这个代理源的有效产出
+                self.yields[vendor]['valid'] += 1
+                if sampled(self.log_sample):
+                    logger.debug('该代理已收录..  %s' % proxy)
+            elif state == 'dead':
+                if sampled(self.log_sample):
+                    logger.debug('该代理近期验证失败过，跳过..  %s' % proxy)
+            elif state == 'quarantine':
+                if sampled(self.log_sample):
+                    logger.debug('该代理在隔离区等待重试，跳过..  %s' % proxy)
+            elif base_capability(proxy) == 'socks5':
+                socks.append(proxy)
             else:
-                logger.info('该代理已收录..')
+                fresh.append(proxy)
+        if fresh and self.precheck:
+            self.precheck_page(fresh, vendor)
+        else:
+            for proxy in fresh:
+                yield self.validation(proxy, vendor)
+        if socks:
+            d = threads.deferToThread(aiocheck.check_and_apply, self.pool, socks, self.validator_pool, self.config, 'fetch')
+            self.socks_checks.append(d.addCallback(self.socks_checked, vendor).addErrback(socks_failed))
     
-    def parse_kxdaili(self, response):
-        ''' 
-        @url http://www.kxdaili.com/dailiip/1/1.html#ip
+    def validation(self, proxy, vendor):
+        if sampled(self.log_sample):
+            logger.debug('验证: %s' % proxy)
+        return validation_request(self.http_validators, 'http', {'proxy': proxy, 'vendor': vendor},
+            self.checkin, self.check_failed)
+
+    def precheck_page(self, proxies, vendor):
+        ''' Probe a page of candidates concurrently (up to PRECHECK_CONCURRENCY
+        connects in flight over all pages), then queue validation requests
+        for the ones that answered. Dead ones are recorded as failed right
+        away, ones we had no socket for are skipped this round
         '''
-        logger.info('开始爬取kxdaili')
+        d = defer.DeferredList([self.probes.run(tcp_probe, proxy, self.precheck) for proxy in proxies])
+        self.prechecks.add(d)
+        d.addCallback(self.prechecked, proxies, vendor)
+        d.addErrback(lambda failure: logger.error('代理源%s的TCP预检出错: %s' % (vendor, failure.getErrorMessage())))
+        d.addBoth(lambda _: self.prechecks.discard(d))
+
+    def prechecked(self, results, proxies, vendor):
+        alive = [proxy for proxy, (_, ok) in zip(proxies, results) if ok]
+        dead = [proxy for proxy, (_, ok) in zip(proxies, results) if ok is False]
+        logger.info('代理源%s: TCP预检淘汰%s/%s个代理' % (vendor, len(dead), len(proxies)))
+        skipped = len(proxies) - len(alive) - len(dead)
+        if skipped:
+            # 本机文件描述符或端口用完了，不能当成代理连不上写进PROXY_DEAD
+            logger.warning('代理源%s: 本机连接数不够，%s个代理没有预检，本轮跳过' % (vendor, skipped))
+        if dead:
+            # 和验证失败一样记进PROXY_DEAD，写redis放到线程里
+            d = threads.deferToThread(self.pool.apply, [{'proxy': proxy, 'valid': False, 'latency': None,
+                'source': 'fetch'} for proxy in dead])
+            self.socks_checks.append(d.addErrback(socks_failed))
+        if self.closing or time.time() > self.deadlines[vendor]:
+            return
+        for proxy in alive:
+            self.crawler.engine.crawl(self.validation(proxy, vendor), self)
+
+    def parse_vendor(self, response):
+        vendor = response.meta['vendor']
+        logger.info('解析代理源%s: %s' % (vendor, response.url))
         if 'proxy' in response.meta:
             logger.info('=>使用代理%s' % response.meta['proxy'])
-        url_pattern = 'http://www.kxdaili.com/dailiip/1/%s.html#ip'
         try:
-            page = re.search('(\d)+\.html', response.url).group(1)
-            page = int(page)
-        except Exception as e:
-            logger.exception(e)
-            logger.error(response.url)
-        for tr in response.css('table.ui.table.segment tbody tr'):
-            ip = tr.css('td::text').extract()[0]
-            port = tr.css('td::text').extract()[1]
-            proxy = 'http://%s:%s' % (ip, port)
-            logger.info('验证: %s' % proxy)
-            if not self.redis_db.sismember(self.PROXY_SET, proxy):
-                vaurl, vastart = random.choice(list(self.validator_pool))
-                yield Request(url=vaurl, meta={'proxy': proxy, 'startstring': vastart}, callback=self.checkin, dont_filter=True)
-            else:
-                logger.info('该代理已收录..')
-        if page < 3: # 爬取前3页
-            page += 1
-            new_url = url_pattern % page
-            new_meta = response.meta.copy()
-            new_meta['page'] = page
-            yield Request(url=new_url, meta=new_meta, callback=self.parse_kxdaili)
+            candidates = self.parsers[vendor].extract(response)
+        except ValueError as e:
+            logger.warning('代理源%s页面解析失败: %r' % (vendor, e))
+            return
+        yield from self.validate(response, candidates)
     
     def closed(self, reason):
+        self.closing = True
+        if self.deadline_call and self.deadline_call.active():
+            self.deadline_call.cancel()
+        # 等socks5代理验证和预检结果写完再统计代理源产出
+        return defer.DeferredList(self.socks_checks).addCallback(self.finished)
+    
+    def finished(self, _):
+        for name, stats in self.yields.items():
+            logger.info('代理源%s: 候选代理%s个，有效%s个' % (name, stats['candidates'], stats['valid']))
+            self.pool.record_vendor_run(name, stats['candidates'], stats['valid'])
         logger.info('代理池更新完成，有效代理数: %s' % self.redis_db.scard(self.PROXY_SET))
         
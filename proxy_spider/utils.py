@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import random
+import yaml
+from redis import StrictRedis
+
+from proxy_spider.echo import ECHO_STARTSTRING
+from proxy_spider.validators import ValidatorPool
+
+CONFIG_YAML = {
+    'prod': '/etc/hq-proxies.yml',
+    'test': '/etc/hq-proxies.test.yml',
+}
+
+def load_config(mode='prod', path=None):
+    with open(path or CONFIG_YAML[mode], 'r') as f:
+        return yaml.safe_load(f)
+
+def connect_redis(config):
+    return StrictRedis(
+        host=config['REDIS_HOST'],
+        port=config['REDIS_PORT'],
+        password=config['REDIS_PASSWORD'],
+        db=config['REDIS_DB']
+    )
+
+def load_validators(config):
+    ''' PROXY_VALIDATORS as a ValidatorPool, with the ECHO_VALIDATORS pool
+    (possibly empty) as its `echo` attribute
+    '''
+    validator_pool = ValidatorPool.from_config(config)
+    validator_pool.echo = load_echo_validators(config)
+    return validator_pool
+
+def load_echo_validators(config):
+    return ValidatorPool.from_config(config, 'ECHO_VALIDATORS', ECHO_STARTSTRING)
+
+def sampled(rate):
+    ''' Whether to emit one of the per-proxy log lines, which are far too
+    many to log each one on a big pool
+    '''
+    return rate >= 1 or random.random() < rate
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+''' Validator pages as a managed pool
+
+Every PROXY_VALIDATORS (and ECHO_VALIDATORS) entry may set a `weight` for
+smooth weighted round-robin, an `rps` rate limit and a `concurrency` cap
+(CHECK_PER_VALIDATOR by default):
+
+    - url: http://example.com/helloworld.txt
+      startstring: hello world! :)
+      weight: 2
+      rps: 50
+      concurrency: 100
+
+The pool keeps an EWMA of the pass rate of each validator. One that passes
+far fewer proxies than its peers of the same scheme, or fails a direct
+probe, is most likely down or rate limiting us rather than the proxies
+being bad, so it is taken out of rotation for VALIDATOR_COOLDOWN seconds.
+Failures that never reached the validator (the proxy itself refused or
+timed out) don't count against it.
+
+Pool re-checks only evict a proxy after it failed on VALIDATOR_QUORUM
+different validators, as long as there are that many to try.
+'''
+import time
+import logging
+import threading
+from urllib.request import urlopen
+
+from proxy_spider import metrics
+
+logger = logging.getLogger(__name__)
+
+def scheme_for(capability):
+    ''' Validator url scheme able to test `capability`: https urls for the
+    CONNECT check, plain http ones for the others
+    '''
+    return 'https://' if capability == 'https' else 'http://'
+
+class Validator(object):
+
+    def __init__(self, url, startstring, weight=1, rps=None, concurrency=None):
+        self.url = url
+        self.startstring = startstring
+        self.weight = weight
+        self.rps = rps
+        self.concurrency = concurrency
+        self.current = 0
+        self.inflight = 0
+        self.tokens = float(rps or 0)
+        self.refilled = time.time()
+        self.health = 1.0
+        self.samples = 0
+        self.down_until = 0
+
+    @property
+    def pair(self):
+        return (self.url, self.startstring)
+
+    def has_room(self, now):
+        if self.concurrency and self.inflight >= self.concurrency:
+            return False
+        if self.rps:
+            # 令牌桶，最多攒一秒的量
+            self.tokens = min(self.rps, self.tokens + (now - self.refilled) * self.rps)
+            self.refilled = now
+            return self.tokens >= 1
+        return True
+
+class ValidatorPool(object):
+    ''' Validators with health tracking, per-validator caps and smooth
+    weighted round-robin, shared by the spiders and the asyncio engine
+    (which runs in worker threads, hence the lock)
+
+    Iterating yields (url, startstring) pairs like the old validator sets.
+    '''
+    def __init__(self, validators, concurrency=None, alpha=0.02, min_health=0.5, min_samples=50,
+            cooldown=300, quorum=2):
+        self.validators = list(validators)
+        for validator in self.validators:
+            validator.concurrency = validator.concurrency or concurrency
+            metrics.VALIDATOR_UP.set(1, validator=validator.url)
+        self.by_url = dict((validator.url, validator) for validator in self.validators)
+        self.alpha = alpha
+        self.min_health = min_health
+        self.min_samples = min_samples
+        self.cooldown = cooldown
+        self.quorum = quorum
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, key='PROXY_VALIDATORS', startstring=None):
+        return cls(
+            [Validator(v['url'], v.get('startstring', startstring), v.get('weight', 1), v.get('rps'),
+                v.get('concurrency')) for v in config.get(key) or []],
+            concurrency=config.get('CHECK_PER_VALIDATOR', 200),
+            alpha=config.get('VALIDATOR_HEALTH_ALPHA', 0.02),
+            min_health=config.get('VALIDATOR_MIN_HEALTH', 0.5),
+            min_samples=config.get('VALIDATOR_MIN_SAMPLES', 50),
+            cooldown=config.get('VALIDATOR_COOLDOWN', 300),
+            quorum=config.get('VALIDATOR_QUORUM', 2)
+        )
+
+    @classmethod
+    def wrap(cls, validators, concurrency=None):
+        ''' `validators` as a pool, building one from (url, startstring) pairs
+        '''
+        if validators is None or isinstance(validators, cls):
+            return validators
+        return cls([Validator(url, startstring) for url, startstring in validators], concurrency)
+
+    def __iter__(self):
+        return iter([validator.pair for validator in self.validators])
+
+    def __len__(self):
+        return len(self.validators)
+
+    def candidates(self, capability, exclude=()):
+        scheme = scheme_for(capability)
+        return [v for v in self.validators if v.url.startswith(scheme) and v.url not in exclude]
+
+    def available(self, capability, exclude=()):
+        return bool(self.candidates(capability, exclude))
+
+    def pick(self, capability, exclude=(), strict=False, hold=True):
+        ''' Next validator for `capability` by smooth weighted round-robin
+        over the healthy ones, skipping urls in `exclude`, and count it in
+        flight until release(). Validators at their concurrency or rate cap
+        are passed over, if all of them are, strict returns None and the
+        default picks one anyway. None when there is no validator at all
+
+        hold=False only chooses the validator, for requests that may wait
+        in a queue a long while (or forever) before they go out, hold()
+        then counts it once the check really starts.
+        '''
+        now = time.time()
+        with self.lock:
+            candidates = self.candidates(capability, exclude)
+            if not candidates:
+                return None
+            for validator in candidates:
+                if validator.down_until and now >= validator.down_until:
+                    self.mark_up(validator)
+            # 全都停用了也比不验证强
+            healthy = [v for v in candidates if not v.down_until] or candidates
+            ready = [v for v in healthy if v.has_room(now)]
+            if not ready:
+                if strict:
+                    return None
+                ready = healthy
+            total = 0
+            best = None
+            for validator in ready:
+                validator.current += validator.weight
+                total += validator.weight
+                if best is None or validator.current > best.current:
+                    best = validator
+            best.current -= total
+            if hold:
+                self.take(best)
+            return best
+
+    def hold(self, url):
+        ''' Count a check against the validator at `url` in flight
+        '''
+        validator = self.by_url.get(url)
+        if validator is not None:
+            with self.lock:
+                self.take(validator)
+
+    def take(self, validator):
+        validator.inflight += 1
+        if validator.rps:
+            validator.tokens -= 1
+
+    def release(self, url, passed=None):
+        ''' Finish a check against the validator at `url`. `passed` is
+        whether the proxy passed, None when the check never got through to
+        the validator and says nothing about it
+        '''
+        validator = self.by_url.get(url)
+        if validator is None:
+            return
+        with self.lock:
+            validator.inflight = max(validator.inflight - 1, 0)
+            if passed is None or validator.down_until:
+                return
+            validator.health += self.alpha * ((1.0 if passed else 0.0) - validator.health)
+            validator.samples += 1
+            if validator.samples < self.min_samples:
+                return
+            scheme = validator.url.split('://', 1)[0]
+            peers = [v.health for v in self.validators if v is not validator and not v.down_until
+                and v.samples >= self.min_samples and v.url.startswith(scheme + '://')]
+            if peers and validator.health < self.min_health * max(peers):
+                self.mark_down(validator, '通过率%.2f，其他验证页最高%.2f' % (validator.health, max(peers)))
+
+    def mark_down(self, validator, reason):
+        logger.warning('验证页%s异常（%s），停用%s秒' % (validator.url, reason, self.cooldown))
+        validator.down_until = time.time() + self.cooldown
+        metrics.VALIDATOR_UP.set(0, validator=validator.url)
+
+    def mark_up(self, validator):
+        logger.info('验证页%s恢复使用' % validator.url)
+        validator.down_until = 0
+        validator.samples = 0
+        validator.health = max([v.health for v in self.validators if not v.down_until] + [validator.health])
+        metrics.VALIDATOR_UP.set(1, validator=validator.url)
+
+    def probe(self, timeout=5):
+        ''' Fetch every validator directly, blocking, meant for a worker
+        thread. Ones that don't answer with their startstring are taken out
+        of rotation, stopped ones that do are brought back
+        '''
+        for validator in self.validators:
+            try:
+                with urlopen(validator.url, timeout=timeout) as response:
+                    body = response.read(max(len(validator.startstring.encode('utf-8')), 1024))
+                ok = body.decode('utf-8', 'replace').startswith(validator.startstring)
+                reason = '返回内容不对'
+            except (OSError, ValueError) as e:
+                ok = False
+                reason = repr(e)
+            with self.lock:
+                if not ok and not validator.down_until:
+                    self.mark_down(validator, reason)
+                elif ok and validator.down_until:
+                    self.mark_up(validator)
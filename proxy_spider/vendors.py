@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+''' Declarative proxy vendors
+
+A PROXY_VENDORS entry either names a registered preset with `parser`
+(overriding any of its keys) or spells out its own rules:
+
+    - name: some-listing
+      url: http://example.com/free/%s.html
+      pages: 5
+      rows: 'table.list tr'            # css, or rows_xpath: '//table//tr'
+      fields:                          # td index, or css/xpath (+regex) inside the row
+        ip: 0
+        port: 1
+        proto: 3
+        anonymity: 2
+        latency: {css: 'div.bar::attr(title)', regex: '([\\d.]+)'}
+      filters:
+        anonymity: [高匿]              # keep rows whose field is one of these
+        max_latency: 3                 # max_<field>: numeric upper bound
+
+    - name: some-api
+      url: http://example.com/api?num=100
+      format: json                     # or text with `regex: '(ip):(port)'`
+      items: data.proxies              # dotted path to the list
+      fields: {ip: ip, port: port}     # dotted keys, "ip:port" strings work as is
+
+Rules are compiled to lxml XPath / regex objects once per vendor definition
+and every table row is read in one pass over its cells. Vendors that really
+need code register a function(response, vendor) -> candidates with
+@register('name'). An entry that can't be compiled raises VendorError.
+'''
+import re
+import json
+import logging
+
+from lxml import etree
+from parsel.csstranslator import HTMLTranslator
+
+from proxy_spider.pool import proxy_url
+
+logger = logging.getLogger(__name__)
+
+IP_RE = re.compile(r'^\d{1,3}(\.\d{1,3}){3}$')
+ADDR_RE = re.compile(r'(\d{1,3}(?:\.\d{1,3}){3}):(\d{1,5})')
+NUMBER_RE = re.compile(r'\d+(?:\.\d+)?')
+
+FORMATS = ('html', 'text', 'json')
+
+REGISTRY = {}
+
+class VendorError(ValueError):
+    ''' A PROXY_VENDORS entry that can't work, raised when it is compiled
+    '''
+
+def register(name, rule=None):
+    ''' Register a preset rule dict under `name`, or decorate a custom
+    parser function(response, vendor) -> candidate proxy urls
+    '''
+    if rule is not None:
+        REGISTRY[name] = rule
+        return rule
+    def decorator(func):
+        REGISTRY[name] = func
+        return func
+    return decorator
+
+register('parse_xici', {
+    'url': 'http://www.xicidaili.com/nn/',
+    'rows': '#ip_list tr',
+    'fields': {'ip': 1, 'port': 2, 'anonymity': 4, 'proto': 5,
+        'latency': {'css': 'div.bar::attr(title)', 'regex': r'(\d+\.\d+)秒'}},
+    'filters': {'max_latency': 3},
+})
+register('parse_66ip', {
+    'url': 'http://www.66ip.cn/nmtq.php?getnum=100&isp=0&anonymoustype=3&start=&ports=&export=&ipaddress=&area=1&proxytype=0&api=66ip',
+    'format': 'text',
+})
+register('parse_ip181', {
+    'url': 'http://www.ip181.com/',
+    'rows': 'table tbody tr',
+    'fields': {'ip': 0, 'port': 1, 'anonymity': 2, 'proto': 3},
+    'filters': {'anonymity': ['高匿']},
+})
+register('parse_kxdaili', {
+    'url': 'http://www.kxdaili.com/dailiip/1/%s.html#ip',
+    'pages': 3,
+    'rows': 'table.ui.table.segment tbody tr',
+    'fields': {'ip': 0, 'port': 1, 'anonymity': 2},
+})
+
+_translator = HTMLTranslator()
+
+def css_xpath(css):
+    return etree.XPath(_translator.css_to_xpath(css))
+
+def dig(item, path):
+    for key in path.split('.') if path else []:
+        if isinstance(item, list):
+            item = item[int(key)] if key.isdigit() and int(key) < len(item) else None
+        elif isinstance(item, dict):
+            item = item.get(key)
+        else:
+            return None
+    return item
+
+class Field(object):
+    ''' One field of a row: a cell index, or css/xpath relative to the row,
+    optionally narrowed down by the first group of a regex
+    '''
+    def __init__(self, spec):
+        if not isinstance(spec, dict):
+            spec = {'cell': spec}
+        self.cell = spec.get('cell')
+        self.key = spec.get('key', spec.get('cell'))
+        self.xpath = css_xpath(spec['css']) if 'css' in spec else (
+            etree.XPath(spec['xpath']) if 'xpath' in spec else None)
+        self.regex = re.compile(spec['regex']) if 'regex' in spec else None
+
+    def html(self, row, cells):
+        if self.xpath is not None:
+            found = self.xpath(row)
+            if not found:
+                return None
+            value = found[0] if isinstance(found[0], str) else ''.join(found[0].itertext())
+        elif isinstance(self.cell, int):
+            if self.cell >= len(cells):
+                return None
+            value = ''.join(cells[self.cell].itertext())
+        else:
+            return None
+        return self.narrow(value)
+
+    def json(self, item):
+        value = dig(item, str(self.key))
+        return None if value is None else self.narrow(str(value))
+
+    def narrow(self, value):
+        value = value.strip()
+        if self.regex is not None:
+            match = self.regex.search(value)
+            if not match:
+                return None
+            value = match.group(1) if match.groups() else match.group(0)
+        return value
+
+class Vendor(object):
+    ''' A compiled vendor definition, extract(response) -> candidate proxy urls
+    '''
+    def __init__(self, rule):
+        self.urls = page_urls(rule)
+        self.format = rule.get('format', 'html')
+        if self.format not in FORMATS:
+            raise VendorError('unknown format %r' % self.format)
+        self.proto = rule.get('proto', 'http')
+        if 'rows_xpath' in rule:
+            self.rows = etree.XPath(rule['rows_xpath'])
+        elif 'rows' in rule:
+            self.rows = css_xpath(rule['rows'])
+        elif self.format == 'html':
+            raise VendorError('html vendor needs rows or rows_xpath')
+        else:
+            self.rows = None
+        self.regex = re.compile(rule['regex']) if 'regex' in rule else ADDR_RE
+        self.items = rule.get('items', '')
+        fields = dict(rule.get('fields') or {})
+        if self.format == 'json':
+            fields.setdefault('ip', 'ip')
+            fields.setdefault('port', 'port')
+        if self.format == 'html' and not ('ip' in fields and 'port' in fields):
+            raise VendorError('html vendor needs ip and port fields')
+        self.fields = dict((name, Field(spec if isinstance(spec, dict) or self.format != 'json' else {'key': spec}))
+            for name, spec in fields.items())
+        self.allowed = {}
+        self.maximum = {}
+        for name, value in (rule.get('filters') or {}).items():
+            if name.startswith('max_'):
+                self.maximum[name[4:]] = float(value)
+            else:
+                self.allowed[name] = set(value if isinstance(value, list) else [value])
+
+    def extract(self, response):
+        if self.format == 'text':
+            rows = self.text_rows(response.body_as_unicode())
+        elif self.format == 'json':
+            rows = self.json_rows(json.loads(response.body_as_unicode()))
+        else:
+            rows = self.html_rows(response.selector.root)
+        return [proxy_url(row['ip'], row['port'], row.get('proto') or self.proto) for row in rows if self.keep(row)]
+
+    def text_rows(self, text):
+        for match in self.regex.finditer(text):
+            groups = match.groupdict() or dict(zip(('ip', 'port'), match.groups()))
+            yield groups
+
+    def json_rows(self, data):
+        for item in dig(data, self.items) or []:
+            if isinstance(item, str):
+                match = ADDR_RE.search(item)
+                if match:
+                    yield {'ip': match.group(1), 'port': match.group(2)}
+                continue
+            yield dict((name, field.json(item)) for name, field in self.fields.items())
+
+    def html_rows(self, root):
+        for row in self.rows(root):
+            cells = row.findall('td')
+            yield dict((name, field.html(row, cells)) for name, field in self.fields.items())
+
+    def keep(self, row):
+        ip, port = row.get('ip'), row.get('port')
+        if not ip or not IP_RE.match(ip) or not port or not port.isdigit():
+            return False
+        for name, allowed in self.allowed.items():
+            if row.get(name) not in allowed:
+                return False
+        for name, maximum in self.maximum.items():
+            number = NUMBER_RE.search(row.get(name) or '')
+            if number and float(number.group(0)) > maximum:
+                return False
+        return True
+
+class CustomVendor(object):
+    def __init__(self, func, vendor):
+        self.urls = page_urls(vendor)
+        self.func = func
+        self.vendor = vendor
+
+    def extract(self, response):
+        return list(self.func(response, self.vendor))
+
+def page_urls(rule):
+    ''' url with a %s page placeholder and `pages: N` expands to pages 1..N
+    '''
+    if not rule.get('url'):
+        raise VendorError('vendor needs a url')
+    if 'pages' not in rule:
+        return [rule['url']]
+    if '%s' not in rule['url']:
+        raise VendorError('url %s has no %%s for pages' % rule['url'])
+    return [rule['url'] % page for page in range(1, rule['pages'] + 1)]
+
+def merge(preset, vendor):
+    ''' Preset overridden by the entry. An entry still carrying the first
+    page of a paged preset (old configs) keeps the preset's paging, any
+    other url without a %s is fetched as a single page
+    '''
+    rule = dict(preset)
+    rule.update(vendor)
+    if 'pages' in preset and 'pages' not in vendor and '%s' not in vendor.get('url', '%s'):
+        if vendor['url'] == preset['url'] % 1:
+            rule['url'] = preset['url']
+        else:
+            del rule['pages']
+    return rule
+
+_compiled = {}
+
+def compile_vendor(vendor):
+    ''' Vendor for a PROXY_VENDORS entry, compiled once per distinct entry
+    '''
+    key = json.dumps(vendor, sort_keys=True, ensure_ascii=False)
+    if key not in _compiled:
+        parser = vendor.get('parser')
+        if parser is not None and parser not in REGISTRY:
+            raise VendorError('unknown parser %s' % parser)
+        preset = REGISTRY.get(parser, {})
+        if callable(preset):
+            _compiled[key] = CustomVendor(preset, vendor)
+        else:
+            _compiled[key] = Vendor(merge(preset, vendor))
+    return _compiled[key]
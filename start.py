@@ -4,44 +4,47 @@ import os
 import sys
 import time
 import random
-import unittest
-import yaml
-from redis import StrictRedis
-from threading import Thread
+import socket
 from datetime import datetime
 import logging
 from logging.handlers import RotatingFileHandler
+from threading import Thread
+
+from twisted.internet import reactor, defer, task, threads
+from twisted.trial import unittest
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+from scrapy.crawler import CrawlerRunner
+from scrapy.utils.project import get_project_settings
+
+from proxy_spider.spiders.proxy_spider import ProxyCheckSpider, ProxyFetchSpider
+from proxy_spider.utils import load_config, connect_redis, load_validators
+from proxy_spider.pool import ProxyPool
+from proxy_spider import aiocheck, echo, metrics, snapshot, vendors
 
 if __name__ == '__main__':
-    LOCAL_CONFIG_YAML = '/etc/hq-proxies.yml'
-    with open(LOCAL_CONFIG_YAML, 'r') as f:
-        LOCAL_CONFIG = yaml.load(f)
-    fetchcmd = 'scrapy crawl proxy_fetch'
-    checkcmd = 'scrapy crawl proxy_check > /dev/null 2>&1'
+    MODE = 'prod'
 else:
     print('测试模式！')
-    LOCAL_CONFIG_YAML = '/etc/hq-proxies.test.yml'
-    with open(LOCAL_CONFIG_YAML, 'r') as f:
-        LOCAL_CONFIG = yaml.load(f)
-    fetchcmd = 'scrapy crawl proxy_fetch -a mode=test'
-    checkcmd = 'scrapy crawl proxy_check -a mode=test'
+    MODE = 'test'
+LOCAL_CONFIG = load_config(MODE)
 
 FORMAT = '%(asctime)s %(levelno)s/%(lineno)d: %(message)s'
-logging.basicConfig(level=logging.DEBUG, format=FORMAT)    
+logging.basicConfig(level=logging.DEBUG, format=FORMAT)
 logger = logging.getLogger(__name__)
+# scrapy的请求级日志太多了，和以前跑子进程时一样只保留INFO以上
+logging.getLogger('scrapy').setLevel(logging.INFO)
 
 # redis keys
 PROXY_COUNT = LOCAL_CONFIG['PROXY_COUNT']
 PROXY_SET = LOCAL_CONFIG['PROXY_SET']
 PROXY_PROTECT = LOCAL_CONFIG['PROXY_PROTECT']
 PROXY_REFRESH = LOCAL_CONFIG['PROXY_REFRESH']
-    
-redis_db = StrictRedis(
-    host=LOCAL_CONFIG['REDIS_HOST'], 
-    port=LOCAL_CONFIG['REDIS_PORT'], 
-    password=LOCAL_CONFIG['REDIS_PASSWORD'],
-    db=LOCAL_CONFIG['REDIS_DB']
-)
+PROXY_EVENTS = LOCAL_CONFIG.get('PROXY_EVENTS', 'hq-proxies:proxy_events')
+
+redis_db = connect_redis(LOCAL_CONFIG)
+validator_pool = load_validators(LOCAL_CONFIG)
+pool = ProxyPool(redis_db, LOCAL_CONFIG)
 
 # settings
 PROXY_LOW = LOCAL_CONFIG['PROXY_LOW']
@@ -51,18 +54,178 @@ CHECK_INTERVAL = LOCAL_CONFIG['CHECK_INTERVAL']
 LOOP_DELAY = LOCAL_CONFIG['LOOP_DELAY']
 PROTECT_SEC = LOCAL_CONFIG['PROTECT_SEC']
 REFRESH_SEC = LOCAL_CONFIG['REFRESH_SEC']
+# scrapy: 用proxy_check爬虫验证  asyncio: 用aiocheck高并发验证
+CHECK_ENGINE = LOCAL_CONFIG.get('CHECK_ENGINE', 'scrapy')
+CHECK_MODE = LOCAL_CONFIG.get('CHECK_MODE', 'full')
+# 监控指标的http端口，Prometheus从 http://host:METRICS_PORT/metrics 拉取，默认只监听本机
+METRICS_HOST = LOCAL_CONFIG.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = LOCAL_CONFIG.get('METRICS_PORT', 9108)
+RESTART_DELAY = 60
+# 多节点模式：每个节点都验证，按租约领取到期代理；只有主节点负责补充代理
+DISTRIBUTED = LOCAL_CONFIG.get('DISTRIBUTED', False)
+NODE_ID = LOCAL_CONFIG.get('NODE_ID') or '%s:%s' % (socket.gethostname(), os.getpid())
+LEADER_TTL = LOCAL_CONFIG.get('LEADER_TTL', 90)
+# 代理池快照，定期保存，启动时代理池为空就从快照热启动
+SNAPSHOT_PATH = LOCAL_CONFIG.get('SNAPSHOT_PATH')
+SNAPSHOT_INTERVAL = LOCAL_CONFIG.get('SNAPSHOT_INTERVAL', 300)
+# 每隔VALIDATOR_PROBE_INTERVAL秒直接访问一遍验证页，挂了的先停用，恢复了再启用，0为关闭
+VALIDATOR_PROBE_INTERVAL = LOCAL_CONFIG.get('VALIDATOR_PROBE_INTERVAL', 60)
+if DISTRIBUTED and CHECK_MODE != 'rolling':
+    logger.warning('多节点模式下full检查会重复验证，改用rolling模式')
+    CHECK_MODE = 'rolling'
+
+# 两个爬虫都跑在同一个reactor里，配置、redis连接和验证页复用，不再每轮起一个scrapy进程
+runner = CrawlerRunner(get_project_settings())
+
+def crawl(spidercls):
+    # 本机出口ip要直接访问echo验证页，放到线程里查，不能卡住reactor
+    if validator_pool.echo:
+        d = threads.deferToThread(echo.own_ips, validator_pool.echo, LOCAL_CONFIG.get('ECHO_OWN_IPS') or [])
+    else:
+        d = defer.succeed(set())
+    return d.addCallback(lambda own_ips: runner.crawl(spidercls, mode=MODE, config=LOCAL_CONFIG,
+        redis_db=redis_db, validator_pool=validator_pool, own_ips=own_ips))
+
+def sleep(secs):
+    return task.deferLater(reactor, secs, lambda: None)
+
+class Waiter(object):
+    ''' A sleep that pool events can cut short
+    '''
+    def __init__(self):
+        self.pending = None
+
+    def sleep(self, secs):
+        d = defer.Deferred()
+        call = reactor.callLater(secs, d.callback, None)
+        self.pending = (d, call)
+        return d
+
+    def wake(self, reason):
+        if self.pending is None:
+            return
+        d, call = self.pending
+        self.pending = None
+        if call.active():
+            call.cancel()
+            d.callback(reason)
+
+fetch_waiter = Waiter()
+
+class Leadership(object):
+    ''' Whether this node runs the refill loop, renewed every LEADER_TTL/3
+
+    Single node setups always lead.
+    '''
+    def __init__(self, node, ttl):
+        self.node = node
+        self.ttl = ttl
+        self.leading = not DISTRIBUTED
+
+    def renew(self):
+        try:
+            leading = pool.lead(self.node, self.ttl)
+        except Exception as e:
+            # 连不上redis时不能再当自己是主节点
+            logger.exception(e)
+            leading = False
+        if leading and not self.leading:
+            logger.info('节点%s成为主节点，接管代理补充' % self.node)
+            fetch_waiter.wake('leader')
+        elif self.leading and not leading:
+            logger.info('节点%s不再是主节点，当前主节点: %s' % (self.node, pool.leader()))
+        self.leading = leading
+
+    def start(self):
+        if DISTRIBUTED:
+            task.LoopingCall(self.renew).start(self.ttl / 3.0)
+            reactor.addSystemEventTrigger('before', 'shutdown', pool.resign, self.node)
+
+leadership = Leadership(NODE_ID, LEADER_TTL)
+
+def onPoolEvent(event):
+    logger.info('收到代理池事件[%s]，立即检查库存...' % event)
+    fetch_waiter.wake(event)
+
+def listenPoolEvents():
+    ''' Relay PROXY_EVENTS messages to the reactor, runs in its own thread
+    '''
+    while True:
+        try:
+            pubsub = redis_db.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(PROXY_EVENTS)
+            for message in pubsub.listen():
+                reactor.callFromThread(onPoolEvent, message['data'].decode('utf-8'))
+        except Exception as e:
+            logger.exception(e)
+            time.sleep(5)
 
-def startFetch(reason=None, fetchcmd='scrapy crawl proxy_fetch > /dev/null 2>&1'):
+def timed(d, kind):
+    started = time.time()
+    def observe(result):
+        metrics.CYCLE_DURATION.observe(time.time() - started, kind=kind)
+        return result
+    return d.addBoth(observe)
+
+def check():
+    if CHECK_ENGINE == 'asyncio':
+        # aiocheck跑自己的event loop，放到线程池里不阻塞reactor
+        d = threads.deferToThread(aiocheck.run_check, pool, validator_pool, LOCAL_CONFIG, CHECK_MODE)
+    else:
+        d = crawl(ProxyCheckSpider)
+    return timed(d, 'check')
+
+def startFetch(reason=None):
     logger.info(reason)
     redis_db.setex(PROXY_PROTECT, PROTECT_SEC, True)
     redis_db.setex(PROXY_REFRESH, REFRESH_SEC, True)
-    os.system(fetchcmd)
+    return timed(crawl(ProxyFetchSpider), 'fetch')
+
+def saveSnapshot():
+    # 多节点时只让主节点写
+    if not leadership.leading:
+        return
+    d = threads.deferToThread(snapshot.dump, pool, SNAPSHOT_PATH)
+    d.addErrback(lambda failure: logger.error('保存代理池快照失败: %s' % failure.getErrorMessage()))
+    return d
+
+def probeValidators():
+    # echo验证页是单独的一组，也要检查
+    def probe():
+        validator_pool.probe()
+        validator_pool.echo.probe()
+    d = threads.deferToThread(probe)
+    d.addErrback(lambda failure: logger.error('检查验证页失败: %s' % failure.getErrorMessage()))
+    return d
+
+def warmStart():
+    ''' Revalidate the last snapshot best-first when the pool is empty
+    '''
+    if not leadership.leading or pool.count():
+        return defer.succeed(None)
+    d = timed(threads.deferToThread(snapshot.restore, pool, SNAPSHOT_PATH, validator_pool, LOCAL_CONFIG), 'warm_start')
+    d.addErrback(lambda failure: logger.error('代理池热启动失败: %s' % failure.getErrorMessage()))
+    return d
 
+class MetricsResource(Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+        return metrics.render().encode('utf-8')
+
+@defer.inlineCallbacks
 def proxyFetch(single_run=False, fake=False):
     while True:
+        if not leadership.leading:
+            logger.debug('节点%s不是主节点，不负责补充代理' % NODE_ID)
+            if single_run:
+                break
+            yield fetch_waiter.sleep(LOOP_DELAY)
+            continue
         protect_ttl = redis_db.ttl(PROXY_PROTECT)
         refresh_ttl = redis_db.ttl(PROXY_REFRESH)
-        
+
         pcount = redis_db.get(PROXY_COUNT)
         if not pcount:
             pcount = 0
@@ -74,44 +237,52 @@ def proxyFetch(single_run=False, fake=False):
             if fake:
                 logger.debug(msg)
             else:
-                startFetch(msg, fetchcmd)
+                yield startFetch(msg)
         elif pcount < PROXY_EXHAUST:
             msg = '代理池即将耗尽啦，需要立即补充些代理... Σ( ° △ °|||)'
             if fake:
                 logger.debug(msg)
             else:
-                startFetch(msg, fetchcmd)
+                yield startFetch(msg)
         elif pcount < PROXY_LOW and protect_ttl > 0:
             msg = '代理池存量有点低，但尚在保护期，让我们继续观察一会... O__O'
             if fake:
                 logger.debug(msg)
             else:
                 logger.info(msg)
-        elif not refresh_ttl:
+        elif refresh_ttl <= 0:
+            # 键不存在时ttl返回-2，不是0
             msg = '代理池太久没更新啦，补充些新鲜代理... ლ(╹◡╹ლ)'
             if fake:
                 logger.debug(msg)
             else:
-                startFetch(msg, fetchcmd)
+                yield startFetch(msg)
         else:
             logger.info('当前可用代理数：%s 库存情况良好... (๑•̀ㅂ•́)و✧' % pcount)
-        
+
         protect_ttl = redis_db.ttl(PROXY_PROTECT)
         refresh_ttl = redis_db.ttl(PROXY_REFRESH)
+        delay = LOOP_DELAY
         if protect_ttl > 0:
             logger.info('代理池尚在保护期, 剩余保护时间：%s' % protect_ttl)
+            if pcount < PROXY_LOW:
+                # 存量低时保护期一结束就要补充，不等下一轮
+                delay = min(delay, protect_ttl)
         if refresh_ttl > 0:
             logger.info('距离下次常规更新还剩%s秒' % refresh_ttl)
-        logger.info('%s秒后开始下次检测...' % LOOP_DELAY)
-        
+            delay = min(delay, refresh_ttl)
+        logger.info('%s秒后开始下次检测...' % delay)
+
         if single_run:
             break
-        time.sleep(LOOP_DELAY)
+        # 代理数跌破PROXY_LOW/PROXY_EXHAUST时会被事件提前唤醒
+        yield fetch_waiter.sleep(delay)
 
+@defer.inlineCallbacks
 def proxyCheck(single_run=False, fake=False):
     while True:
         logger.info('检查库存代理质量...')
-        os.system(checkcmd)
+        yield check()
         pcount = redis_db.get(PROXY_COUNT)
         if pcount:
             pcount = int(pcount)
@@ -120,59 +291,84 @@ def proxyCheck(single_run=False, fake=False):
         logger.info('检查完成，存活代理数%s..' % pcount)
         if single_run:
             break
-        time.sleep(CHECK_INTERVAL)
+        yield sleep(CHECK_INTERVAL)
+
+def keepalive(loop, errmsg):
+    ''' Run a scheduler loop, restarting it after RESTART_DELAY if it dies
+    '''
+    def restart(failure):
+        logger.error(errmsg)
+        logger.error(failure.getTraceback())
+        return sleep(RESTART_DELAY).addCallback(lambda _: keepalive(loop, errmsg))
+    return loop().addErrback(restart)
 
 def main():
     logger.info('启动进程中...')
-    # reset 'protect' and 'refresh' tag
-    redis_db.delete(PROXY_PROTECT)
-    redis_db.setex(PROXY_REFRESH, REFRESH_SEC, True)
-    # start proxy-check thread
-    check_thd = Thread(target=proxyCheck)
-    check_thd.daemon = True
-    check_thd.start()
-    # start proxy-fetch thread
-    fetch_thd = Thread(target=proxyFetch)
-    fetch_thd.daemon = True
-    fetch_thd.start()
-    
-    while True:
-        if not check_thd.is_alive():
-            logger.error('自检线程已挂..重启中..')
-            check_thd.start()
-        if not fetch_thd.is_alive():
-            logger.error('抓取线程已挂..重启中..')
-            fetch_thd.start()
-        time.sleep(60)
+    # 代理源配置有误直接退出，不要等到抓取时才发现
+    try:
+        for vendor in LOCAL_CONFIG['PROXY_VENDORS']:
+            vendors.compile_vendor(vendor)
+    except vendors.VendorError as e:
+        logger.error('代理源配置有误: %s (%s)' % (e, vendor))
+        sys.exit(1)
+    if DISTRIBUTED:
+        # 别的节点可能正在跑，只在没有刷新标记时补上
+        logger.info('多节点模式，节点: %s' % NODE_ID)
+        redis_db.set(PROXY_REFRESH, True, ex=REFRESH_SEC, nx=True)
+    else:
+        # reset 'protect' and 'refresh' tag
+        redis_db.delete(PROXY_PROTECT)
+        redis_db.setex(PROXY_REFRESH, REFRESH_SEC, True)
+    leadership.start()
+    if VALIDATOR_PROBE_INTERVAL:
+        task.LoopingCall(probeValidators).start(VALIDATOR_PROBE_INTERVAL)
+    if SNAPSHOT_PATH:
+        warmStart()
+        task.LoopingCall(saveSnapshot).start(SNAPSHOT_INTERVAL, now=False)
+    # start proxy-check loop
+    keepalive(proxyCheck, '自检线程已挂..重启中..')
+    # start proxy-fetch loop
+    keepalive(proxyFetch, '抓取线程已挂..重启中..')
+    # expose metrics
+    if METRICS_PORT:
+        reactor.listenTCP(METRICS_PORT, Site(MetricsResource()), interface=METRICS_HOST)
+        logger.info('监控指标: http://%s:%s/metrics' % (METRICS_HOST, METRICS_PORT))
+    # wake the fetch loop up on pool events
+    event_thd = Thread(target=listenPoolEvents)
+    event_thd.daemon = True
+    event_thd.start()
+    reactor.run()
 
 class TestCases(unittest.TestCase):
+    ''' Run with `trial start`, deferreds returned here are driven by trial's reactor
+    '''
     def test_proxyFetch(self):
-        proxyFetch(True) 
+        return proxyFetch(True)
     def test_proxyCheck(self):
-        proxyCheck(True)
-        
+        return proxyCheck(True)
+
     def test_proxyExhaust(self):
         redis_db.setex(PROXY_PROTECT, PROTECT_SEC, True)
         redis_db.set(PROXY_COUNT, 0)
-        proxyFetch(True, True)
-        
+        return proxyFetch(True, True)
+
     def test_proxyLow(self):
         redis_db.delete(PROXY_PROTECT)
         redis_db.set(PROXY_COUNT, 3)
-        proxyFetch(True, True)
-        
+        return proxyFetch(True, True)
+
     def test_proxyLowProtect(self):
         redis_db.setex(PROXY_PROTECT, PROTECT_SEC, True)
         redis_db.set(PROXY_COUNT, 3)
-        proxyFetch(True, True)    
-    
+        return proxyFetch(True, True)
+
     def test_proxyRefresh(self):
         redis_db.delete(PROXY_REFRESH)
         redis_db.set(PROXY_COUNT, 10)
-        proxyFetch(True, True)  
-    
+        return proxyFetch(True, True)
+
     def loop(self):
         main()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+''' Anonymity classification of echo validator bodies
+'''
+from proxy_spider import echo
+
+OWN = {'9.9.9.9'}
+
+def body(origin, *headers):
+    return echo.render(origin, headers)
+
+def test_not_an_echo_body():
+    assert echo.classify('hello world! :)', OWN) is None
+    assert echo.parse('hello world! :)') is None
+
+def test_parse():
+    assert echo.parse(body('1.2.3.4', ('Via', '1.1 squid'))) == ('1.2.3.4', {'via': '1.1 squid'})
+
+def test_elite():
+    assert echo.classify(body('1.2.3.4', ('User-Agent', 'x')), OWN) == 'elite'
+
+def test_anonymous():
+    assert echo.classify(body('1.2.3.4', ('Via', '1.1 squid')), OWN) == 'anonymous'
+    assert echo.classify(body('1.2.3.4', ('X-Forwarded-For', '1.2.3.4')), OWN) == 'anonymous'
+
+def test_transparent():
+    assert echo.classify(body('9.9.9.9'), OWN) == 'transparent'
+    assert echo.classify(body('1.2.3.4', ('X-Forwarded-For', '9.9.9.9, 1.2.3.4')), OWN) == 'transparent'
+    assert echo.classify(body('1.2.3.4', ('Forwarded', 'for=9.9.9.9;proto=http')), OWN) == 'transparent'
+
+def test_ports_are_not_ips():
+    assert echo.classify(body('1.2.3.4', ('X-Forwarded-For', '1.2.3.4:3128')), set()) == 'anonymous'
+    assert echo.classify(body('1.2.3.4', ('Forwarded', 'for=1.2.3.4:4711')), set()) == 'anonymous'
+    assert echo.classify(body('1.2.3.4', ('X-Forwarded-For', '9.9.9.9:3128')), OWN) == 'transparent'
+
+def test_ipv6():
+    assert echo.IP_RE.findall('for="[2001:db8::1]:4711"') == ['2001:db8::1']
+    assert echo.classify(body('1.2.3.4', ('X-Forwarded-For', '2001:db8::1')), {'2001:db8::1'}) == 'transparent'
+
+def test_without_own_ips():
+    # 不知道本机ip时，和来源不同的转发ip都算泄露
+    assert echo.classify(body('1.2.3.4', ('X-Real-IP', '5.6.7.8')), set()) == 'transparent'
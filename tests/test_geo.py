@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+''' GeoIndex loading and lookups, and region indexing in the pool
+'''
+import pytest
+
+from benchmarks.fakeredis import FakeRedis
+from proxy_spider import geo
+from proxy_spider.pool import ProxyPool
+
+DATABASE = '''# start,end,country,region,asn
+1.0.0.0,1.0.0.255,CN,Guangdong,AS4134
+1.0.1.0,1.0.1.255,cn,Guangdong,4134
+2.0.0.0/8,US,California,15169
+16843008,16843263,JP,Tokyo,0
+::1,::2,XX,IPv6,1
+'''
+
+@pytest.fixture
+def database(tmpdir):
+    path = tmpdir.join('geo.csv')
+    path.write(DATABASE)
+    return str(path)
+
+def test_load_and_lookup(database):
+    index = geo.GeoIndex.load(database)
+    assert len(index) == 4
+    assert index.lookup('1.0.0.7') == {'country': 'CN', 'region': 'Guangdong', 'asn': '4134'}
+    assert index.lookup('2.255.0.1') == {'country': 'US', 'region': 'California', 'asn': '15169'}
+    # 整数地址，AS0当作没有自治域
+    assert index.lookup('1.1.1.1') == {'country': 'JP', 'region': 'Tokyo', 'asn': ''}
+    assert index.lookup('3.0.0.1') is None
+    assert index.lookup('1.0.2.0') is None
+    assert index.lookup('not an ip') is None
+
+def test_tags_are_shared(database):
+    index = geo.GeoIndex.load(database)
+    assert index.tags[0] is index.tags[1]
+
+def test_columns(tmpdir):
+    path = tmpdir.join('ip2asn.tsv')
+    path.write('1.0.0.0\t1.0.0.255\t13335\tUS\tCLOUDFLARENET\n')
+    index = geo.GeoIndex.load(str(path), ('start', 'end', 'asn', 'country', '-'))
+    assert index.lookup('1.0.0.1') == {'country': 'US', 'region': '', 'asn': '13335'}
+
+def test_from_ranges_sorts():
+    index = geo.GeoIndex.from_ranges([(200, 299, {'country': 'US'}), (100, 199, {'country': 'CN', 'asn': '1'})])
+    assert index.lookup('150') == {'country': 'CN', 'region': '', 'asn': '1'}
+    assert index.lookup('250')['country'] == 'US'
+
+def test_labels(database):
+    index = geo.GeoIndex.load(database)
+    assert index.labels('http://1.0.0.1:8080') == ['CN', 'CN/Guangdong', 'AS4134']
+    assert index.labels('socks5://9.9.9.9:1080') == []
+    assert geo.labels_of({'country': '', 'region': 'x', 'asn': '7'}) == ['AS7']
+
+@pytest.mark.parametrize('region, expected', [
+    ('cn', 'CN'), ('cn/Guangdong', 'CN/Guangdong'), ('as4134', 'AS4134'), (4134, 'AS4134'), ('AS13335', 'AS13335'),
+])
+def test_label(region, expected):
+    assert geo.label(region) == expected
+
+def test_pool_region_index(database):
+    pool = ProxyPool(FakeRedis(), {'PROXY_COUNT': 'test:count', 'PROXY_SET': 'test:pool', 'GEO_DATABASE': database})
+    pool.add('http://1.0.0.1:8080')
+    pool.add('http://2.0.0.1:8080')
+    assert [p for p, _ in pool.snapshot(region='cn/Guangdong')] == ['http://1.0.0.1:8080']
+    assert [p for p, _ in pool.snapshot(region='AS15169')] == ['http://2.0.0.1:8080']
+    # 地址库没了也能按统计里记的标签把代理从地区索引里拿掉
+    geo._loaded.clear()
+    pool.config = {'GEO_DATABASE': database + '.gone'}
+    pool.remove('http://1.0.0.1:8080')
+    assert pool.snapshot(region='CN') == []
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+''' Prometheus text rendering of the metrics module
+'''
+import pytest
+
+from proxy_spider import metrics
+
+@pytest.fixture
+def registered():
+    # 测试里建的指标用完从全局注册表里拿掉
+    before = list(metrics.REGISTRY)
+    yield
+    metrics.REGISTRY[:] = before
+
+def test_counter(registered):
+    counter = metrics.Counter('test_total', 'A counter', ['source', 'result'])
+    counter.inc(source='fetch', result='valid')
+    counter.inc(2, source='fetch', result='valid')
+    counter.inc(source='check', result='invalid')
+    assert counter.render() == [
+        '# HELP test_total A counter',
+        '# TYPE test_total counter',
+        'test_total{source="check",result="invalid"} 1',
+        'test_total{source="fetch",result="valid"} 3',
+    ]
+
+def test_gauge_without_labels(registered):
+    gauge = metrics.Gauge('test_size', 'A gauge')
+    gauge.set(5)
+    gauge.set(7)
+    assert gauge.render()[2:] == ['test_size 7']
+
+def test_label_escaping(registered):
+    gauge = metrics.Gauge('test_up', 'Escaping', ['validator'])
+    gauge.set(1, validator='http://a/"x"\\')
+    assert gauge.render()[2] == 'test_up{validator="http://a/\\"x\\"\\\\"} 1'
+
+def test_histogram(registered):
+    histogram = metrics.Histogram('test_seconds', 'A histogram', [0.5, 1], ['kind'])
+    for value in (0.2, 0.5, 0.7, 3):
+        histogram.observe(value, kind='check')
+    assert histogram.render()[2:] == [
+        'test_seconds_bucket{kind="check",le="0.5"} 2',
+        'test_seconds_bucket{kind="check",le="1"} 3',
+        'test_seconds_bucket{kind="check",le="+Inf"} 4',
+        'test_seconds_sum{kind="check"} 4.4',
+        'test_seconds_count{kind="check"} 4',
+    ]
+
+def test_render_all(registered):
+    metrics.Counter('test_render_total', 'Rendered with the rest').inc()
+    text = metrics.render()
+    assert text.endswith('\n')
+    assert '# TYPE hqproxies_pool_size gauge' in text
+    assert '# TYPE hqproxies_check_latency_seconds histogram' in text
+    assert '\ntest_render_total 1\n' in text
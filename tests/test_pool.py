@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+''' ProxyPool bookkeeping on benchmarks/fakeredis.py, no redis needed
+'''
+import time
+
+import pytest
+
+from benchmarks.fakeredis import FakeRedis
+from proxy_spider.pool import ProxyPool, address, domain_of
+
+PROXY = 'http://10.0.0.1:8080'
+
+CONFIG = {'PROXY_COUNT': 'test:count', 'PROXY_SET': 'test:pool', 'QUARANTINE_MAX_FAILS': 3,
+    'QUARANTINE_BACKOFF': 60, 'QUARANTINE_BACKOFF_MAX': 100}
+
+@pytest.fixture
+def pool():
+    return ProxyPool(FakeRedis(), CONFIG)
+
+def check(pool, valid):
+    pool.apply([{'proxy': PROXY, 'valid': valid, 'latency': 0.5 if valid else None, 'source': 'check'}])
+
+def test_quarantine_then_back(pool):
+    pool.add(PROXY)
+    check(pool, False)
+    assert not pool.contains(PROXY)
+    assert pool.lookup([PROXY]) == ['quarantine']
+    retry_at = pool.redis_db.zscore(pool.PROXY_QUARANTINE, PROXY)
+    assert 54 <= retry_at - time.time() <= 66
+    check(pool, True)
+    assert pool.contains(PROXY)
+    assert pool.quarantined() == 0
+    assert pool.redis_db.hget(pool.PROXY_FAILS, PROXY) is None
+
+def test_quarantine_backoff_then_dead(pool):
+    pool.add(PROXY)
+    check(pool, False)
+    check(pool, False)
+    # 第二次失败等待时间翻倍，但不超过QUARANTINE_BACKOFF_MAX
+    assert 90 <= pool.redis_db.zscore(pool.PROXY_QUARANTINE, PROXY) - time.time() <= 110
+    check(pool, False)
+    assert pool.quarantined() == 0
+    assert pool.lookup([PROXY]) == ['dead']
+    assert pool.redis_db.zscore(pool.PROXY_DEAD, address(PROXY)) > time.time()
+
+def test_failed_fetch_is_not_quarantined(pool):
+    pool.apply([{'proxy': PROXY, 'valid': False, 'latency': None, 'source': 'fetch'}])
+    assert pool.lookup([PROXY]) == ['dead']
+
+def test_claim_quarantined(pool):
+    pool.add(PROXY)
+    check(pool, False)
+    assert pool.claim_quarantined() == []
+    pool.redis_db.zadd(pool.PROXY_QUARANTINE, time.time() - 1, PROXY)
+    assert pool.claim_quarantined() == [PROXY]
+    assert pool.claim_quarantined() == []
+
+OTHER = 'http://10.0.0.2:8080'
+
+def test_domain_of():
+    assert domain_of('https://WWW.Example.com:8443/path') == 'example.com'
+    assert domain_of('example.com') == 'example.com'
+
+def test_domain_ban(pool):
+    pool.add(PROXY)
+    pool.add(OTHER)
+    assert pool.report_domain('http://example.com/a', [(PROXY, False), (PROXY, False)]) == []
+    assert pool.report_domain('example.com', [(PROXY, False), (OTHER, True)]) == [PROXY]
+    assert pool.banned('www.example.com') == {PROXY}
+    assert [p for p, _ in pool.snapshot(domain='example.com')] == [OTHER]
+    assert set(p for p, _ in pool.snapshot(domain='example.org')) == {PROXY, OTHER}
+    # 成功一次就解除屏蔽，扣分减半
+    pool.report_domain('example.com', [(PROXY, True)])
+    assert pool.banned('example.com') == set()
+
+def test_domain_penalty_decays(pool):
+    pool.report_domain('example.com', [(PROXY, False), (PROXY, False)])
+    key = pool.PROXY_DOMAIN % 'example.com'
+    # 两个半衰期之前的2分只剩0.5分，再失败一次也到不了3分
+    pool.redis_db.hset(key, PROXY, '2.000:%d' % (time.time() - 2 * pool.domain_half_life))
+    assert pool.report_domain('example.com', [(PROXY, False)]) == []
+    penalty = float(pool.redis_db.hget(key, PROXY).decode('utf-8').split(':')[0])
+    assert abs(penalty - 1.5) < 0.01
+
+def test_domain_outcomes_in_order(pool):
+    # 最后一次是成功，中途被屏蔽也不留下
+    assert pool.report_domain('example.com', [(PROXY, False)] * 3 + [(PROXY, True)]) == []
+    assert pool.banned('example.com') == set()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+''' The pool's Lua scripts against a real redis
+
+benchmarks/fakeredis.py stands in Python look-alikes for the scripts, so
+these are the only runs of the Lua itself. Point REDIS_TEST_URL at a
+scratch redis (redis://localhost:6379/15 by default), the tests are
+skipped when there is none and only touch hq-proxies-test:* keys.
+
+    python -m pytest tests
+'''
+import os
+import time
+
+import pytest
+import redis
+
+from proxy_spider.pool import ProxyPool
+
+PREFIX = 'hq-proxies-test:'
+
+CONFIG = dict((key, PREFIX + key.lower()) for key in ('PROXY_COUNT', 'PROXY_SET', 'PROXY_DUE', 'PROXY_QUARANTINE',
+    'PROXY_LEADER', 'PROXY_LEASES', 'PROXY_RATE', 'PROXY_SCORE', 'PROXY_EVENTS'))
+
+PROXIES = ['http://10.0.0.%d:8080' % i for i in range(1, 4)]
+
+@pytest.fixture
+def redis_db():
+    db = redis.StrictRedis.from_url(os.environ.get('REDIS_TEST_URL', 'redis://localhost:6379/15'))
+    try:
+        db.ping()
+    except redis.ConnectionError:
+        pytest.skip('no redis to test against')
+    def clean():
+        keys = db.keys(PREFIX + '*')
+        if keys:
+            db.delete(*keys)
+    clean()
+    yield db
+    clean()
+
+def make_pool(redis_db, **config):
+    return ProxyPool(redis_db, dict(CONFIG, **config))
+
+def zadd(redis_db, key, score, member):
+    # redis-py 2.x和3.x的zadd参数不一样
+    redis_db.execute_command('ZADD', key, score, member)
+
+def next_second():
+    time.sleep(1.05 - time.time() % 1)
+
+def test_lease_concurrency_cap(redis_db):
+    pool = make_pool(redis_db, LEASE_MAX_CONCURRENCY=2, LEASE_MAX_RPS=0)
+    leases = []
+    while True:
+        lease = pool.lease(candidates=PROXIES)
+        if lease is None:
+            break
+        leases.append(lease)
+    assert len(leases) == 2 * len(PROXIES)
+    assert sorted(set(proxy for proxy, _ in leases)) == PROXIES
+    proxy, lease_id = leases[0]
+    pool.release(proxy, lease_id)
+    assert pool.lease(candidates=PROXIES)[0] == proxy
+
+def test_lease_picks_least_leased(redis_db):
+    pool = make_pool(redis_db, LEASE_MAX_CONCURRENCY=10, LEASE_MAX_RPS=0)
+    pool.lease(candidates=PROXIES[:1])
+    pool.lease(candidates=PROXIES[:1])
+    pool.lease(candidates=PROXIES[1:2])
+    pool.lease_candidates = len(PROXIES)
+    assert pool.lease(candidates=PROXIES)[0] == PROXIES[2]
+
+def test_lease_rate_cap(redis_db):
+    pool = make_pool(redis_db, LEASE_MAX_CONCURRENCY=0, LEASE_MAX_RPS=2)
+    next_second()
+    first = [pool.lease(candidates=PROXIES[:1]) for _ in range(3)]
+    assert [lease is not None for lease in first] == [True, True, False]
+    next_second()
+    assert pool.lease(candidates=PROXIES[:1]) is not None
+
+def test_lease_lapses(redis_db):
+    pool = make_pool(redis_db, LEASE_MAX_CONCURRENCY=1, LEASE_MAX_RPS=0)
+    assert pool.lease(candidates=PROXIES[:1], ttl=0.2) is not None
+    assert pool.lease(candidates=PROXIES[:1]) is None
+    time.sleep(0.3)
+    assert pool.lease(candidates=PROXIES[:1]) is not None
+    assert redis_db.ttl(pool.PROXY_LEASES % PROXIES[0]) > 0
+
+def test_claim_due(redis_db):
+    pool = make_pool(redis_db, CHECK_LEASE=600)
+    now = time.time()
+    zadd(redis_db, pool.PROXY_DUE, now - 10, PROXIES[0])
+    zadd(redis_db, pool.PROXY_DUE, now - 5, PROXIES[1])
+    zadd(redis_db, pool.PROXY_DUE, now + 60, PROXIES[2])
+    assert pool.claim_due(limit=1) == [PROXIES[0]]
+    assert pool.claim_due() == [PROXIES[1]]
+    assert pool.claim_due() == []
+    # 取走的代理推迟到租约到期
+    assert redis_db.zscore(pool.PROXY_DUE, PROXIES[0]) >= now + 590
+
+def test_sync_schedule(redis_db):
+    pool = make_pool(redis_db)
+    redis_db.sadd(pool.PROXY_SET, *PROXIES)
+    zadd(redis_db, pool.PROXY_DUE, 1, PROXIES[1])
+    zadd(redis_db, pool.PROXY_DUE, 1, 'http://10.0.0.9:8080')
+    zadd(redis_db, pool.PROXY_SCORE, 1, 'http://10.0.0.9:8080')
+    pool.sync_schedule()
+    assert sorted(m.decode('utf-8') for m in redis_db.zrange(pool.PROXY_DUE, 0, -1)) == PROXIES
+    assert redis_db.zscore(pool.PROXY_DUE, PROXIES[1]) == 1
+    # 只清理排期，其他集合留给apply/remove
+    assert redis_db.zscore(pool.PROXY_SCORE, 'http://10.0.0.9:8080') == 1
+
+def test_claim_quarantined(redis_db):
+    pool = make_pool(redis_db)
+    zadd(redis_db, pool.PROXY_QUARANTINE, time.time() - 1, PROXIES[0])
+    assert pool.claim_quarantined() == [PROXIES[0]]
+    assert pool.claim_quarantined() == []
+    assert pool.quarantined() == 1
+
+def test_leadership(redis_db):
+    pool = make_pool(redis_db)
+    assert pool.lead('a', 10)
+    assert not pool.lead('b', 10)
+    # 续期只对持有者有效
+    assert pool.lead('a', 20)
+    assert redis_db.pttl(pool.PROXY_LEADER) > 10000
+    pool.resign('b')
+    assert pool.leader() == 'a'
+    pool.resign('a')
+    assert pool.leader() is None
+    assert pool.lead('b', 10)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+''' ValidatorPool scheduling and health tracking, no network
+'''
+import time
+import asyncio
+from collections import Counter
+
+from proxy_spider import aiocheck
+from proxy_spider.validators import Validator, ValidatorPool
+
+def make_pool(*validators, **kwargs):
+    kwargs.setdefault('min_samples', 5)
+    kwargs.setdefault('alpha', 0.5)
+    return ValidatorPool(validators, **kwargs)
+
+def test_weighted_round_robin():
+    pool = make_pool(Validator('http://a/', 'a', weight=3), Validator('http://b/', 'b', weight=1),
+        Validator('https://c/', 'c', weight=5))
+    picks = [pool.pick('http', hold=False).url for _ in range(8)]
+    assert Counter(picks) == {'http://a/': 6, 'http://b/': 2}
+    # 平滑加权，不会把同一个验证页连着用光
+    assert 'http://b/' in picks[:4]
+    assert pool.pick('https').url == 'https://c/'
+
+def test_exclude():
+    pool = make_pool(Validator('http://a/', 'a'), Validator('http://b/', 'b'))
+    assert pool.pick('http', exclude=['http://a/']).url == 'http://b/'
+    assert pool.pick('http', exclude=['http://a/', 'http://b/']) is None
+    assert pool.pick('https') is None
+
+def test_concurrency_cap():
+    pool = make_pool(Validator('http://a/', 'a', concurrency=1))
+    assert pool.pick('http', strict=True).url == 'http://a/'
+    assert pool.pick('http', strict=True) is None
+    # 不严格时都满了也照样给一个
+    assert pool.pick('http').url == 'http://a/'
+    pool.release('http://a/')
+    pool.release('http://a/')
+    assert pool.pick('http', strict=True).url == 'http://a/'
+
+def test_token_bucket():
+    validator = Validator('http://a/', 'a', rps=2)
+    pool = make_pool(validator)
+    assert pool.pick('http', strict=True) is not None
+    assert pool.pick('http', strict=True) is not None
+    assert pool.pick('http', strict=True) is None
+    # 桶最多攒一秒的量
+    validator.refilled -= 10
+    picks = [pool.pick('http', strict=True) for _ in range(3)]
+    assert [p is not None for p in picks] == [True, True, False]
+
+def test_unhealthy_validator_goes_down():
+    pool = make_pool(Validator('http://a/', 'a'), Validator('http://b/', 'b'), cooldown=60)
+    for _ in range(10):
+        pool.release('http://a/', True)
+        pool.release('http://b/', False)
+    assert pool.by_url['http://b/'].down_until > time.time()
+    assert not pool.by_url['http://a/'].down_until
+    assert set(pool.pick('http').url for _ in range(4)) == {'http://a/'}
+
+def test_unreached_checks_dont_count():
+    pool = make_pool(Validator('http://a/', 'a'), Validator('http://b/', 'b'))
+    for _ in range(10):
+        pool.release('http://a/', True)
+        pool.release('http://b/', None)
+    assert pool.by_url['http://b/'].samples == 0
+    assert not pool.by_url['http://b/'].down_until
+
+def test_cooldown_ends():
+    pool = make_pool(Validator('http://a/', 'a'), Validator('http://b/', 'b'))
+    pool.mark_down(pool.by_url['http://b/'], 'test')
+    pool.by_url['http://b/'].down_until = time.time() - 1
+    assert set(pool.pick('http').url for _ in range(4)) == {'http://a/', 'http://b/'}
+    assert not pool.by_url['http://b/'].down_until
+
+def test_all_down_still_picks():
+    pool = make_pool(Validator('http://a/', 'a'))
+    pool.mark_down(pool.by_url['http://a/'], 'test')
+    assert pool.pick('http').url == 'http://a/'
+
+def test_from_config():
+    pool = ValidatorPool.from_config({'PROXY_VALIDATORS': [{'url': 'http://a/', 'startstring': 'a', 'weight': 2}],
+        'CHECK_PER_VALIDATOR': 7, 'VALIDATOR_QUORUM': 3})
+    assert list(pool) == [('http://a/', 'a')]
+    assert pool.by_url['http://a/'].concurrency == 7
+    assert pool.quorum == 3
+
+def run_checks(monkeypatch, pool, reached, quorum):
+    tried = []
+    async def check_proxy(proxy, validator, timeouts, capability=None, own_ips=None):
+        tried.append(validator[0])
+        return aiocheck.CheckResult(proxy, validator[0], False, None, 0.1 if reached else None, None,
+            'bad', (), None)
+    monkeypatch.setattr(aiocheck, 'check_proxy', check_proxy)
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(aiocheck.check_proxies(['http://1.1.1.1:80'], pool, quorum=quorum))
+    finally:
+        loop.close()
+    return tried
+
+def test_quorum(monkeypatch):
+    pool = make_pool(Validator('http://a/', 'a'), Validator('http://b/', 'b'), Validator('http://c/', 'c'))
+    tried = run_checks(monkeypatch, pool, True, 2)
+    assert len(tried) == 2 and len(set(tried)) == 2
+    # 连不上代理时换验证页也没用
+    assert len(run_checks(monkeypatch, pool, False, 2)) == 1
+    # 验证页不够quorum个时有几个试几个
+    assert len(run_checks(monkeypatch, make_pool(Validator('http://a/', 'a')), True, 2)) == 1
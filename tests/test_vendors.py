@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+''' Vendor presets and declarative rules on canned pages, no network
+'''
+import pytest
+from parsel import Selector
+
+from proxy_spider import vendors
+
+class Page(object):
+    ''' The two bits of a scrapy response vendors read
+    '''
+    def __init__(self, text):
+        self.text = text
+        self.selector = Selector(text=text)
+
+    def body_as_unicode(self):
+        return self.text
+
+def table(rows, attrs=''):
+    return '<table %s><tbody>%s</tbody></table>' % (attrs, ''.join(
+        '<tr>%s</tr>' % ''.join('<td>%s</td>' % cell for cell in row) for row in rows))
+
+def test_xici_cells():
+    page = Page(
+        '<table id="ip_list"><tr><th>国家</th><th>IP地址</th></tr>'
+        '<tr><td><img alt="Cn"></td><td>110.73.1.1</td><td>8123</td><td>广西</td><td>高匿</td><td>HTTPS</td>'
+        '<td><div title="0.312秒" class="bar"></div></td></tr>'
+        '<tr><td></td><td>110.73.1.2</td><td>80</td><td>广西</td><td>高匿</td><td>HTTP</td>'
+        '<td><div title="5.1秒" class="bar"></div></td></tr></table>')
+    # 慢的那个被max_latency过滤掉，HTTPS列也是http代理
+    vendor = vendors.compile_vendor({'parser': 'parse_xici'})
+    assert vendor.extract(page) == ['http://110.73.1.1:8123']
+
+def test_ip181_filters_anonymity():
+    page = Page(table([['1.1.1.1', '80', '高匿', 'HTTP'], ['2.2.2.2', '8080', '透明', 'HTTP']]))
+    assert vendors.compile_vendor({'parser': 'parse_ip181'}).extract(page) == ['http://1.1.1.1:80']
+
+def test_kxdaili_cells():
+    page = Page(table([['3.3.3.3', '3128', '高匿']], 'class="ui table segment"'))
+    assert vendors.compile_vendor({'parser': 'parse_kxdaili'}).extract(page) == ['http://3.3.3.3:3128']
+
+def test_66ip_text():
+    page = Page('<html><body>1.2.3.4:80<br>5.6.7.8:3128<br>999.1:1</body></html>')
+    assert vendors.compile_vendor({'parser': 'parse_66ip'}).extract(page) == ['http://1.2.3.4:80', 'http://5.6.7.8:3128']
+
+def test_json_items():
+    page = Page('{"data": {"list": [{"ip": "1.1.1.1", "port": 1080, "type": "socks5"}, "2.2.2.2:3128", {"ip": "x"}]}}')
+    vendor = vendors.compile_vendor({'url': 'http://api', 'format': 'json', 'items': 'data.list',
+        'fields': {'ip': 'ip', 'port': 'port', 'proto': 'type'}})
+    assert vendor.extract(page) == ['socks5://1.1.1.1:1080', 'http://2.2.2.2:3128']
+
+def test_preset_override():
+    page = Page(table([['1.1.1.1', '80', '透明', 'HTTP']]))
+    vendor = vendors.compile_vendor({'parser': 'parse_ip181', 'filters': {}})
+    assert vendor.extract(page) == ['http://1.1.1.1:80']
+
+def test_pages():
+    vendor = vendors.compile_vendor({'parser': 'parse_kxdaili', 'url': 'http://example.com/%s.html', 'pages': 2})
+    assert vendor.urls == ['http://example.com/1.html', 'http://example.com/2.html']
+
+def test_old_kxdaili_url_keeps_paging():
+    vendor = vendors.compile_vendor({'parser': 'parse_kxdaili', 'url': 'http://www.kxdaili.com/dailiip/1/1.html#ip'})
+    assert len(vendor.urls) == 3
+    vendor = vendors.compile_vendor({'parser': 'parse_kxdaili', 'url': 'http://example.com/list.html'})
+    assert vendor.urls == ['http://example.com/list.html']
+
+@pytest.mark.parametrize('entry', [
+    {'parser': 'parse_nothing', 'url': 'http://example.com/'},
+    {'url': 'http://example.com/'},
+    {'url': 'http://example.com/', 'rows': 'tr', 'fields': {'ip': 0}},
+    {'url': 'http://example.com/', 'format': 'text', 'pages': 2},
+    {'format': 'text'},
+    {'url': 'http://example.com/', 'format': 'xml'},
+])
+def test_bad_entries(entry):
+    with pytest.raises(vendors.VendorError):
+        vendors.compile_vendor(entry)